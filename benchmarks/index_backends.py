@@ -0,0 +1,118 @@
+'''
+Compares the index build time and query latency of the javascript view and mango index backends
+
+Usage:
+	python benchmarks/index_backends.py --url http://127.0.0.1:5984 --documents 10000 --queries 200
+
+Created on 18 Oct 2026
+
+@author: Will Ogden
+'''
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+import ormchair
+
+
+class BenchmarkPerson(ormchair.Document):
+
+	name = ormchair.StringProperty()
+	age = ormchair.IntegerProperty()
+	address = ormchair.DictProperty(
+		address_1 = ormchair.StringProperty(),
+		postcode = ormchair.StringProperty()
+	)
+
+	get_by_name = ormchair.Index("name")
+	get_by_postcode_and_age = ormchair.Index("address.postcode","age")
+
+
+# Returns the percentile of a sorted list of timings
+def percentile(timings,percent):
+
+	return timings[min(int(len(timings) * percent / 100.0),len(timings) - 1)]
+
+
+def run(url,username,password,backend,documents,queries,seed):
+
+	session = ormchair.Session(url,username=username,password=password)
+
+	database_name = "ormchair_bench_%s" % (backend)
+	if session.databaseExists(database_name):
+		session.deleteDatabase(database_name)
+
+	database = session.createDatabase(database_name,index_backend=backend)
+	database.sync()
+
+	generator = random.Random(seed)
+	names = ["name_%d" % (i) for i in range(documents / 10 or 1)]
+	postcodes = ["PC%d" % (i) for i in range(100)]
+
+	# Load the documents in chunks
+	batch = []
+	for i in range(documents):
+
+		person = BenchmarkPerson()
+		person.name = generator.choice(names)
+		person.age = generator.randint(1,100)
+		person.address.address_1 = "%d The Street" % (i)
+		person.address.postcode = generator.choice(postcodes)
+		batch.append(person)
+
+		if len(batch) == 1000:
+			database.addMultiple(batch)
+			batch = []
+
+	if len(batch) > 0:
+		database.addMultiple(batch)
+
+	# First query builds the index
+	start = time.time()
+	database.getByIndex(BenchmarkPerson.get_by_name,key=names[0],limit=1)
+	build_time = time.time() - start
+
+	timings = []
+	for i in range(queries):
+
+		start = time.time()
+		if i % 2:
+			database.getByIndex(BenchmarkPerson.get_by_name,key=generator.choice(names))
+		else:
+			postcode = generator.choice(postcodes)
+			database.getByIndex(BenchmarkPerson.get_by_postcode_and_age,startkey=[postcode,18],endkey=[postcode,65])
+		timings.append(time.time() - start)
+
+	timings.sort()
+	session.deleteDatabase(database_name)
+
+	return {
+		"backend" : backend,
+		"build" : build_time,
+		"p50" : percentile(timings,50),
+		"p95" : percentile(timings,95),
+		"p99" : percentile(timings,99)
+	}
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Compare the view and mango index backends")
+	parser.add_argument("--url",default="http://127.0.0.1:5984")
+	parser.add_argument("--username")
+	parser.add_argument("--password")
+	parser.add_argument("--documents",type=int,default=10000)
+	parser.add_argument("--queries",type=int,default=200)
+	parser.add_argument("--seed",type=int,default=1)
+	args = parser.parse_args()
+
+	print "%-8s %12s %10s %10s %10s" % ("backend","build (s)","p50 (ms)","p95 (ms)","p99 (ms)")
+
+	for backend in ["view","mango"]:
+
+		result = run(args.url,args.username,args.password,backend,args.documents,args.queries,args.seed)
+		print "%-8s %12.3f %10.2f %10.2f %10.2f" % (backend,result["build"],result["p50"] * 1000,result["p95"] * 1000,result["p99"] * 1000)
@@ -0,0 +1,322 @@
+'''
+Microbenchmarks for the pure python hot paths (schema inflation/export, view row processing, property paths, list properties and
+class creation). Runs offline, no couchdb needed.
+
+Usage:
+	python benchmarks/microbenchmarks.py
+	python benchmarks/microbenchmarks.py --save baseline
+	python benchmarks/microbenchmarks.py --compare baseline --max-regression 10
+	python benchmarks/microbenchmarks.py --filter instance_from_dict --repeat 9
+
+Baselines are stored as json in benchmarks/baselines/<name>.json so they can be committed and compared between commits. Each benchmark
+uses fixed data and a fixed number of calls per repeat, with the garbage collector paused whilst timing, and reports the fastest repeat
+(the least noisy measure) alongside the median.
+
+Created on 19 Oct 2026
+
+@author: Will Ogden
+'''
+import os
+import sys
+import gc
+import json
+import copy
+import random
+import timeit
+import argparse
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+import ormchair
+
+BASELINES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),"baselines")
+
+
+class MicrobenchmarkFlat(ormchair.Document):
+
+	name = ormchair.StringProperty()
+	email = ormchair.StringProperty()
+	city = ormchair.StringProperty()
+	country = ormchair.StringProperty()
+	age = ormchair.IntegerProperty()
+	height = ormchair.NumberProperty()
+	weight = ormchair.NumberProperty()
+	score = ormchair.IntegerProperty()
+	active = ormchair.BooleanProperty()
+	verified = ormchair.BooleanProperty()
+
+
+class MicrobenchmarkNested(ormchair.Document):
+
+	name = ormchair.StringProperty()
+	level_1 = ormchair.DictProperty(
+		value = ormchair.StringProperty(),
+		level_2 = ormchair.DictProperty(
+			value = ormchair.StringProperty(),
+			level_3 = ormchair.DictProperty(
+				value = ormchair.StringProperty(),
+				level_4 = ormchair.DictProperty(
+					value = ormchair.StringProperty(),
+					level_5 = ormchair.DictProperty(
+						value = ormchair.StringProperty(),
+						number = ormchair.IntegerProperty()
+					)
+				)
+			)
+		)
+	)
+
+
+class MicrobenchmarkList(ormchair.Document):
+
+	name = ormchair.StringProperty()
+	tags = ormchair.ListProperty(
+		ormchair.StringProperty()
+	)
+	addresses = ormchair.ListProperty(
+		ormchair.DictProperty(
+			address_1 = ormchair.StringProperty(),
+			postcode = ormchair.StringProperty()
+		)
+	)
+
+
+# Fixed data so runs are comparable (documents are given a rev as if read from couchdb)
+def createFlat(generator):
+
+	document = MicrobenchmarkFlat()
+	document._id = "flat_%d" % (generator.randint(0,10 ** 9))
+	document._rev = "1-%x" % (generator.getrandbits(128))
+	document.name = "name_%d" % (generator.randint(0,1000))
+	document.email = "user_%d@example.com" % (generator.randint(0,1000))
+	document.city = generator.choice(["London","Leeds","Bristol"])
+	document.country = "UK"
+	document.age = generator.randint(1,100)
+	document.height = generator.random() * 2
+	document.weight = generator.random() * 100
+	document.score = generator.randint(0,10000)
+	document.active = generator.random() > 0.5
+	document.verified = generator.random() > 0.5
+
+	return document
+
+def createNested(generator):
+
+	document = MicrobenchmarkNested()
+	document._id = "nested_%d" % (generator.randint(0,10 ** 9))
+	document._rev = "1-%x" % (generator.getrandbits(128))
+	document.name = "name_%d" % (generator.randint(0,1000))
+	document.level_1.value = "value_1"
+	document.level_1.level_2.value = "value_2"
+	document.level_1.level_2.level_3.value = "value_3"
+	document.level_1.level_2.level_3.level_4.value = "value_4"
+	document.level_1.level_2.level_3.level_4.level_5.value = "value_5"
+	document.level_1.level_2.level_3.level_4.level_5.number = generator.randint(0,1000)
+
+	return document
+
+def createList(generator):
+
+	document = MicrobenchmarkList()
+	document._id = "list_%d" % (generator.randint(0,10 ** 9))
+	document._rev = "1-%x" % (generator.getrandbits(128))
+	document.name = "name_%d" % (generator.randint(0,1000))
+	document.tags = ["tag_%d" % (generator.randint(0,1000)) for i in range(1000)]
+	document.addresses = [{"address_1" : "%d The Street" % (i), "postcode" : "PC%d" % (generator.randint(0,100))} for i in range(100)]
+
+	return document
+
+# A view response with include_docs=true
+def createViewPayload(generator,rows):
+
+	documents_data = [createFlat(generator).instanceToDict() for i in range(rows)]
+
+	return {
+		"total_rows" : rows,
+		"offset" : 0,
+		"rows" : [{"id" : document_data["_id"], "key" : document_data["name"], "value" : None, "doc" : document_data} for document_data in documents_data]
+	}
+
+# Create a document class as a class statement would
+def createDocumentClass():
+
+	return type("MicrobenchmarkClassCreation",(ormchair.Document,),{
+		"name" : ormchair.StringProperty(),
+		"age" : ormchair.IntegerProperty(),
+		"address" : ormchair.DictProperty(
+			address_1 = ormchair.StringProperty(),
+			postcode = ormchair.StringProperty()
+		),
+		"tags" : ormchair.ListProperty(
+			ormchair.StringProperty()
+		),
+		"get_by_name" : ormchair.Index("name")
+	})
+
+
+def getBenchmarks(seed):
+	"""
+	Returns a list of (name, calls per repeat, prepare, run) where prepare() builds the argument for one call outside the timing and run(arg)
+	is timed
+	"""
+	generator = random.Random(seed)
+
+	flat = createFlat(generator)
+	nested = createNested(generator)
+	large_list = createList(generator)
+
+	flat_data = flat.instanceToDict()
+	nested_data = nested.instanceToDict()
+	large_list_data = large_list.instanceToDict()
+
+	view_payload = createViewPayload(generator,100)
+
+	# Documents aren't bound to a server when processing a view response
+	database = ormchair.Database("http://127.0.0.1:5984/microbenchmark/",None,ormchair.BasicLock)
+
+	tags = large_list.tags
+	tags_to_add = ["new_tag_%d" % (i) for i in range(100)]
+
+	return [
+		# Inflating consumes the dict so each call gets a fresh copy
+		("instance_from_dict.flat",2000,lambda: copy.deepcopy(flat_data),lambda data: MicrobenchmarkFlat(document_data=data)),
+		("instance_from_dict.nested",1000,lambda: copy.deepcopy(nested_data),lambda data: MicrobenchmarkNested(document_data=data)),
+		("instance_from_dict.large_list",20,lambda: copy.deepcopy(large_list_data),lambda data: MicrobenchmarkList(document_data=data)),
+		("instance_to_dict.flat",5000,lambda: flat,lambda document: document.instanceToDict()),
+		("instance_to_dict.nested",2000,lambda: nested,lambda document: document.instanceToDict()),
+		("instance_to_dict.large_list",50,lambda: large_list,lambda document: document.instanceToDict()),
+		("create_document.view_100_rows",20,lambda: copy.deepcopy(view_payload),lambda payload: database._processViewResponse(payload)),
+		("schema_to_dict.nested",2000,lambda: MicrobenchmarkNested,lambda document_class: document_class.schemaToDict()),
+		("schema_to_dict.large_list",5000,lambda: MicrobenchmarkList,lambda document_class: document_class.schemaToDict()),
+		("get_property_value_by_path.depth_1",20000,lambda: nested,lambda document: document.getPropertyValueByPath("name")),
+		("get_property_value_by_path.depth_6",5000,lambda: nested,lambda document: document.getPropertyValueByPath("level_1.level_2.level_3.level_4.level_5.number")),
+		("dict_property_list.append",200,lambda: MicrobenchmarkList(),lambda document: [document.tags.append(tag) for tag in tags_to_add]),
+		("dict_property_list.extend",200,lambda: MicrobenchmarkList(),lambda document: document.tags.extend(tags_to_add)),
+		("dict_property_list.getitem",200,lambda: tags,lambda tag_list: [tag_list[i] for i in range(100)]),
+		("dict_property_list.contains",200,lambda: tags,lambda tag_list: "missing_tag" in tag_list),
+		("dict_property_list.iterate",200,lambda: tags,lambda tag_list: [tag for tag in tag_list]),
+		("class_creation.document",500,lambda: None,lambda unused: createDocumentClass())
+	]
+
+
+# Time a benchmark, returning the per call seconds of each repeat
+def measure(calls,prepare,run,repeat):
+
+	timings = []
+
+	for i in range(repeat):
+
+		arguments = [prepare() for j in range(calls)]
+
+		gc.collect()
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+
+		try:
+			start = timeit.default_timer()
+			for argument in arguments:
+				run(argument)
+			timings.append((timeit.default_timer() - start) / calls)
+		finally:
+			if gc_was_enabled:
+				gc.enable()
+
+	return timings
+
+
+# Returns the current git commit if available
+def getCommit():
+
+	try:
+		return subprocess.check_output(["git","rev-parse","--short","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),stderr=subprocess.STDOUT).strip()
+	except (OSError,subprocess.CalledProcessError):
+		return None
+
+
+def run(repeat,seed,name_filter=None):
+
+	results = {}
+
+	for (name,calls,prepare,run_benchmark) in getBenchmarks(seed):
+
+		if name_filter and name_filter not in name:
+			continue
+
+		timings = sorted(measure(calls,prepare,run_benchmark,repeat))
+
+		results[name] = {
+			"calls" : calls,
+			"repeat" : repeat,
+			"min" : timings[0],
+			"median" : timings[len(timings) / 2]
+		}
+
+	return {
+		"commit" : getCommit(),
+		"python" : platform.python_version(),
+		"platform" : platform.platform(),
+		"seed" : seed,
+		"results" : results
+	}
+
+
+def getBaselinePath(name):
+
+	return os.path.join(BASELINES_DIRECTORY,"%s.json" % (name))
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Microbenchmark the pure python hot paths")
+	parser.add_argument("--repeat",type=int,default=5)
+	parser.add_argument("--seed",type=int,default=1)
+	parser.add_argument("--filter",help="Only run benchmarks whose name contains this")
+	parser.add_argument("--save",metavar="NAME",help="Store the results as benchmarks/baselines/NAME.json")
+	parser.add_argument("--compare",metavar="NAME",help="Compare against benchmarks/baselines/NAME.json")
+	parser.add_argument("--max-regression",type=float,help="Exit with an error if a benchmark is this percent slower than the baseline")
+	args = parser.parse_args()
+
+	report = run(args.repeat,args.seed,args.filter)
+
+	baseline = None
+	if args.compare:
+		with open(getBaselinePath(args.compare)) as baseline_file:
+			baseline = json.load(baseline_file)
+
+	regressions = []
+
+	if baseline:
+		print "Comparing against %s (commit %s, python %s)" % (args.compare,baseline.get("commit"),baseline.get("python"))
+		print "%-40s %12s %12s %10s" % ("benchmark","min (us)","base (us)","change")
+	else:
+		print "%-40s %12s %12s" % ("benchmark","min (us)","median (us)")
+
+	for name in sorted(report["results"].keys()):
+
+		result = report["results"][name]
+
+		if baseline and name in baseline["results"]:
+
+			change = 100.0 * (result["min"] - baseline["results"][name]["min"]) / baseline["results"][name]["min"]
+			print "%-40s %12.2f %12.2f %+9.1f%%" % (name,result["min"] * 10 ** 6,baseline["results"][name]["min"] * 10 ** 6,change)
+
+			if args.max_regression is not None and change > args.max_regression:
+				regressions.append(name)
+		else:
+			print "%-40s %12.2f %12.2f" % (name,result["min"] * 10 ** 6,result["median"] * 10 ** 6)
+
+	if args.save:
+
+		if not os.path.exists(BASELINES_DIRECTORY):
+			os.makedirs(BASELINES_DIRECTORY)
+
+		with open(getBaselinePath(args.save),"w") as baseline_file:
+			json.dump(report,baseline_file,indent=4,sort_keys=True)
+
+		print "Saved %s" % (getBaselinePath(args.save))
+
+	if regressions:
+		print "Regressed more than %.1f%%: %s" % (args.max_regression,", ".join(regressions))
+		sys.exit(1)
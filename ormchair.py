@@ -11,7 +11,38 @@ import uuid
 import json
 import copy
 import threading
-import weakref
+import time
+import hashlib
+import random
+import functools
+import urlparse
+import logging
+import gc
+import zlib
+import os
+import mmap
+import urllib
+import base64
+import collections
+import Queue
+import heapq
+import itertools
+import unicodedata
+import atexit
+
+# Optional faster json libraries for JSONCodec
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+try:
+	import simplejson
+except ImportError:
+	simplejson = None
+
+# Warnings are only output if the application configures logging
+logging.getLogger("ormchair").addHandler(logging.NullHandler())
 
 class ValidationError(Exception):
 	"""
@@ -35,6 +66,20 @@ class PropertyPathNotFoundError(Exception):
 	def __init__(self, message):
 		Exception.__init__(self, message)
 
+class MigrationError(Exception):
+	"""
+	Used when a document can't be migrated to the current schema version
+	"""
+	def __init__(self, message):
+		Exception.__init__(self, message)
+
+class LinkedDocumentNotFoundError(AttributeError):
+	"""
+	Used when an attribute of an embedded link proxy is read but the linked document doesn't exist
+	"""
+	def __init__(self, message):
+		AttributeError.__init__(self, message)
+
 class Property(object):
 	"""
 	Represents an abstract property of a class
@@ -630,6 +675,20 @@ class ListProperty(Property):
 		# Empty array
 		list_data = []
 		
+		# Inflated (and proxied) embedded links are stored as their id, only lists of them need checking for those
+		if isinstance(self._cls._property,EmbeddedLinkProperty):
+			
+			for item in self.__get__(instance,None):
+				
+				if isinstance(item,(BaseDocument,EmbeddedLinkProxy)):
+					list_data.append(item._id)
+				elif issubclass(item.__class__,Schema):
+					list_data.append(item.instanceToDict())
+				else:
+					list_data.append(item)
+			
+			return list_data
+		
 		# Loop over dictpropertlist
 		for item in self.__get__(instance,None):
 			
@@ -686,6 +745,16 @@ class LinkProperty(Property):
 	def __set__(self, instance, value):
 		pass
 	
+	# Override so the reverse link property knows the name of this side of the relationship (not known when it's created)
+	def setName(self,name):
+		
+		super(LinkProperty,self).setName(name)
+		
+		reverse_link_property = getattr(self._linked_class,self._reverse,None) if self._reverse else None
+		
+		if isinstance(reverse_link_property,LinkProperty) and reverse_link_property is not self:
+			reverse_link_property._reverse = name
+	
 	def instanceToDict(self,instance):
 		
 		return None
@@ -763,12 +832,19 @@ class EmbeddedLinkProperty(Property):
 		else:
 			self._checkForPropertyValue(instance)
 
+			embedded_link = instance._property_values[self._name]
+
 			# If _inflated is True return the doc
-			if instance._property_values[self._name]._inflated:
-				return instance._property_values[self._name]._document
-			else:
-				# Return id
-				return instance._property_values[self._name]._id
+			if embedded_link._inflated:
+				return embedded_link._document
+			
+			# In a loader scope return a proxy that is loaded in a batch with the other links read in the scope
+			loader = getattr(_operation_context,"loader",None)
+			if loader is not None and embedded_link._id:
+				return loader._getLinkedDocument(self,instance,embedded_link)
+			
+			# Return id
+			return embedded_link._id
 	
 
 	def __set__(self, instance, value):
@@ -780,6 +856,10 @@ class EmbeddedLinkProperty(Property):
 			instance._property_values[self._name]._inflated = True
 			instance._property_values[self._name]._document = value
 			instance._property_values[self._name]._id = value._id
+		elif isinstance(value,EmbeddedLinkProxy):
+			instance._property_values[self._name]._inflated = False
+			instance._property_values[self._name]._document = None
+			instance._property_values[self._name]._id = value._id
 		elif isinstance(value,basestring):
 			instance._property_values[self._name]._id = value
 		elif value:
@@ -799,6 +879,10 @@ class EmbeddedLinkProperty(Property):
 		else:
 			return None
 	
+	def getLinkedClass(self):
+		
+		return self._linked_class
+	
 	# Override
 	def schemaToDict(self):
 		
@@ -811,838 +895,5004 @@ class EmbeddedLinkProperty(Property):
 		
 		return schema_dict
 
-class BasicLock(object):
+class AttachmentValue():
+	
+	def __init__(self,content=None,pending=False):
+		
+		self._content = content
+		
+		# Set but not yet saved (sent inline with the next add/update)
+		self._pending = pending
+
+
+class AttachmentProperty(Property):
 	"""
-	A basic single process only lock for single threaded access to particular documents
+	A (large) string property stored out-of-line as an attachment named after the property. Documents read from the database only
+	carry the stub, the content is fetched on first access
 	"""
-	main_lock = threading.RLock()
-	document_locks = weakref.WeakValueDictionary()
+	def __init__(self,**kwargs):
+		"""
+        Kwargs:
+			default (str): Default value
+			required (bool): Is this a required (compulsory) property (only in the schema, the content isn't in the document body)
+			content_type (str): The attachment mime type
+			cache (bool): Keep the content once fetched or saved, otherwise it's fetched on every access
+		"""
+		self._content_type = kwargs.pop('content_type', "application/octet-stream")
+		self._cache = kwargs.pop('cache', True)
+		
+		super(AttachmentProperty, self).__init__(**kwargs)
 	
-	def __init__(self,document_ids):
-		self._document_ids = sorted(document_ids)
-		self._document_locks = None
+	def __get__(self, instance, owner):
 		
-	def __enter__(self):
+		if instance is None:
+			return self
 		
-		# Aquire main lock whilst checking if per document locks exist
-		with BasicLock.main_lock:
-			self._document_locks = [BasicLock.document_locks.setdefault(document_id, threading.RLock()) for document_id in self._document_ids]
+		attachment_value = instance._property_values.get(self._name)
 		
-		# Now try and aquire locks (done in a sorted way to avoid deadlocks)
-		for document_lock in self._document_locks:
-			document_lock.acquire()
-	
-	def __exit__(self, exc_type, exc_val, exc_tb):
+		if attachment_value is not None:
+			return attachment_value._content
 		
-		# Release lock (in reverse order to aquire)
-		for document_lock in reversed(self._document_locks):
-			document_lock.release()
+		# Not set and no attachment
+		if not instance.hasAttachment(self._name):
+			return None
 		
-		if exc_type is not None:
-			# Exception occurred
-			return False # Will raise the exception
+		if instance.getDatabase() is None:
+			raise Exception("Document %s isn't bound to a database to fetch attachment %s from" % (instance._id,self._name))
 		
-		# All Ok
-		return True
-
-class Session(object):
-	"""
-	A couchdb server session
-	"""
-	def __init__(self,url,username=None,password=None,Lock=BasicLock):
+		content = instance.getDatabase().getAttachment(instance,self._name)
 		
-		# Url of the couchdb server
-		self._url = url
+		if self._cache:
+			instance._property_values[self._name] = AttachmentValue(content)
 		
-		# The lock class
-		self._Lock = Lock
+		return content
+	
+	def __set__(self, instance, value):
 		
-		# Create a session to deal with subsequent requests
-		self._database_session = requests.Session()
+		if self._validate(value):
+			instance._property_values[self._name] = AttachmentValue(value,pending=True)
+	
+	# Override
+	def _validate(self,value):
 		
-		# If username and password passed in then try and login
-		if username and password:
-			
-			# Login with basic auth first, this issues a cookie which is then used for each subsequent call
-			r = self._database_session.post("%s/_session" % (self._url), data={"name": username,"password": password}, auth=(username, password))
-			
-			if r.status_code != 200:
-				
-				raise Exception(r.json())
+		if value and not isinstance(value, basestring):
+			raise ValidationError("Not a string")
 		
-	def createDatabase(self,database_name):
+		return True
+	
+	# Override, the content can't be checked for when reading a document
+	def getRequired(self):
 		
-		# TODO check the database name is valid
-		database_url = "%s/%s/" % (self._url, database_name)
-		r = self._database_session.put(database_url)
+		return False
+	
+	def getContentType(self):
 		
-		if r.status_code == 201:
-			return Database(database_url,self._database_session, self._Lock)
+		return self._content_type
+	
+	# Returns the attachment to send with the document, an inline attachment if set since last saved, its stub, or None if removed
+	def attachmentToDict(self,instance):
+		
+		attachment_value = instance._property_values.get(self._name)
+		
+		if attachment_value is None or not attachment_value._pending:
+			return instance.getAttachmentStub(self._name)
+		elif attachment_value._content is None:
+			return None
 		else:
-			raise Exception(r.json())
+			content = attachment_value._content.encode("utf-8") if isinstance(attachment_value._content,unicode) else attachment_value._content
+			return {"content_type" : self._content_type, "data" : base64.b64encode(content)}
+	
+	# Called once the document has been saved
+	def setSaved(self,instance):
 		
-	def getDatabase(self,database_name):
+		attachment_value = instance._property_values.get(self._name)
 		
-		database_url = "%s/%s/" % (self._url, database_name)
-		r = self._database_session.get(database_url)
+		if attachment_value is None or not attachment_value._pending:
+			return
 		
-		if r.status_code == 200:
-			return Database(database_url, self._database_session, self._Lock, info=r.json())
+		if attachment_value._content is None:
+			instance.removeAttachmentStub(self._name)
+		else:
+			content = attachment_value._content.encode("utf-8") if isinstance(attachment_value._content,unicode) else attachment_value._content
+			instance.setAttachmentStub(self._name,{"content_type" : self._content_type, "length" : len(content), "stub" : True})
+		
+		if self._cache:
+			attachment_value._pending = False
 		else:
-			raise Exception(r.json())
+			del instance._property_values[self._name]
 	
-	def databaseExists(self,database_name):
+	# Override
+	def schemaToDict(self):
 		
-		database_url = "%s/_all_dbs" % (self._url)
-		r = self._database_session.get(database_url)
+		schema_dict = super(AttachmentProperty,self).schemaToDict()
 		
-		if r.status_code == 200:
-			return True if database_name in r.json() else False
+		schema_dict["type"] = "string"
+		schema_dict["media"] = {"type" : self._content_type}
+		
+		return schema_dict
+
+class _LockStripe(object):
+	"""
+	One stripe of BasicLock's lock table, a re-entrant lock that records how it's used
+	"""
+	def __init__(self):
+		
+		self._lock = threading.RLock()
+		self._depth = 0
+		self._acquired_at = None
+		
+		self.acquisitions = 0
+		self.contended = 0
+		self.wait_time = 0.0
+		self.max_wait_time = 0.0
+		self.max_hold_time = 0.0
+	
+	def acquire(self):
+		
+		# Only time the wait if the stripe is already held
+		if self._lock.acquire(False):
+			wait_time = 0.0
 		else:
-			raise Exception(r.json())
+			start = time.time()
+			self._lock.acquire()
+			wait_time = time.time() - start
+			self.contended += 1
+		
+		# Counters are only updated whilst holding the stripe
+		self.acquisitions += 1
+		self.wait_time += wait_time
+		self.max_wait_time = max(self.max_wait_time,wait_time)
+		
+		self._depth += 1
+		if self._depth == 1:
+			self._acquired_at = time.time()
 	
-	def deleteDatabase(self,database_name):
+	def release(self):
 		
-		database_url = "%s/%s/" % (self._url, database_name)
-		r = self._database_session.delete(database_url)
+		self._depth -= 1
+		if self._depth == 0:
+			self.max_hold_time = max(self.max_hold_time,time.time() - self._acquired_at)
 		
-		if r.status_code != 200:
-			raise Exception(r.json())
+		self._lock.release()
+	
+	def getMetrics(self):
+		
+		return {
+			"acquisitions" : self.acquisitions,
+			"contended" : self.contended,
+			"wait_time" : self.wait_time,
+			"max_wait_time" : self.max_wait_time,
+			"max_hold_time" : self.max_hold_time
+		}
 
 
-class Database(object):
+class BasicLock(object):
 	"""
-	Represents a couchdb database
+	A basic single process only lock for single threaded access to particular documents. Document ids are hashed onto 
+	a fixed table of lock stripes, which are acquired in stripe order to avoid deadlocks
 	"""
-	def __init__(self,database_url,database_session, Lock, info = None):
-		self._database_url = database_url
-		self._database_session = database_session
-		self._Lock = Lock
-		self._info = info
+	stripe_count = 64
+	stripes = [_LockStripe() for i in range(stripe_count)]
+	
+	def __init__(self,document_ids,database=None):
+		self._document_ids = sorted(document_ids)
+		self._stripes = None
+	
+	# Set the number of stripes (replaces the lock table so should only be called at start up)
+	@classmethod
+	def setStripeCount(cls,stripe_count):
 		
-	def getUrl(self):
-		return self._database_url
+		BasicLock.stripe_count = stripe_count
+		BasicLock.stripes = [_LockStripe() for i in range(stripe_count)]
 	
-	# Add single document
-	def add(self,document):
+	# Get the stripe a document id is locked with e.g. to match hot stripes to documents
+	@classmethod
+	def getStripeIndex(cls,document_id):
+		
+		return hash(document_id) % BasicLock.stripe_count
+	
+	# Returns the acquisitions, contended acquisitions, total and max wait time and max hold time of each stripe
+	@classmethod
+	def getMetrics(cls):
 		
-		data = json.dumps(document.instanceToDict())
+		return [stripe.getMetrics() for stripe in BasicLock.stripes]
 		
-		r = self._database_session.put("%s/%s" % (self._database_url,document._id),data=data)
+	def __enter__(self):
 		
-		if r.status_code == 201:
-			document._rev = r.json()["rev"]		
-		else:
-			raise Exception(r.json())
+		# Several ids can share a stripe so only lock each once
+		stripes = BasicLock.stripes
+		stripe_indexes = sorted(set([hash(document_id) % len(stripes) for document_id in self._document_ids]))
+		self._stripes = [stripes[stripe_index] for stripe_index in stripe_indexes]
 		
-		return document
+		# Now try and aquire locks (done in stripe order to avoid deadlocks)
+		for stripe in self._stripes:
+			stripe.acquire()
 	
-	# Updates a document
-	def update(self,document):
+	def __exit__(self, exc_type, exc_val, exc_tb):
 		
-		# Lock the document whilst updating
-		with self._Lock(document._id):
-			
-			data = json.dumps(document.instanceToDict())
-			
-			r = self._database_session.put("%s/%s" % (self._database_url,document._id),data=data)
-			
-			if r.status_code == 201:
-				document._rev = r.json()["rev"]
-			else:
-				raise Exception(r.json())
-			
-			# If this document has linked documents with indexes must update
-			if issubclass(document.__class__, Document) and document.__class__.hasLinksWithIndexes():
-				
-				self._updateLinkIndexes(document)
+		# Release lock (in reverse order to aquire)
+		for stripe in reversed(self._stripes):
+			stripe.release()
+		
+		if exc_type is not None:
+			# Exception occurred
+			return False # Will raise the exception
+		
+		# All Ok
+		return True
 
-			return document
+# Update sequences are integers in couchdb 1.x and opaque "N-xxxx" strings (or lists in BigCouch) in later versions
+def _sequenceNumber(update_seq):
 	
-	# Get single document
-	def get(self,_id,rev=None,as_json=False):
+	if isinstance(update_seq,list):
+		update_seq = update_seq[0]
+	
+	if isinstance(update_seq,basestring):
+		update_seq = update_seq.split("-")[0]
+	
+	return int(update_seq)
+
+# The changes a view index is behind its database. The leading number of an opaque (clustered) sequence is only a sum over the
+# shards, so those are caught up only when the sequences are equal and otherwise the lag is approximate (but at least 1)
+def _sequenceLag(database_seq,view_seq):
+	
+	if database_seq == view_seq:
+		return 0
+	
+	lag = _sequenceNumber(database_seq) - _sequenceNumber(view_seq)
+	
+	opaque = (isinstance(database_seq,basestring) and isinstance(view_seq,basestring)) or (isinstance(database_seq,list) and isinstance(view_seq,list))
+	
+	return max(lag,1 if opaque else 0)
+
+
+class BackgroundTask(threading.Thread):
+	"""
+	A daemon thread that records any error raised so it can be re-raised when waited on
+	"""
+	def __init__(self,target,*args):
 		
-		params = {}
-		if rev:
-			params = {"rev" : rev}
+		super(BackgroundTask,self).__init__()
+		self.daemon = True
 		
-		r = self._database_session.get("%s/%s" % (self._database_url,_id), params = params)
+		self._target_function = target
+		self._target_args = args
+		self._error = None
 		
-		if r.status_code == 200:
-			document_data = r.json()
-			
-			# See if just need to return json
-			if as_json:
-				return document_data
-			else:
-				return self._createDocument(document_data)
+	def run(self):
+		
+		try:
+			self._target_function(*self._target_args)
+		except Exception as e:
+			self._error = e
 	
-		else:
-			raise Exception(r.json())
+	# Has the task finished without error
+	def isComplete(self):
+		
+		return not self.is_alive() and self._error is None
 	
-	# Deletes a single document
-	def delete(self,document):
+	# Blocks until the task has finished and raises any error that occurred
+	def wait(self,timeout=None):
 		
-		# Lock the document whilst deleting
-		with self._Lock(document._id):
+		self.join(timeout)
+		
+		if self._error is not None:
+			raise self._error
+		
+		return self.isComplete()
+
+
+class LockTimeoutError(Exception):
+	"""
+	Used when a lock couldn't be acquired in time
+	"""
+	def __init__(self, message):
+		Exception.__init__(self, message)
+
+class LeaseExpiredError(Exception):
+	"""
+	Used when a lease lock is released after its leases expired (so another process may have held them)
+	"""
+	def __init__(self, message):
+		Exception.__init__(self, message)
+
+
+class LeaseLock(object):
+	"""
+	A multi process lock stored as lease documents in the database. Leases are created with _bulk_docs so a conflict means 
+	another process holds the lease, and expire after a ttl so a crashed process can't hold a document forever. All the leases
+	of a lock are acquired or none are (so processes locking overlapping documents can't deadlock). Call renew() to extend the leases 
+	of a long critical section, as leaving the lock after they expired raises LeaseExpiredError.
+	Use Session(Lock=LeaseLock) or Session(Lock=LeaseLock.configure(ttl=10,timeout=30))
+	"""
+	# Seconds a lease is valid for
+	ttl = 30
+	
+	# Seconds to wait for all leases before raising LockTimeoutError
+	timeout = 60
+	
+	# Seconds between attempts (doubles on each retry up to max_retry_interval)
+	retry_interval = 0.01
+	max_retry_interval = 0.5
+	
+	# Identifies this process as the lease owner
+	process_id = uuid.uuid4().hex
+	
+	# Leases held per thread (so locks are re-entrant like BasicLock)
+	_held_leases = threading.local()
+	
+	# Contention metrics shared by all lease locks
+	_metrics_lock = threading.Lock()
+	_metrics = {}
+	
+	def __init__(self,document_ids,database=None):
+		
+		if database is None:
+			raise Exception("LeaseLock requires a database to store leases in")
+		
+		self._document_ids = sorted(set(document_ids))
+		self._database = database
+		self._acquired_ids = []
+	
+	# Create a lease lock class with different settings
+	@classmethod
+	def configure(cls,**kwargs):
+		
+		return type(cls.__name__,(cls,),kwargs)
+	
+	# Get the lease document id for a document id
+	@classmethod
+	def getLeaseDocumentId(cls,document_id):
+		
+		return "lease_%s" % (document_id)
+	
+	# Returns the contention metrics e.g. acquisitions, contended acquisitions, total and max wait time, timeouts and expired lease takeovers
+	@classmethod
+	def getMetrics(cls):
+		
+		with LeaseLock._metrics_lock:
 			
-			r = self._database_session.delete("%s/%s?rev=%s" % (self._database_url,document._id,document._rev))
+			metrics = {
+				"acquisitions" : 0,
+				"contended" : 0,
+				"wait_time" : 0.0,
+				"max_wait_time" : 0.0,
+				"timeouts" : 0,
+				"takeovers" : 0
+			}
+			metrics.update(LeaseLock._metrics)
 			
-			if r.status_code != 200:
-				
-				raise Exception(r.json())
+			return metrics
+	
+	@classmethod
+	def resetMetrics(cls):
+		
+		with LeaseLock._metrics_lock:
+			LeaseLock._metrics = {}
+	
+	@classmethod
+	def _recordMetrics(cls,wait_time,contended,timed_out,takeovers):
+		
+		with LeaseLock._metrics_lock:
 			
-		# If this document has linked documents must tidy up to stop orphans
-		if document.__class__.hasLinks():
+			metrics = LeaseLock._metrics
 			
-			# Delete all linkdocuments that reference the deleted document
-			self.deleteAllLinks(document)
+			metrics["acquisitions"] = metrics.get("acquisitions",0) + (0 if timed_out else 1)
+			metrics["contended"] = metrics.get("contended",0) + (1 if contended else 0)
+			metrics["wait_time"] = metrics.get("wait_time",0.0) + wait_time
+			metrics["max_wait_time"] = max(metrics.get("max_wait_time",0.0),wait_time)
+			metrics["timeouts"] = metrics.get("timeouts",0) + (1 if timed_out else 0)
+			metrics["takeovers"] = metrics.get("takeovers",0) + takeovers
 	
-	# Does document id exist
-	def exists(self,_id):
+	# Leases held by the current thread keyed by (database url, document id) -> [lease document, hold count]
+	def _getHeldLeases(self):
 		
-		return [_id] == self.existsMultiple([_id])
+		if not hasattr(LeaseLock._held_leases,"leases"):
+			LeaseLock._held_leases.leases = {}
+		
+		return LeaseLock._held_leases.leases
 	
-	# Bulk doc API used for add/update/delete multiple	
-	def _bulkDocs(self,documents):
+	def __enter__(self):
 		
-		docs_dict = {"docs": [document.instanceToDict() for document in documents]}
+		held_leases = self._getHeldLeases()
 		
-		headers = {"content-type": "application/json"}	
-		data = json.dumps(docs_dict)
+		# Re-entrant so only acquire the leases this thread doesn't already hold
+		pending_ids = []
+		for document_id in self._document_ids:
+			
+			held_key = (self._database.getUrl(),document_id)
+			
+			if held_key in held_leases:
+				held_leases[held_key][1] += 1
+				self._acquired_ids.append(document_id)
+			else:
+				pending_ids.append(document_id)
 		
-		r = self._database_session.post("%s/_bulk_docs" % (self._database_url),headers=headers,data=data)
+		start = time.time()
+		retry_interval = self.retry_interval
+		takeover_revs = {}
+		contended = False
+		takeovers = 0
 		
-		if r.status_code == 201:
-			documents_data = r.json()
+		while len(pending_ids) > 0:
 			
-			# Return saved and failed documents
-			ok_documents = []
-			failed_documents = []
+			now = time.time()
+			lease_documents = []
 			
-			# Create a hash map of id vs new rev (only succeeded updates/inserts will have a rev)
-			id_rev_map = dict([(document_data["id"],document_data["rev"]) for document_data in documents_data if "rev" in document_data])
+			for document_id in pending_ids:
+				
+				lease_document = _LeaseDocument()
+				lease_document._id = self.getLeaseDocumentId(document_id)
+				lease_document._rev = takeover_revs.get(document_id)
+				lease_document.document_id = document_id
+				lease_document.owner = "%s:%s" % (self.process_id,threading.current_thread().ident)
+				lease_document.expires = now + self.ttl
+				lease_documents.append(lease_document)
 			
-			# Update existing objects
-			for document in documents:
+			# Try and create (or take over expired) leases in one request
+			(ok_documents,failed_documents) = self._database._bulkDocs(lease_documents)
+			
+			if len(failed_documents) == 0:
 				
-				# See if succeeded
-				if document._id in id_rev_map:
+				for lease_document in ok_documents:
 					
-					document._rev = id_rev_map[document._id]
-					ok_documents.append(document)
-				
-				# Failed due to conflict
-				else:
-					failed_documents.append(document)
+					if lease_document.document_id in takeover_revs:
+						takeovers += 1
 					
-			return (ok_documents,failed_documents)
+					held_leases[(self._database.getUrl(),lease_document.document_id)] = [lease_document,1]
+					self._acquired_ids.append(lease_document.document_id)
+				
+				break
 			
-		else:
-			raise Exception(r.json())
-	
-	# Add multiple documents
-	def addMultiple(self,documents):
-		return self._bulkDocs(documents)
-	
-	# Update multiple documents
-	def updateMultiple(self,documents):
-		
-		ok_documents = []
-		failed_documents = []
-		
-		class_documents = {}
-		
-		# Must loop and place in dicts based on class
-		for document in documents:
-
-			documents = class_documents.setdefault(document.__class__,[])
-			documents.append(document)
+			# All or nothing, so give back the leases won this round rather than hold them whilst waiting for the rest
+			if len(ok_documents) > 0:
+				
+				for lease_document in ok_documents:
+					lease_document.setMarkedForDelete(True)
+				
+				self._database._bulkDocs(ok_documents)
 			
-		for document_class in class_documents:
+			takeover_revs = {}
+			contended = True
 			
-			# If no links with indexes then can safely bulk update (as no linked documents to remove)
-			if not (issubclass(document.__class__, Document) and document_class.hasLinksWithIndexes()):
+			# Leases past their expiry can be taken over (using their rev so only one process wins)
+			failed_ids = [lease_document.document_id for lease_document in failed_documents]
+			for lease_data in self._database.getMultiple([self.getLeaseDocumentId(document_id) for document_id in failed_ids],as_json=True):
 				
-				(cls_ok_documents,cls_failed_documents) = self._bulkDocs(class_documents[document_class])
-				ok_documents.extend(cls_ok_documents)
-				failed_documents.extend(cls_failed_documents)
+				if lease_data and "_rev" in lease_data and lease_data.get("expires",0) < time.time():
+					takeover_revs[lease_data["document_id"]] = lease_data["_rev"]
+			
+			if time.time() - start >= self.timeout:
 				
-			else:
+				self._release()
+				self._recordMetrics(time.time() - start,contended,True,takeovers)
 				
-				# If links exist then must update one at a time and lock
-				for document in class_documents[document_class]:
-					
-					try:
-						
-						document = self.update(document)
-						ok_documents.append(document)
-						
-					except:
-						
-						failed_documents.append(document)
-						
-		return (ok_documents,failed_documents)
-	
-	# Delete multiple documents
-	def deleteMultiple(self,documents):
+				raise LockTimeoutError("Timed out acquiring leases on %s" % (", ".join(failed_ids)))
+			
+			# Back off with jitter
+			time.sleep(retry_interval * (0.5 + random.random() / 2))
+			retry_interval = min(retry_interval * 2,self.max_retry_interval)
 		
-		ok_documents = []
-		failed_documents = []
+		self._recordMetrics(time.time() - start,contended,False,takeovers)
 		
-		class_documents = {}
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
 		
-		# Must loop and place in dicts based on class
-		for document in documents:
-			
-			# First mark for delete
-			document.setMarkedForDelete(True)
-			
-			documents = class_documents.setdefault(document.__class__,[])
-			documents.append(document)
-			
-		for document_class in class_documents:
-			
-			# If no links then can safely bulk delete (as no linked documents to remove)
-			if not document_class.hasLinks():
-				
-				(cls_ok_documents,cls_failed_documents) = self._bulkDocs(class_documents[document_class])
-				ok_documents.extend(cls_ok_documents)
-				failed_documents.extend(cls_failed_documents)
-				
-			else:
-				
-				# If links exist then must delete one at a time and lock
-				for document in class_documents[document_class]:
-					
-					try:
-						
-						self.delete(document)
-						ok_documents.append(document)
-						
-					except:
-						
-						failed_documents.append(document)
-						
-		return (ok_documents,failed_documents)
-
-	# Check for existence of multiple document ids (don't want to support documents as would then have to inflate first to check existance)
-	def existsMultiple(self,_ids):
-		headers = {"content-type": "application/json"}	
+		held_leases = self._getHeldLeases()
+		now = time.time()
 		
-		data = json.dumps({"keys":_ids})
+		expired_ids = [document_id for document_id in self._acquired_ids if held_leases[(self._database.getUrl(),document_id)][0].expires < now]
 		
-		r = self._database_session.post("%s/_all_docs" % (self._database_url), headers=headers,data=data)
+		self._release()
 		
-		if r.status_code == 200:
-			
-			_ids_that_exist = []
-			for row in r.json()["rows"]:
-				if not ("deleted" in row or "error" in row):
-					_ids_that_exist.append(row["id"])
-					
-			return _ids_that_exist
+		# Another process may have taken over the leases, so the critical section wasn't exclusive
+		if len(expired_ids) > 0 and exc_type is None:
+			raise LeaseExpiredError("Leases on %s expired before they were released" % (", ".join(expired_ids)))
 		
-		else:
-			raise Exception(r.json())
+		# Will raise any exception
+		return False
+	
+	# Extend this lock's leases by the ttl, raises LeaseExpiredError if any have been taken over by another process
+	def renew(self):
 		
-	# Tries to inflate a dict of data into a Document
-	def _createDocument(self,document_data):
+		held_leases = self._getHeldLeases()
+		now = time.time()
 		
-		# Is this a schema bound document
-		if "type_" in document_data and document_data["type_"] in BaseDocument.type_class_map:
+		lease_documents = []
+		for document_id in self._acquired_ids:
 			
-			document_class = BaseDocument.type_class_map[document_data["type_"]]
-			
-			# Now check is the current version (or if missing means is a schema design doc)
-			if "schema_version_" not in document_data or ("schema_version_" in document_data and document_data["schema_version_"] == document_class.getCurrentSchemaVersion()):
-				
-				# Valid document so inflate
-				return document_class(document_data=document_data)
+			lease_document = held_leases[(self._database.getUrl(),document_id)][0]
+			lease_document.expires = now + self.ttl
+			lease_documents.append(lease_document)
 		
-		# Could bind to existing schema so return as unbound document
-		return 	UnboundDocument(document_data)
+		if len(lease_documents) > 0:
 			
+			(ok_documents,failed_documents) = self._database._bulkDocs(lease_documents)
+			
+			if len(failed_documents) > 0:
+				raise LeaseExpiredError("Leases on %s were taken over before they were renewed" % (", ".join([lease_document.document_id for lease_document in failed_documents])))
 	
-	# Pass a json response from a view query and inflates documents
-	def _processViewResponse(self,documents_data,as_json=False,**kwargs):
+	# Release this lock's leases (deleting those no longer held by the thread)
+	def _release(self):
 		
-		documents = []
+		held_leases = self._getHeldLeases()
+		lease_documents = []
 		
-		for row in documents_data["rows"]:
+		for document_id in self._acquired_ids:
 			
-			if as_json and "doc" in row:
-				
-				documents.append(row["doc"])
-				
-			elif "doc" in row:
-				
-				documents.append(self._createDocument(row["doc"]))
+			held_key = (self._database.getUrl(),document_id)
+			held_leases[held_key][1] -= 1
 			
-			else:
+			if held_leases[held_key][1] == 0:
 				
-				documents.append(row)
-				
-		return documents
-	
-	# Get multiple documents
-	def getMultiple(self,_ids):
+				lease_document = held_leases.pop(held_key)[0]
+				lease_document.setMarkedForDelete(True)
+				lease_documents.append(lease_document)
 		
-		headers = {"content-type": "application/json"}	
-		data = json.dumps({"keys":_ids})
+		self._acquired_ids = []
 		
-		r = self._database_session.post("%s/_all_docs?include_docs=true" % (self._database_url), headers=headers,data=data)
+		# A conflict means the lease expired and was taken over, so there's nothing to release
+		if len(lease_documents) > 0:
+			self._database._bulkDocs(lease_documents)
+
+
+class DesignDocumentDeployment(BackgroundTask):
+	"""
+	A background blue/green deployment of a design document started by Database.sync(staged=True)
+	"""
+	def __init__(self,database,design_document,staging_document_id,staging_rev,document_class=None):
 		
-		if r.status_code == 200:
-			
-			return self._processViewResponse(r.json())
+		super(DesignDocumentDeployment,self).__init__(database._swapDesignDocument,design_document,staging_document_id,staging_rev,document_class)
 		
-		else:
-			raise Exception(r.json())
+		self._design_document = design_document
+	
+	# Get the design document being deployed
+	def getDesignDocument(self):
+		
+		return self._design_document
 
+
+class MetricsRegistry(object):
+	"""
+	An in-process registry of counters and latency histograms, which can be dumped as a dict or Prometheus text
+	"""
+	default_buckets = (0.001,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
 	
-	# Add links to documents
-	def addLinks(self,link_property,to_documents):
+	def __init__(self,buckets=None):
 		
-		# The created link documents
-		link_documents = []
+		self._buckets = tuple(buckets) if buckets else MetricsRegistry.default_buckets
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._histograms = {}
+	
+	# Labels are stored as a sorted tuple so they can be used as a key
+	def _labelsKey(self,labels):
 		
-		# Get the from doc and property itself
-		(from_document,link_property) = link_property
+		return tuple(sorted(labels.items())) if labels else ()
 	
-		# See if need to add from doc
-		if not from_document.hasBeenAdded():
-			from_document = self.add(from_document)
+	def incrementCounter(self,name,value=1,labels=None):
+		
+		key = (name,self._labelsKey(labels))
+		
+		with self._lock:
+			self._counters[key] = self._counters.get(key,0) + value
+	
+	def observe(self,name,value,labels=None):
+		
+		key = (name,self._labelsKey(labels))
+		
+		with self._lock:
 			
-		# Create new link document per to document
-		for to_document in to_documents:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				histogram = self._histograms[key] = {"buckets" : [0] * len(self._buckets), "sum" : 0.0, "count" : 0}
 			
-			documents_to_add = []
-			document_ids_to_lock = [from_document._id]
+			for (bucket_index,bucket) in enumerate(self._buckets):
+				if value <= bucket:
+					histogram["buckets"][bucket_index] += 1
+					break
 			
-			# See if need add to doc or lock if already exists
-			if not to_document.hasBeenAdded():
-				documents_to_add.append(to_document)
-			else:
-				document_ids_to_lock.append(to_document._id)
+			histogram["sum"] += value
+			histogram["count"] += 1
+	
+	def getCounter(self,name,labels=None):
 		
-			with self._Lock(document_ids_to_lock):
-				
-				# Check documents exist still (as now locked)
-				if document_ids_to_lock == self.existsMultiple(document_ids_to_lock):
-				
-					# Check not already linked (only add if not linked already)
-					existing_links = self.getLinks((from_document,link_property), to_document._id)		
-					if len(existing_links) == 0:
-						
-						# Now create link documents
-						link_document = _LinkDocument()
-						link_document.name = link_property.getName()
-						link_document.reverse_name = link_property.getReverse()
-						link_document.from_id = from_document._id
-						link_document.from_type = from_document.type_
-						link_document.to_id = to_document._id
-						link_document.to_type = to_document.type_
-
-						# Add indexes if present
-						for index_property_path in link_property.getIndexPropertyPaths():
-
-							(property_exists,property_value) = to_document.getPropertyValueByPath(index_property_path)
-							if property_exists:
-								link_document.indexes[index_property_path] = property_value
-
-						# Add reverse indexes if present
-						for reverse_index_property_path in link_property.getReverseIndexPropertyPaths():
-
-							(property_exists,property_value) = from_document.getPropertyValueByPath(reverse_index_property_path)
-							if property_exists:
-								link_document.reverse_indexes[reverse_index_property_path] = property_value
-							
-						# Add documents to database
-						documents_to_add.append(link_document)
-						
-						# Add to database
-						link_documents.extend(self.addMultiple(documents_to_add))
+		return self._counters.get((name,self._labelsKey(labels)),0)
+	
+	def getHistogram(self,name,labels=None):
+		
+		histogram = self._histograms.get((name,self._labelsKey(labels)))
 		
-		return link_documents
+		return self._histogramToDict(histogram) if histogram else None
 	
-	# Add linked document
-	def addLink(self,link_property,to_document):
+	def reset(self):
 		
-		return self.addLinks(link_property, [to_document])
+		with self._lock:
+			self._counters = {}
+			self._histograms = {}
 	
-	# Get linked documents
-	def getLinks(self,link_property,start_key=None,limit=None,as_json=False):
+	# Buckets are cumulative (as in Prometheus)
+	def _histogramToDict(self,histogram):
 		
-		# Get the from doc and property itself
-		(from_document,link_property) = link_property
+		buckets = {}
+		cumulative_count = 0
 		
-		start_key = [from_document._id,link_property.getName(),start_key] if start_key else [from_document._id,link_property.getName()]
-		end_key = [from_document._id,link_property.getName(),{}]
+		for (bucket_index,bucket) in enumerate(self._buckets):
+			cumulative_count += histogram["buckets"][bucket_index]
+			buckets[bucket] = cumulative_count
 		
-		params = {
-			"include_docs" : True,
-			"startkey" : json.dumps(start_key),
-			"endkey" : json.dumps(end_key)
+		return {
+			"buckets" : buckets,
+			"sum" : histogram["sum"],
+			"count" : histogram["count"]
 		}
 	
-		if limit:
-			params["limit"] = limit
+	def toDict(self):
+		
+		metrics = {"counters" : {}, "histograms" : {}}
+		
+		with self._lock:
+			
+			for ((name,labels),value) in self._counters.items():
+				metrics["counters"].setdefault(name,[]).append({"labels" : dict(labels), "value" : value})
 			
-		r = self._database_session.get("%s/_design/_linkdocument/_view/links_by_name" % (self._database_url), params = params)
+			for ((name,labels),histogram) in self._histograms.items():
+				histogram_data = self._histogramToDict(histogram)
+				histogram_data["labels"] = dict(labels)
+				metrics["histograms"].setdefault(name,[]).append(histogram_data)
 		
-		if r.status_code == 200:
+		return metrics
+	
+	def toPrometheus(self):
 		
-			return self._processViewResponse(r.json(),as_json)
+		def format_labels(labels,extra_labels=()):
+			
+			labels = list(labels) + list(extra_labels)
+			if len(labels) == 0:
+				return ""
+			
+			return "{%s}" % ",".join(['%s="%s"' % (label,str(value).replace("\\","\\\\").replace('"','\\"')) for (label,value) in labels])
 		
-		else:
+		lines = []
+		
+		with self._lock:
+			
+			for name in sorted(set([name for (name,labels) in self._counters])):
+				lines.append("# TYPE %s counter" % (name))
+				for ((counter_name,labels),value) in sorted(self._counters.items()):
+					if counter_name == name:
+						lines.append("%s%s %s" % (name,format_labels(labels),value))
+			
+			for name in sorted(set([name for (name,labels) in self._histograms])):
+				lines.append("# TYPE %s histogram" % (name))
+				for ((histogram_name,labels),histogram) in sorted(self._histograms.items()):
+					if histogram_name == name:
+						histogram_data = self._histogramToDict(histogram)
+						for bucket in self._buckets:
+							lines.append("%s_bucket%s %d" % (name,format_labels(labels,[("le",bucket)]),histogram_data["buckets"][bucket]))
+						lines.append("%s_bucket%s %d" % (name,format_labels(labels,[("le","+Inf")]),histogram["count"]))
+						lines.append("%s_sum%s %s" % (name,format_labels(labels),histogram["sum"]))
+						lines.append("%s_count%s %d" % (name,format_labels(labels),histogram["count"]))
 		
-			raise Exception(r.json())
+		return "\n".join(lines) + "\n"
 
-	# Get the linked documents using index
-	def getLinksByIndex(self,link_property,index_property_path,index_property_value,start_key=None,limit=None,as_json=False):
 
-		# Get the from doc and property itself
-		(from_document,link_property) = link_property
-		
-		start_key = [from_document._id,link_property.getName(),index_property_path,index_property_value,start_key] if start_key else [from_document._id,link_property.getName(),index_property_path,index_property_value]
-		end_key = [from_document._id,link_property.getName(),index_property_path,index_property_value,{}]
+class Span(object):
+	"""
+	A timed operation within a trace e.g. a Database method or one of the HTTP requests it makes. Use as a context manager.
+	"""
+	def __init__(self,tracer,name,parent=None,attributes=None):
+		
+		self._tracer = tracer
+		
+		self.name = name
+		self.parent = parent
+		self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+		self.span_id = uuid.uuid4().hex[:16]
+		self.attributes = dict(attributes) if attributes else {}
+		self.children = []
+		self.start_time = None
+		self.end_time = None
+		self.error = None
+	
+	def __enter__(self):
 		
-		params = {
-			"include_docs" : True,
-			"startkey" : json.dumps(start_key),
-			"endkey" : json.dumps(end_key)
-		}
+		self._tracer._startSpan(self)
+		return self
 	
-		if limit:
-			params["limit"] = limit
-			
-		r = self._database_session.get("%s/_design/_linkdocument/_view/links_by_indexes" % (self._database_url), params = params)
+	def __exit__(self, exc_type, exc_val, exc_tb):
 		
-		if r.status_code == 200:
-
-			return self._processViewResponse(r.json(),as_json)
+		if exc_type is not None:
+			self.error = repr(exc_val)
 		
-		else:
+		self._tracer._endSpan(self)
 		
-			raise Exception(r.json())
+		# Will raise any exception
+		return False
 	
-	# Delete a linked document
-	def deleteLink(self,link_property,to_document):
+	def setAttribute(self,name,value):
 		
-		self.deleteLinks(link_property,[to_document])
+		self.attributes[name] = value
 	
-	# Delete many linked documents
-	def deleteLinks(self,link_property,to_documents):
+	# Seconds the span took (or has taken so far)
+	def getDuration(self):
 		
-		# Get the from doc and property itself
-		(from_document,link_property) = link_property
+		return (self.end_time if self.end_time is not None else time.time()) - self.start_time
+	
+	# Iterate over this span and all its descendants
+	def iterSpans(self):
 		
-		# Lock the affected documents
-		document_ids_to_lock = [from_document._id]
+		yield self
 		
-		# Build the keys
-		_ids = []
-		for to_document in to_documents:
-			_ids.append([from_document._id,link_property.getName(),to_document._id])
-			document_ids_to_lock.append(to_document._id)
-			
-		headers = {"content-type": "application/json"}
+		for child in self.children:
+			for span in child.iterSpans():
+				yield span
+	
+	def toDict(self):
 		
-		params = {
-			"include_docs" : True
+		return {
+			"name" : self.name,
+			"trace_id" : self.trace_id,
+			"span_id" : self.span_id,
+			"parent_id" : self.parent.span_id if self.parent else None,
+			"start_time" : self.start_time,
+			"duration" : self.getDuration(),
+			"attributes" : self.attributes,
+			"error" : self.error,
+			"children" : [child.toDict() for child in self.children]
 		}
-			
-		data = {"keys":_ids}
-		
-		# Fetch the link docs
-		r = self._database_session.post("%s/_design/_linkdocument/_view/by_name" % (self._database_url), headers=headers, params=params, data=json.dumps(data))
 
-		if r.status_code == 200:
 
-			# Turn into docs (TODO just need id so add a deleteMultipleByIds) 
-			documents_to_delete = self._processViewResponse(r.json(),False)
-			
-			# Lock on the id's to stop links being added whilst delete is happening
-			with self._Lock(document_ids_to_lock):
-			
-				# Finally delete the documents
-				return self.deleteMultiple(documents_to_delete)
-		
-		else:
-		
-			raise Exception(r.json())	
+class _NullSpan(object):
+	"""
+	Stands in for a Span when tracing is off
+	"""
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		return False
+	
+	def setAttribute(self,name,value):
+		pass
 
-	# For a given document this returns all the linked documents
-	def deleteAllLinks(self,from_document):
+_NULL_SPAN = _NullSpan()
+
+
+class InMemorySpanExporter(object):
+	"""
+	Keeps finished spans in memory e.g. for tests or to inspect from a debug endpoint
+	"""
+	def __init__(self,max_spans=10000):
 		
-		headers = {"content-type": "application/json"}
+		self._max_spans = max_spans
+		self._lock = threading.Lock()
+		self._spans = []
+	
+	def export(self,span):
 		
-		params = {
-			"include_docs" : True
+		with self._lock:
+			self._spans.append(span)
 			
-		}
+			if len(self._spans) > self._max_spans:
+				del self._spans[:len(self._spans) - self._max_spans]
+	
+	# Get finished spans (optionally only those with a name)
+	def getSpans(self,name=None):
+		
+		with self._lock:
+			return [span for span in self._spans if name is None or span.name == name]
+	
+	# Get finished top level spans
+	def getRootSpans(self):
+		
+		return [span for span in self.getSpans() if span.parent is None]
+	
+	def clear(self):
+		
+		with self._lock:
+			self._spans = []
 
-		data = {"key" : from_document._id}
 
-		# Fetch the link docs
-		r = self._database_session.post("%s/_design/_linkdocument/_view/by_id" % (self._database_url), headers=headers, params=params,  data=json.dumps(data))
+class Tracer(object):
+	"""
+	Creates nested spans for Database methods and the HTTP requests they make, passing finished spans to an exporter 
+	(any object with an export(span) method) and logging top level operations slower than slow_threshold seconds
+	"""
+	def __init__(self,exporter=None,slow_threshold=None,logger=None):
+		
+		self._exporter = exporter
+		self._slow_threshold = slow_threshold
+		self._logger = logger if logger else logging.getLogger("ormchair")
+		self._local = threading.local()
+	
+	def _getSpanStack(self):
+		
+		if not hasattr(self._local,"spans"):
+			self._local.spans = []
+		
+		return self._local.spans
+	
+	# Get the innermost open span on this thread
+	def getCurrentSpan(self):
+		
+		spans = self._getSpanStack()
+		
+		return spans[-1] if spans else None
+	
+	# Create a span that's a child of the current span (use as a context manager)
+	def startSpan(self,name,attributes=None):
+		
+		return Span(self,name,parent=self.getCurrentSpan(),attributes=attributes)
+	
+	def _startSpan(self,span):
+		
+		span.start_time = time.time()
+		
+		if span.parent is not None:
+			span.parent.children.append(span)
+		
+		self._getSpanStack().append(span)
+	
+	def _endSpan(self,span):
+		
+		span.end_time = time.time()
+		
+		spans = self._getSpanStack()
+		if spans and spans[-1] is span:
+			spans.pop()
+		
+		if self._exporter is not None:
+			self._exporter.export(span)
+		
+		if span.parent is None and self._slow_threshold is not None and span.getDuration() >= self._slow_threshold:
+			self._logSlowSpan(span)
+	
+	# Logs the slow operation with a breakdown of its HTTP requests
+	def _logSlowSpan(self,span):
+		
+		request_counts = {}
+		for child_span in span.iterSpans():
+			if "endpoint" in child_span.attributes:
+				request_key = "%s %s" % (child_span.attributes["method"],child_span.attributes["endpoint"])
+				request_counts[request_key] = request_counts.get(request_key,0) + 1
+		
+		self._logger.warning("Slow operation %s took %.3fs with %d HTTP requests (%s)",
+			span.name,
+			span.getDuration(),
+			sum(request_counts.values()),
+			", ".join(["%d x %s" % (count,request_key) for (request_key,count) in sorted(request_counts.items())])
+		)
 
-		if r.status_code == 200:
 
-			# Turn into docs (TODO just need id so add a deleteMultipleByIds) 
-			documents_to_delete = self._processViewResponse(r.json(),False)
-			
-			# Lock on the id's to stop links being added whilst delete is happening
-			with self._Lock([from_document._id]):
-			
-				# Finally delete the documents
-				return self.deleteMultiple(documents_to_delete)
+class _ProfilePhase(object):
+	"""
+	Times one phase of a Database call for a Profiler (time spent in nested phases only counts against those phases)
+	"""
+	def __init__(self,profiler,name):
 		
-		else:
+		self._profiler = profiler
+		self._name = name
 		
-			raise Exception(r.json())
-
-	# For a given document that has links, update the indexes on the LinkDocuments to reflect document values
-	def _updateLinkIndexes(self,document):
+		# Totals of the nested phases
+		self._child_wall = 0
+		self._child_cpu = 0
+		self._child_allocations = 0
+	
+	def __enter__(self):
 		
-		headers = {"content-type": "application/json"}
+		self._profiler._phases.append(self)
 		
-		params = {
-			"include_docs" : True
-		}
+		self._start_wall = time.time()
+		self._start_cpu = time.clock()
+		self._start_allocations = gc.get_count()[0]
+		
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		
+		wall = time.time() - self._start_wall
+		cpu = time.clock() - self._start_cpu
+		allocations = gc.get_count()[0] - self._start_allocations
+		
+		phases = self._profiler._phases
+		phases.pop()
+		
+		if phases:
+			phases[-1]._child_wall += wall
+			phases[-1]._child_cpu += cpu
+			phases[-1]._child_allocations += allocations
+		
+		operations = _getOperationStack()
+		self._profiler._recordPhase(operations[0] if operations else None,self._name,wall - self._child_wall,cpu - self._child_cpu,allocations - self._child_allocations)
+		
+		# Will raise any exception
+		return False
 
-		data = {"key" : document._id}
 
-		# Fetch the link docs
-		r = self._database_session.post("%s/_design/_linkdocument/_view/by_id" % (self._database_url), headers=headers, params=params,  data=json.dumps(data))
+# Number of active profilers tracking allocations, the garbage collector is process wide so it's paused while any are and restored 
+# when the last exits
+_allocation_profiling = {"count" : 0, "gc_was_enabled" : False}
+_allocation_profiling_lock = threading.Lock()
 
-		if r.status_code == 200:
+class Profiler(object):
+	"""
+	Attributes the wall time, cpu time and allocations of Database calls made on the current thread to the serialize, http, parse, process 
+	and inflate phases. Use via ormchair.profile(). Allocations are the net number of gc tracked objects created by the whole process 
+	(gc doesn't count per thread), so they are best-effort and include other threads' allocations. The garbage collector is paused whilst 
+	any profiler with track_allocations set is active.
+	"""
+	phases = ["serialize","http","parse","process","inflate","other"]
+	
+	def __init__(self,track_allocations=True):
+		
+		self._track_allocations = track_allocations
+		
+		self._stats = {}
+		self._phases = []
+		self._previous_profiler = None
+	
+	def __enter__(self):
+		
+		self._previous_profiler = getattr(_operation_context,"profiler",None)
+		_operation_context.profiler = self
+		
+		if self._track_allocations:
+			with _allocation_profiling_lock:
+				
+				if _allocation_profiling["count"] == 0:
+					_allocation_profiling["gc_was_enabled"] = gc.isenabled()
+					gc.disable()
+				
+				_allocation_profiling["count"] += 1
+		
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		
+		_operation_context.profiler = self._previous_profiler
+		
+		if self._track_allocations:
+			with _allocation_profiling_lock:
+				
+				_allocation_profiling["count"] -= 1
+				
+				if _allocation_profiling["count"] == 0 and _allocation_profiling["gc_was_enabled"]:
+					gc.enable()
+		
+		return False
+	
+	def _getOperationStats(self,operation):
+		
+		if operation not in self._stats:
+			self._stats[operation] = {"calls" : 0, "wall" : 0, "phases" : {}}
+		
+		return self._stats[operation]
+	
+	def _recordCall(self,operation,wall):
+		
+		operation_stats = self._getOperationStats(operation)
+		operation_stats["calls"] += 1
+		operation_stats["wall"] += wall
+	
+	def _recordPhase(self,operation,phase,wall,cpu,allocations):
+		
+		phase_stats = self._getOperationStats(operation)["phases"].setdefault(phase,{"count" : 0, "wall" : 0, "cpu" : 0, "allocations" : 0})
+		phase_stats["count"] += 1
+		phase_stats["wall"] += wall
+		phase_stats["cpu"] += cpu
+		phase_stats["allocations"] += allocations if self._track_allocations else 0
+	
+	# Get the totals per top level Database method and phase, with "other" being the call time not spent in a phase (e.g. locks, link bookkeeping)
+	def getStats(self):
+		
+		stats = {}
+		
+		for (operation,operation_stats) in self._stats.iteritems():
 			
-			# Turn into docs
-			link_documents = self._processViewResponse(r.json(),False)
+			phases = copy.deepcopy(operation_stats["phases"])
 			
-			# Updates index dict values
-			def update_index_dict(document,index_dict):
-
-				updated = False
-
-				for index_property_path in index_dict:
+			if operation_stats["calls"]:
+				phases["other"] = {
+					"count" : operation_stats["calls"],
+					"wall" : max(operation_stats["wall"] - sum([phase_stats["wall"] for phase_stats in phases.values()]),0),
+					"cpu" : None,
+					"allocations" : None
+				}
+			
+			stats[operation] = {"calls" : operation_stats["calls"], "wall" : operation_stats["wall"], "phases" : phases}
+		
+		return stats
+	
+	# Get the stats as a text table
+	def getReport(self):
+		
+		# Allocations are counted across the process
+		lines = ["%-22s %-10s %8s %12s %12s %12s %8s" % ("operation","phase","count","wall (ms)","cpu (ms)","proc allocs","% wall")]
+		
+		stats = self.getStats()
+		
+		for operation in sorted(stats.keys()):
+			
+			operation_stats = stats[operation]
+			total_wall = operation_stats["wall"] or sum([phase_stats["wall"] for phase_stats in operation_stats["phases"].values()])
+			
+			for phase in Profiler.phases:
+				
+				if phase in operation_stats["phases"]:
 					
-					# Get the correct property value
-					(property_exists,property_value) = document.getPropertyValueByPath(index_property_path)
+					phase_stats = operation_stats["phases"][phase]
+					lines.append("%-22s %-10s %8d %12.2f %12s %12s %7.1f%%" % (
+						operation or "-",
+						phase,
+						phase_stats["count"],
+						phase_stats["wall"] * 1000,
+						"%.2f" % (phase_stats["cpu"] * 1000) if phase_stats["cpu"] is not None else "-",
+						phase_stats["allocations"] if phase_stats["allocations"] is not None and self._track_allocations else "-",
+						100.0 * phase_stats["wall"] / total_wall if total_wall else 0
+					))
+		
+		return "\n".join(lines)
+
+
+# Profile the Database calls made on this thread e.g. with ormchair.profile() as profiler: ... print profiler.getReport()
+def profile(track_allocations=True):
+	
+	return Profiler(track_allocations=track_allocations)
 
-					if property_exists:
 
-						# See if value is different to index
-						if index_dict[index_property_path] != property_value:
-							updated = True 
-							index_dict[index_property_path] = property_value
-				
-					else:
-					
-						# If can't find the property then delete the index as schema must have changed
-						del index_dict[index_property_path]
+# Time a phase if this thread is being profiled
+def _profilePhase(name):
+	
+	profiler = getattr(_operation_context,"profiler",None)
+	
+	if profiler is not None:
+		return _ProfilePhase(profiler,name)
+	
+	return _NULL_SPAN
 
-				return updated
 
-			# Loop over link documents update indexes
-			link_documents_to_update = []
-			
-			for link_document in link_documents:
-				
-				if link_document.to_id == document._id:
-					
-					# Normal index
-					if update_index_dict(document,link_document.indexes):
-						
-						link_documents_to_update.append(link_document)
+# The Database methods currently running on this thread (outermost first)
+_operation_context = threading.local()
 
-				elif link_document.from_id == document._id:
-					
-					# Reverse index
-					if update_index_dict(document,link_document.reverse_indexes):
-						
-						link_documents_to_update.append(link_document)
+def _getOperationStack():
+	
+	if not hasattr(_operation_context,"operations"):
+		_operation_context.operations = []
+	
+	return _operation_context.operations
 
-			# If any documents need updating do
-			if len(link_documents_to_update) > 0:
-				
-				self.updateMultiple(link_documents_to_update)
 
-		else:
+def _instrumented(database_method):
+	"""
+	Decorator for public Database methods that records their latency and attributes the HTTP requests they make to them
+	"""
+	@functools.wraps(database_method)
+	def wrapper(self,*args,**kwargs):
+		
+		operations = _getOperationStack()
+		operations.append(database_method.__name__)
+		
+		start = time.time()
+		status = "error"
+		
+		try:
+			
+			with _startSpan(self._database_session,"Database.%s" % (database_method.__name__),{"database" : self._database_url}):
+				result = database_method(self,*args,**kwargs)
+			
+			status = "ok"
+			return result
 		
-			raise Exception(r.json())
+		finally:
+			operations.pop()
+			
+			if isinstance(self._database_session,_HTTPSession):
+				self._database_session.recordOperation(database_method.__name__,time.time() - start,status)
+			
+			profiler = getattr(_operation_context,"profiler",None)
+			if profiler is not None and not operations:
+				profiler._recordCall(database_method.__name__,time.time() - start)
+	
+	return wrapper
 
-	# Loops over document classes and creates their schema's and if changed updates schema version and design docs for indexes
-	def sync(self):
+
+# Decorator for functions run on other threads so their requests are attributed to the current operation and span
+def _inCurrentContext(database_session):
+	
+	operations = list(_getOperationStack())
+	tracer = database_session.tracer if isinstance(database_session,_HTTPSession) else None
+	parent_span = tracer.getCurrentSpan() if tracer is not None else None
+	
+	def decorator(function):
 		
-		# Loop each document class
-		for document_class_name in BaseDocument.type_class_map:
+		def wrapper(*args,**kwargs):
 			
-			document_class = BaseDocument.type_class_map[document_class_name]
+			_operation_context.operations = list(operations)
 			
-			# Don't sync design documents and system documents (seperate process for them)
-			if not issubclass(document_class, DesignDocument) and document_class not in [BaseDocument,Document]:
-				
-				saved_schema_design_document = None
-				
-				try:
-					
-					# Try and get
-					saved_schema_design_document = self.get(document_class.getSchemaDesignDocumentId(),as_json=True)
-					
-					# Got this far so must compare to see if it needs updating
-					current_schema_design_document = document_class.getSchemaDesignDocument()
-					
-					# Set the _rev and version properties so like for like comparison
-					current_schema_design_document._rev = saved_schema_design_document["_rev"]
-					current_schema_design_document.version = saved_schema_design_document["version"]
-					
-					update = False
-					
-					# Compare saved schema to see if need to update version
-					if current_schema_design_document.schema != saved_schema_design_document["schema"]:
-						current_schema_design_document.version = saved_schema_design_document["version"] + 1
-						update = True
-						
-					# See if more views/indexes have been added (e.g. not affecting the schema version)
-					elif json.dumps(current_schema_design_document.instanceToDict()) != json.dumps(saved_schema_design_document):
-						update = True
-					
-					if update:
-						saved_schema_design_document = self.update(current_schema_design_document)
-					else:
-						saved_schema_design_document = current_schema_design_document
+			if parent_span is not None:
+				tracer._getSpanStack().append(parent_span)
+			
+			return function(*args,**kwargs)
+		
+		return wrapper
 	
-				# Add
-				except Exception as e:
-					
-					saved_schema_design_document = self.add(document_class.getSchemaDesignDocument())
-					
-				# Set the schema version for document class
-				document_class.setCurrentSchemaVersion(saved_schema_design_document.version)
-				
-			# Check design documents and see if they have fixed id's...if so check for changes and sync if needed
-			elif issubclass(document_class, DesignDocument) and document_class.hasFixedId():
-				
-				current_design_document = document_class()
-				
-				try:
-					
-					saved_design_document = self.get(current_design_document._id)
-					current_design_document._rev = saved_design_document._rev
+	return decorator
+
+
+# Start a span if the session is being traced
+def _startSpan(database_session,name,attributes=None):
 	
-					# Compare with saved (also check for unknown properties e.g. things in the doc that aren't in the schema)
-					if json.dumps(current_design_document.instanceToDict()) != json.dumps(saved_design_document.instanceToDict()) > 0:
-						
-						saved_design_document = self.update(current_design_document)
-				
-				except ValidationError:
-					
-					# Ok doc exists but couldn't create class so just grab document (TODO this is inefficient but only happens when syncing meh)
-					saved_design_document_json = self.get(current_design_document._id,as_json=True)
-					current_design_document._rev = saved_design_document_json["_rev"]
-					saved_design_document = self.update(current_design_document)
-					
-				except Exception:
-					
-					# Doc doesn't exist so first sync so just add
-					saved_design_document = self.add(current_design_document)
-				
+	if isinstance(database_session,_HTTPSession) and database_session.tracer is not None:
+		return database_session.tracer.startSpan(name,attributes)
 	
-	# Gets the documents by view. Passed in either a view property of Document class or design_document_id and document class
-	def getByView(self,view_property=None,view_name=None,design_document_id=None,**kwargs):
+	return _NULL_SPAN
+
+
+# Classifies a request url into an endpoint e.g. doc, _bulk_docs, view:_design/name/view_name or _all_docs
+def _getEndpoint(url):
+	
+	segments = [segment for segment in urlparse.urlparse(url).path.split("/") if segment != ""]
+	
+	if len(segments) == 0:
+		return "server"
+	elif len(segments) == 1:
+		return segments[0] if segments[0].startswith("_") else "database"
+	
+	# Partition scoped requests are classified as their global equivalent
+	if segments[1] == "_partition" and len(segments) > 2:
+		segments[1:3] = []
+		
+		if len(segments) == 1:
+			return "_partition"
+	
+	# Design document ids contain a slash
+	if segments[1] in ["_design","_local"] and len(segments) > 2:
+		segments[1:3] = ["%s/%s" % (segments[1],segments[2])]
+	
+	if len(segments) >= 4 and segments[2] == "_view":
+		return "view:%s/%s" % (segments[1],segments[3])
+	elif len(segments) >= 3 and segments[2] == "_info":
+		return "_info"
+	elif len(segments) >= 3:
+		return "attachment"
+	elif segments[1].startswith("_") and not segments[1].startswith("_design/"):
+		return segments[1]
+	
+	return "doc"
+
+
+# The database name of a request url
+def _getDatabaseName(url):
+	
+	segments = [segment for segment in urlparse.urlparse(url).path.split("/") if segment != ""]
+	
+	return urllib.unquote(segments[0]) if segments else None
+
+
+class JSONCodec(object):
+	"""
+	Encodes request bodies and decodes response bodies using the standard library json module. Subclasses use faster libraries.
+	"""
+	name = "json"
+	
+	# Do floats survive a round trip (only lossless codecs are picked by "auto")
+	lossless = True
+	
+	# Is the library installed
+	@classmethod
+	def isAvailable(cls):
+		
+		return True
+	
+	def dumps(self,data):
+		
+		return json.dumps(data)
+	
+	# Decode a response body (bytes)
+	def loads(self,content):
+		
+		return json.loads(content)
+
+
+class SimpleJSONCodec(JSONCodec):
+	"""
+	Uses simplejson (fast when its C speedups are built)
+	"""
+	name = "simplejson"
+	
+	@classmethod
+	def isAvailable(cls):
+		
+		return simplejson is not None
+	
+	def dumps(self,data):
+		
+		return simplejson.dumps(data)
+	
+	def loads(self,content):
+		
+		return simplejson.loads(content)
+
+
+class UJSONCodec(JSONCodec):
+	"""
+	Uses ujson. Note floats are encoded with at most 15 significant digits (json uses 17, and ujson releases supporting python 2
+	can't encode more) so it is only used when asked for by name.
+	"""
+	name = "ujson"
+	lossless = False
+	
+	@classmethod
+	def isAvailable(cls):
+		
+		return ujson is not None
+	
+	def dumps(self,data):
+		
+		return ujson.dumps(data,double_precision=15)
+	
+	def loads(self,content):
+		
+		return ujson.loads(content)
+
+
+# Fastest first
+_json_codec_classes = [UJSONCodec,SimpleJSONCodec,JSONCodec]
+
+def getJSONCodec(name="auto"):
+	"""
+	Args:
+		name (str): "json", "simplejson", "ujson" or "auto" for the fastest installed that doesn't lose float precision
+	
+	Returns:
+		JSONCodec: The codec
+	"""
+	for json_codec_class in _json_codec_classes:
+		
+		if name == "auto" and json_codec_class.lossless and json_codec_class.isAvailable():
+			return json_codec_class()
+		
+		elif name == json_codec_class.name:
+			
+			if not json_codec_class.isAvailable():
+				raise Exception("JSON codec %s is not installed" % (name))
+			
+			return json_codec_class()
+	
+	raise Exception("Unknown JSON codec %s" % (name))
+
+
+class Compression(object):
+	"""
+	Gzip settings for a Session. Request bodies of at least threshold bytes sent to the listed endpoints (prefixes of the endpoint names 
+	used in request events e.g. "view" for any view) are gzipped, and gzipped responses are asked for.
+	"""
+	def __init__(self,level=6,threshold=1024,endpoints=("_bulk_docs","_all_docs","view","_find"),accept_gzip=True):
+		"""
+		Kwargs:
+			level (int): The gzip compression level, 1 (fastest) to 9 (smallest)
+			threshold (int): The minimum request body size in bytes to compress
+			endpoints (tuple): Endpoint name prefixes whose request bodies are compressed
+			accept_gzip (bool): Send Accept-Encoding: gzip so the server (or a proxy) can compress responses
+		"""
+		self.level = level
+		self.threshold = threshold
+		self.endpoints = tuple(endpoints)
+		self.accept_gzip = accept_gzip
+	
+	def shouldCompress(self,method,endpoint,data):
+		
+		return method in ["POST","PUT"] and isinstance(data,basestring) and len(data) >= self.threshold and endpoint.startswith(self.endpoints)
+	
+	def compress(self,data):
+		
+		compressor = zlib.compressobj(self.level,zlib.DEFLATED,16 + zlib.MAX_WBITS)
+		
+		return compressor.compress(data) + compressor.flush()
+	
+	def compressRequest(self,method,endpoint,kwargs):
+		"""
+		Returns:
+			tuple: The request kwargs (with the body compressed if it should be) and a dict of the uncompressed and compressed sizes and 
+			cpu seconds taken, or None if not compressed
+		"""
+		data = kwargs.get("data")
+		
+		if not self.shouldCompress(method,endpoint,data):
+			return (kwargs,None)
+		
+		if isinstance(data,unicode):
+			data = data.encode("utf-8")
+		
+		start_cpu = time.clock()
+		compressed_data = self.compress(data)
+		cpu_seconds = time.clock() - start_cpu
+		
+		kwargs = dict(kwargs)
+		kwargs["data"] = compressed_data
+		kwargs["headers"] = dict(kwargs.get("headers") or {})
+		kwargs["headers"]["Content-Encoding"] = "gzip"
+		
+		return (kwargs,{"uncompressed_bytes" : len(data), "compressed_bytes" : len(compressed_data), "cpu_seconds" : cpu_seconds})
+
+
+class NodeUnavailableError(requests.ConnectionError):
+	"""
+	Used when none of a NodePool's nodes can be reached
+	"""
+	def __init__(self, message):
+		requests.ConnectionError.__init__(self, message)
+
+
+class _Node(object):
+	"""
+	A couchdb node of a NodePool
+	"""
+	def __init__(self,url):
+		
+		self.url = url.rstrip("/")
+		self.outstanding = 0
+		self.healthy = True
+		self.checking = False
+		self.consecutive_failures = 0
+		self.ejections = 0
+		self.retry_at = None
+		self.requests = 0
+		self.failures = 0
+
+
+class NodePool(object):
+	"""
+	The nodes of a couchdb cluster. Reads are spread across the healthy nodes by least outstanding requests and writes go to the primary
+	(or the next healthy node if it's ejected). A node that fails max_failures requests in a row (connection errors or 5xx responses) is
+	ejected, then health checked before being used again after a backoff that doubles with each failed check.
+	"""
+	def __init__(self,urls,primary=0,max_failures=1,backoff=1.0,max_backoff=60.0,health_check_timeout=2.0):
+		"""
+		Args:
+			urls (list): The node urls e.g. ["http://node1:5984","http://node2:5984"]
+		
+		Kwargs:
+			primary (int or str): Index or url of the node writes go to
+			max_failures (int): Consecutive failures before a node is ejected
+			backoff (float): Seconds before an ejected node is first health checked
+			max_backoff (float): Maximum seconds between health checks
+			health_check_timeout (float): Seconds to wait for a health check response
+		"""
+		if isinstance(urls,basestring):
+			urls = [urls]
+		
+		if len(urls) == 0:
+			raise ValueError("At least one node url is required")
+		
+		self._nodes = [_Node(url) for url in urls]
+		
+		if isinstance(primary,basestring):
+			primary = [node.url for node in self._nodes].index(primary.rstrip("/"))
+		
+		self._primary = primary
+		self._max_failures = max_failures
+		self._backoff = backoff
+		self._max_backoff = max_backoff
+		self._health_check_timeout = health_check_timeout
+		
+		self._lock = threading.Lock()
+		self._counter = 0
+	
+	# The url requests are built against (the primary's), they're rewritten to the chosen node
+	def getUrl(self):
+		
+		return self._nodes[self._primary].url
+	
+	def getNodes(self):
+		
+		return list(self._nodes)
+	
+	# Returns the node a url is built against if it's one of the pool's
+	def owns(self,url):
+		
+		return url.startswith(self.getUrl() + "/")
+	
+	# Rewrite a url to another node
+	def rewriteUrl(self,url,node):
+		
+		return node.url + url[len(self.getUrl()):]
+	
+	def _isAvailable(self,node,now):
+		
+		return node.healthy or (not node.checking and node.retry_at <= now)
+	
+	# Choose a node for a request and count it as outstanding, the least loaded healthy node for reads or the primary for writes
+	def acquire(self,read,exclude=()):
+		"""
+		Args:
+			read (bool): Is the request a read
+		
+		Kwargs:
+			exclude (list): Nodes already tried
+		
+		Returns:
+			_Node: The node, or None if none are left to try
+		"""
+		while True:
+			
+			now = time.time()
+			
+			with self._lock:
+				
+				nodes = [node for node in self._nodes if node not in exclude]
+				
+				if len(nodes) == 0:
+					return None
+				
+				available = [node for node in nodes if self._isAvailable(node,now)]
+				
+				# Nothing healthy so try whichever is due to be checked first
+				if len(available) == 0:
+					available = [min(nodes,key=lambda node: node.retry_at)]
+				
+				if read:
+					
+					# Ties are taken in turn
+					least_outstanding = min([node.outstanding for node in available])
+					candidates = [node for node in available if node.outstanding == least_outstanding]
+					node = candidates[self._counter % len(candidates)]
+					self._counter += 1
+					
+				else:
+					
+					# The primary or the next node after it
+					node = min(available,key=lambda node: (self._nodes.index(node) - self._primary) % len(self._nodes))
+				
+				if node.healthy:
+					node.outstanding += 1
+					node.requests += 1
+					return node
+				
+				node.checking = True
+			
+			# Ejected node due a health check
+			if self.checkHealth(node):
+				continue
+			
+			exclude = list(exclude) + [node]
+	
+	# Record the outcome of a request to a node
+	def release(self,node,ok):
+		
+		with self._lock:
+			
+			node.outstanding -= 1
+			
+			if ok:
+				node.consecutive_failures = 0
+				return False
+			
+			node.failures += 1
+			node.consecutive_failures += 1
+			
+			if node.healthy and node.consecutive_failures >= self._max_failures:
+				self._eject(node)
+				return True
+			
+			return False
+	
+	# Eject a node e.g. one that can't be reached
+	def eject(self,node):
+		
+		with self._lock:
+			if node.healthy:
+				self._eject(node)
+	
+	def _eject(self,node):
+		
+		node.healthy = False
+		node.ejections += 1
+		node.retry_at = time.time() + min(self._backoff * 2 ** (node.ejections - 1),self._max_backoff)
+	
+	# Health check a node (a GET of the server root), restoring it if it responds
+	def checkHealth(self,node):
+		
+		try:
+			healthy = requests.get(node.url + "/",timeout=self._health_check_timeout).status_code == 200
+		except requests.RequestException:
+			healthy = False
+		
+		with self._lock:
+			
+			node.checking = False
+			
+			if healthy:
+				node.healthy = True
+				node.consecutive_failures = 0
+				node.ejections = 0
+				node.retry_at = None
+			else:
+				self._eject(node)
+		
+		return healthy
+	
+	# Returns a dict per node of its url, health and request counts
+	def getStats(self):
+		
+		with self._lock:
+			return [{
+				"url" : node.url,
+				"primary" : index == self._primary,
+				"healthy" : node.healthy,
+				"outstanding" : node.outstanding,
+				"requests" : node.requests,
+				"failures" : node.failures,
+				"ejections" : node.ejections
+			} for (index,node) in enumerate(self._nodes)]
+
+
+class Hedging(object):
+	"""
+	Hedged reads for a Database on a multi-node Session. A read that hasn't been answered within a percentile of recent read latencies
+	is sent to a second node and the first successful response is used (the other is discarded when it arrives, an in-flight request
+	can't be aborted). Each read earns budget hedges (up to max_tokens) and each hedge spends one, capping the extra load.
+	"""
+	def __init__(self,percentile=95,min_delay=0.001,max_delay=1.0,budget=0.05,max_tokens=10,window=1000,min_samples=20):
+		"""
+		Kwargs:
+			percentile (float): Percentile of recent read latencies to wait for before hedging
+			min_delay (float): Minimum seconds to wait before hedging
+			max_delay (float): Maximum seconds to wait (also used until there are min_samples latencies)
+			budget (float): Hedges allowed per read e.g. 0.05 is at most 5% extra reads
+			max_tokens (float): Maximum hedges that can be saved up for a burst
+			window (int): Number of recent read latencies kept
+			min_samples (int): Latencies needed before the percentile is used
+		"""
+		self._percentile = percentile
+		self._min_delay = min_delay
+		self._max_delay = max_delay
+		self._budget = budget
+		self._max_tokens = max_tokens
+		self._window = window
+		self._min_samples = min_samples
+		
+		self._lock = threading.Lock()
+		self._latencies = collections.deque(maxlen=window)
+		self._delay = None
+		self._tokens = 0.0
+		
+		self._reads = 0
+		self._hedges = 0
+		self._wins = 0
+		self._skipped = 0
+	
+	# Seconds to wait before hedging
+	def getDelay(self):
+		
+		with self._lock:
+			
+			if self._delay is None:
+				
+				if len(self._latencies) < self._min_samples:
+					self._delay = self._max_delay
+				else:
+					latencies = sorted(self._latencies)
+					self._delay = min(max(latencies[min(int(len(latencies) * self._percentile / 100.0),len(latencies) - 1)],self._min_delay),self._max_delay)
+			
+			return self._delay
+	
+	# Record the latency of a request to a node
+	def recordLatency(self,latency):
+		
+		with self._lock:
+			
+			self._latencies.append(latency)
+			
+			# Recalculated at most every tenth of a window
+			if len(self._latencies) < self._min_samples or len(self._latencies) % max(self._window / 10,1) == 0:
+				self._delay = None
+	
+	# Count a read, adding to the budget
+	def recordRead(self):
+		
+		with self._lock:
+			self._reads += 1
+			self._tokens = min(self._tokens + self._budget,self._max_tokens)
+	
+	# Spend a token on a hedge if there's budget
+	def acquireHedge(self):
+		
+		with self._lock:
+			
+			if self._tokens < 1:
+				self._skipped += 1
+				return False
+			
+			self._tokens -= 1
+			self._hedges += 1
+			return True
+	
+	def recordWin(self):
+		
+		with self._lock:
+			self._wins += 1
+	
+	# Returns the reads, hedges, hedges won and skipped (over budget), the hedge rate and current delay
+	def getStats(self):
+		
+		delay = self.getDelay()
+		
+		with self._lock:
+			return {
+				"reads" : self._reads,
+				"hedges" : self._hedges,
+				"wins" : self._wins,
+				"skipped" : self._skipped,
+				"hedge_rate" : float(self._hedges) / self._reads if self._reads else 0.0,
+				"delay" : delay
+			}
+
+
+# Reads can go to any node
+def _isReadRequest(method,endpoint):
+	
+	return method in ["GET","HEAD"] or (method == "POST" and (endpoint in ["_all_docs","_find"] or endpoint.startswith("view:")))
+
+
+class _HTTPSession(requests.Session):
+	"""
+	The requests session used by Session and Database, which fires request hooks and records metrics for every HTTP call
+	"""
+	def __init__(self,metrics=None,tracer=None,json_codec=None,compression=None,node_pool=None):
+		
+		super(_HTTPSession,self).__init__()
+		
+		self.metrics = metrics
+		self.node_pool = node_pool
+		self.tracer = tracer
+		self.json_codec = json_codec if json_codec is not None else JSONCodec()
+		self.compression = compression
+		self.request_hooks = []
+		
+		if compression is not None and compression.accept_gzip:
+			self.headers["Accept-Encoding"] = "gzip"
+	
+	# Encode a request body
+	def encode(self,data):
+		
+		return self.json_codec.dumps(data)
+	
+	# Decode a response body straight from its bytes
+	def decode(self,response):
+		
+		with _profilePhase("parse"):
+			return self.json_codec.loads(response.content)
+	
+	def request(self,method,url,route=True,hedging=None,**kwargs):
+		
+		if route and self.node_pool is not None and self.node_pool.owns(url):
+			
+			if hedging is not None and len(self.node_pool.getNodes()) > 1 and _isReadRequest(method,_getEndpoint(url)):
+				return self._requestHedged(method,url,kwargs,hedging)
+			
+			return self._requestNode(method,url,kwargs)
+		
+		operations = _getOperationStack()
+		
+		event = {
+			"stage" : "start",
+			"method" : method,
+			"url" : url,
+			"endpoint" : _getEndpoint(url),
+			"operation" : operations[-1] if operations else None,
+			"root_operation" : operations[0] if operations else None
+		}
+		
+		self._fireRequestHooks(event)
+		
+		start = time.time()
+		response = None
+		
+		# Gzip large bodies
+		request_compression = None
+		if self.compression is not None:
+			(kwargs,request_compression) = self.compression.compressRequest(method,event["endpoint"],kwargs)
+		
+		with _startSpan(self,"HTTP %s" % (method),{"method" : method, "url" : url, "endpoint" : event["endpoint"]}) as span:
+			
+			try:
+				with _profilePhase("http"):
+					response = super(_HTTPSession,self).request(method,url,**kwargs)
+				
+				return response
+			finally:
+				event = dict(event)
+				event["stage"] = "end"
+				event["latency"] = time.time() - start
+				event["status"] = response.status_code if response is not None else None
+				event["bytes_sent"] = int(response.request.headers.get("Content-Length",0)) if response is not None else 0
+				event["bytes_received"] = self._getBytesReceived(response,kwargs.get("stream",False))
+				event["request_compression"] = request_compression
+				event["response_compression"] = self._getResponseCompression(response,kwargs.get("stream",False))
+				
+				span.setAttribute("status",event["status"])
+				span.setAttribute("bytes_sent",event["bytes_sent"])
+				span.setAttribute("bytes_received",event["bytes_received"])
+				
+				self._recordRequest(event)
+				self._fireRequestHooks(event)
+	
+	# Send a request to a node of the pool, failing reads over to the other nodes on connection errors and 5xx responses
+	def _requestNode(self,method,url,kwargs):
+		
+		read = _isReadRequest(method,_getEndpoint(url))
+		tried = []
+		response = None
+		
+		while True:
+			
+			node = self.node_pool.acquire(read,exclude=tried)
+			
+			# The rest failed health checks
+			if node is None:
+				
+				if response is not None:
+					return response
+				
+				raise NodeUnavailableError("No couchdb nodes are available for %s %s" % (method,url))
+			
+			tried.append(node)
+			
+			last_attempt = not read or len(tried) == len(self.node_pool.getNodes())
+			
+			try:
+				response = self.request(method,self.node_pool.rewriteUrl(url,node),route=False,**kwargs)
+			except requests.RequestException:
+				self._releaseNode(node,False)
+				
+				if last_attempt:
+					raise
+			except:
+				self._releaseNode(node,True)
+				raise
+			else:
+				ok = response.status_code < 500
+				self._releaseNode(node,ok)
+				
+				if ok or last_attempt:
+					return response
+			
+			if self.metrics is not None:
+				self.metrics.incrementCounter("ormchair_node_failovers_total",labels={"node" : node.url})
+	
+	# Send a read to a node, then to a second node if it's slower than the hedging delay, returning the first successful response
+	def _requestHedged(self,method,url,kwargs,hedging):
+		
+		hedging.recordRead()
+		
+		results = Queue.Queue()
+		tried = []
+		pending = 0
+		hedged = False
+		result = None
+		labels = {"database" : _getDatabaseName(url)}
+		
+		# Attempts run on their own threads, attributed to the calling operation and span
+		@_inCurrentContext(self)
+		def attempt(node):
+			
+			start = time.time()
+			response = None
+			error = None
+			
+			try:
+				response = self.request(method,self.node_pool.rewriteUrl(url,node),route=False,**kwargs)
+			except Exception as e:
+				error = e
+			
+			ok = response is not None and response.status_code < 500
+			self._releaseNode(node,ok)
+			
+			if ok:
+				hedging.recordLatency(time.time() - start)
+			
+			results.put((node,response,error,ok))
+		
+		def start(node):
+			
+			tried.append(node)
+			
+			thread = threading.Thread(target=attempt,args=(node,))
+			thread.daemon = True
+			thread.start()
+		
+		with _profilePhase("http"):
+			
+			while True:
+				
+				if pending == 0:
+					
+					# First attempt or failing over
+					node = self.node_pool.acquire(True,exclude=tried)
+					
+					if node is None:
+						break
+					
+					if tried and self.metrics is not None:
+						self.metrics.incrementCounter("ormchair_node_failovers_total",labels={"node" : tried[-1].url})
+					
+					start(node)
+					pending += 1
+				
+				try:
+					result = results.get(timeout=None if hedged else hedging.getDelay())
+				except Queue.Empty:
+					
+					# Too slow so hedge
+					hedged = True
+					node = self.node_pool.acquire(True,exclude=tried) if hedging.acquireHedge() else None
+					
+					if node is not None:
+						start(node)
+						pending += 1
+						
+						if self.metrics is not None:
+							self.metrics.incrementCounter("ormchair_hedges_total",labels=labels)
+					
+					elif self.metrics is not None:
+						self.metrics.incrementCounter("ormchair_hedges_skipped_total",labels=labels)
+					
+					continue
+				
+				pending -= 1
+				
+				if result[3]:
+					break
+		
+		if self.metrics is not None:
+			self.metrics.incrementCounter("ormchair_hedged_reads_total",labels=labels)
+		
+		if result is None:
+			raise NodeUnavailableError("No couchdb nodes are available for %s %s" % (method,url))
+		
+		(node,response,error,ok) = result
+		
+		# Answered by the hedge
+		if ok and hedged and node is not tried[0]:
+			
+			hedging.recordWin()
+			
+			if self.metrics is not None:
+				self.metrics.incrementCounter("ormchair_hedge_wins_total",labels=labels)
+		
+		if error is not None:
+			raise error
+		
+		return response
+	
+	def _releaseNode(self,node,ok):
+		
+		if self.node_pool.release(node,ok) and self.metrics is not None:
+			self.metrics.incrementCounter("ormchair_node_ejections_total",labels={"node" : node.url})
+	
+	# Streamed bodies aren't read so can only use the content length
+	def _getBytesReceived(self,response,stream):
+		
+		if response is None:
+			return 0
+		elif "Content-Length" in response.headers:
+			return int(response.headers["Content-Length"])
+		elif not stream:
+			return len(response.content)
+		
+		return 0
+	
+	# Sizes of a gzipped response (requests decompresses it when the content is read)
+	def _getResponseCompression(self,response,stream):
+		
+		if response is None or stream or response.headers.get("Content-Encoding") != "gzip" or "Content-Length" not in response.headers:
+			return None
+		
+		return {"uncompressed_bytes" : len(response.content), "compressed_bytes" : int(response.headers["Content-Length"])}
+	
+	def _fireRequestHooks(self,event):
+		
+		for request_hook in self.request_hooks:
+			request_hook(event)
+	
+	def _recordRequest(self,event):
+		
+		if self.metrics is None:
+			return
+		
+		self.metrics.incrementCounter("ormchair_http_requests_total",labels={"method" : event["method"], "endpoint" : event["endpoint"], "status" : event["status"]})
+		self.metrics.observe("ormchair_http_request_seconds",event["latency"],labels={"method" : event["method"], "endpoint" : event["endpoint"]})
+		self.metrics.incrementCounter("ormchair_http_sent_bytes_total",event["bytes_sent"],labels={"endpoint" : event["endpoint"]})
+		self.metrics.incrementCounter("ormchair_http_received_bytes_total",event["bytes_received"],labels={"endpoint" : event["endpoint"]})
+		
+		if event["root_operation"]:
+			self.metrics.incrementCounter("ormchair_operation_http_requests_total",labels={"operation" : event["root_operation"]})
+		
+		# The compression ratio is compressed / uncompressed bytes
+		for direction in ["request","response"]:
+			
+			compression = event.get("%s_compression" % (direction))
+			
+			if compression:
+				
+				self.metrics.incrementCounter("ormchair_http_uncompressed_bytes_total",compression["uncompressed_bytes"],labels={"endpoint" : event["endpoint"], "direction" : direction})
+				self.metrics.incrementCounter("ormchair_http_compressed_bytes_total",compression["compressed_bytes"],labels={"endpoint" : event["endpoint"], "direction" : direction})
+				
+				if "cpu_seconds" in compression:
+					self.metrics.observe("ormchair_http_compression_cpu_seconds",compression["cpu_seconds"],labels={"endpoint" : event["endpoint"]})
+	
+	def recordOperation(self,operation,latency,status):
+		
+		if self.metrics is None:
+			return
+		
+		self.metrics.incrementCounter("ormchair_database_calls_total",labels={"method" : operation, "status" : status})
+		self.metrics.observe("ormchair_database_call_seconds",latency,labels={"method" : operation})
+
+
+class Session(object):
+	"""
+	A couchdb server session
+	"""
+	def __init__(self,url,username=None,password=None,Lock=BasicLock,metrics=None,tracer=None,json_codec=None,compression=None):
+		"""
+		Args:
+			url (str, list or NodePool): The couchdb server url, or the node urls (or NodePool) of a cluster to spread reads across
+		
+		Kwargs:
+			metrics (MetricsRegistry): Registry to record request and Database method metrics in (one is created if not passed)
+			tracer (Tracer): Traces Database methods and their HTTP requests as nested spans
+			json_codec (JSONCodec or str): Codec (or codec name, see getJSONCodec) for request and response bodies, defaults to json
+			compression (Compression or bool): Gzip settings for large bulk, keys and view request bodies (True uses the defaults)
+		"""
+		
+		# Several nodes
+		node_pool = None
+		if isinstance(url,(list,tuple)):
+			node_pool = NodePool(url)
+		elif isinstance(url,NodePool):
+			node_pool = url
+		
+		# Url of the couchdb server
+		self._url = node_pool.getUrl() if node_pool is not None else url
+		
+		# The lock class
+		self._Lock = Lock
+		
+		# Create a session to deal with subsequent requests
+		if isinstance(json_codec,basestring):
+			json_codec = getJSONCodec(json_codec)
+		
+		if compression is True:
+			compression = Compression()
+		
+		self._database_session = _HTTPSession(metrics if metrics is not None else MetricsRegistry(),tracer,json_codec,compression or None,node_pool)
+		
+		# If username and password passed in then try and login
+		if username and password:
+			
+			if node_pool is None:
+				self._login(self._url,username,password)
+			else:
+				self._loginNodes(node_pool,username,password)
+	
+	# Login with basic auth first, this issues a cookie which is then used for each subsequent call
+	def _login(self,url,username,password):
+		
+		r = self._database_session.post("%s/_session" % (url), data={"name": username,"password": password}, auth=(username, password), route=False)
+		
+		if r.status_code != 200:
+			
+			raise Exception(self._database_session.decode(r))
+	
+	# Login to each node (for its cookie), ejecting those that can't be reached
+	def _loginNodes(self,node_pool,username,password):
+		
+		logged_in = False
+		
+		for node in node_pool.getNodes():
+			
+			try:
+				self._login(node.url,username,password)
+				logged_in = True
+			except requests.RequestException:
+				node_pool.eject(node)
+		
+		if not logged_in:
+			raise Exception("No nodes could be reached")
+	
+	# Get the node pool (None if bound to a single server)
+	def getNodePool(self):
+		
+		return self._database_session.node_pool
+		
+	# Add a callback that's passed an event dict at the start and end of every HTTP request
+	def addRequestHook(self,request_hook):
+		
+		self._database_session.request_hooks.append(request_hook)
+	
+	def removeRequestHook(self,request_hook):
+		
+		self._database_session.request_hooks.remove(request_hook)
+	
+	# Get the metrics registry
+	def getMetrics(self):
+		
+		return self._database_session.metrics
+	
+	# Set the tracer (None turns tracing off)
+	def setTracer(self,tracer):
+		
+		self._database_session.tracer = tracer
+	
+	def getTracer(self):
+		
+		return self._database_session.tracer
+	
+	def createDatabase(self,database_name,partitioned=False,**kwargs):
+		"""
+		Kwargs:
+			partitioned (bool): Create a partitioned database (couchdb 3.0+), its documents must be of classes with a @partitionKey
+		"""
+		
+		# TODO check the database name is valid
+		database_url = "%s/%s/" % (self._url, database_name)
+		r = self._database_session.put(database_url, params={"partitioned" : "true"} if partitioned else None)
+		
+		if r.status_code == 201:
+			return Database(database_url,self._database_session, self._Lock, partitioned=partitioned, **kwargs)
+		else:
+			raise Exception(self._database_session.decode(r))
+		
+	def getDatabase(self,database_name,**kwargs):
+		
+		database_url = "%s/%s/" % (self._url, database_name)
+		r = self._database_session.get(database_url)
+		
+		if r.status_code == 200:
+			return Database(database_url, self._database_session, self._Lock, info=self._database_session.decode(r), **kwargs)
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	def databaseExists(self,database_name):
+		
+		database_url = "%s/_all_dbs" % (self._url)
+		r = self._database_session.get(database_url)
+		
+		if r.status_code == 200:
+			return True if database_name in self._database_session.decode(r) else False
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	def deleteDatabase(self,database_name):
+		
+		database_url = "%s/%s/" % (self._url, database_name)
+		r = self._database_session.delete(database_url)
+		
+		if r.status_code != 200:
+			raise Exception(self._database_session.decode(r))
+
+
+class _AttachmentStream(object):
+	"""
+	A file like request body that reads an attachment in chunks from a str, bytearray, memoryview, mmap or file object (a file on
+	disk or a seekable one like StringIO), so uploads don't copy the whole payload into memory
+	"""
+	def __init__(self,source,length=None):
+		
+		if isinstance(source,unicode):
+			source = source.encode("utf-8")
+		
+		# Slices of a memoryview don't copy
+		if isinstance(source,(str,bytearray,buffer)):
+			source = memoryview(source)
+		
+		self._source = source
+		self._position = 0
+		
+		if length is None:
+			length = self._getRemainingLength(source)
+		
+		self._length = length
+	
+	# Length from the current position of the source
+	@staticmethod
+	def _getRemainingLength(source):
+		
+		if isinstance(source,memoryview):
+			return source.nbytes if hasattr(source,"nbytes") else len(source) * source.itemsize
+		elif isinstance(source,mmap.mmap):
+			return len(source) - source.tell()
+		
+		# Files on disk (in memory files like io.BytesIO raise UnsupportedOperation, an IOError and ValueError)
+		try:
+			return os.fstat(source.fileno()).st_size - source.tell()
+		except (AttributeError,IOError,OSError,ValueError):
+			pass
+		
+		# Seekable files without a fileno e.g. StringIO
+		if hasattr(source,"seek") and hasattr(source,"tell"):
+			
+			position = source.tell()
+			source.seek(0,os.SEEK_END)
+			length = source.tell() - position
+			source.seek(position)
+			
+			return length
+		
+		raise Exception("Can't determine the length of the %s attachment, pass length" % (type(source).__name__))
+	
+	def __len__(self):
+		
+		return self._length
+	
+	def read(self,size=-1):
+		
+		remaining = self._length - self._position
+		if size is None or size < 0 or size > remaining:
+			size = remaining
+		
+		if isinstance(self._source,memoryview):
+			chunk = self._source[self._position:self._position + size]
+		else:
+			chunk = self._source.read(size)
+		
+		self._position += len(chunk)
+		
+		return chunk
+
+
+class Database(object):
+	"""
+	Represents a couchdb database
+	"""
+	def __init__(self,database_url,database_session, Lock, info = None, stale=None, use_update_param=False, index_backend="view", hedging=None, partitioned=None, migrate_on_read=False, write_back=None):
+		"""
+		Kwargs:
+			stale (str): Default read mode for view queries, "ok" answers from the existing index and "update_after" also refreshes it after answering
+			use_update_param (bool): Send the update/stable params (couchdb 2.1+) instead of the deprecated stale param
+			index_backend (str): How Index properties are built and queried, "view" (javascript map function) or "mango" (couchdb 2.0+ _index/_find)
+			hedging (Hedging or bool): Hedge get, getMultiple, view, link and find reads across the Session's nodes (True uses the defaults), 
+				each Database needs its own as the budget and latencies are per database
+			partitioned (bool): Is this a partitioned database (defaults to the props in info)
+			migrate_on_read (bool): Upgrade documents saved with older schema versions as they are read using the registered migrations, 
+				rather than returning them as UnboundDocuments
+			write_back (MigrationWriteBack or bool): Write the documents upgraded on read back in batches in the background (True uses 
+				the defaults), each Database needs its own
+		"""
+		self._database_url = database_url
+		self._database_session = database_session
+		self._Lock = Lock
+		self._info = info
+		self._use_update_param = use_update_param
+		self._hedging = Hedging() if hedging is True else (hedging or None)
+		self._partitioned = partitioned if partitioned is not None else bool(((info or {}).get("props") or {}).get("partitioned"))
+		self._migrate_on_read = migrate_on_read
+		self._write_back = MigrationWriteBack() if write_back is True else (write_back or None)
+		
+		# (id, schema version) of documents that failed to migrate on read, so each failure is only warned about once
+		self._migration_failures = collections.OrderedDict()
+		self.setStale(stale)
+		
+		if self._write_back is not None:
+			self._write_back.setDatabase(self)
+		
+		if index_backend not in ["view","mango"]:
+			raise Exception("Unknown index backend %s" % (index_backend))
+		
+		self._index_backend = index_backend
+		
+	def getUrl(self):
+		return self._database_url
+	
+	# Get the hedging settings and stats (None if reads aren't hedged)
+	def getHedging(self):
+		
+		return self._hedging
+	
+	# Get how Index properties are built and queried
+	def getIndexBackend(self):
+		return self._index_backend
+	
+	def isPartitioned(self):
+		return self._partitioned
+	
+	# Get the write back of documents upgraded on read (None if they aren't written back)
+	def getWriteBack(self):
+		
+		return self._write_back
+	
+	# Writes any documents upgraded on read that are waiting to be written back and stops the write back
+	def close(self):
+		
+		if self._write_back is not None:
+			self._write_back.close()
+	
+	# Open a loader scope e.g. with database.loader(): ... in which embedded links that aren't inflated are loaded in batches when read
+	def loader(self,chunk_size=500):
+		"""
+		Kwargs:
+			chunk_size (int): Maximum ids fetched per request
+		
+		Returns:
+			EmbeddedLinkLoader: The loader scope
+		"""
+		return EmbeddedLinkLoader(self,chunk_size=chunk_size)
+	
+	# Returns the url partition scoped requests are made under (the database url if partition is None)
+	def _getPartitionUrl(self,partition=None):
+		
+		if partition is None:
+			return self._database_url
+		
+		return "%s_partition/%s/" % (self._database_url,urllib.quote(unicode(partition).encode("utf-8"),safe=""))
+	
+	# Creates a lock on document ids using the session's lock class
+	def _lock(self,document_ids):
+		
+		if isinstance(document_ids,basestring):
+			document_ids = [document_ids]
+		
+		return self._Lock(document_ids,database=self)
+	
+	# Set the default read mode for view queries
+	def setStale(self,stale):
+		
+		if stale not in Database._stale_params:
+			raise Exception("Unknown stale option %s" % (stale))
+		
+		self._stale = stale
+	
+	# Get the default read mode for view queries
+	def getStale(self):
+		
+		return self._stale
+	
+	# Map of stale option to (stale params, update params)
+	_stale_params = {
+		None : ({},{}),
+		False : ({},{}),
+		"ok" : ({"stale" : "ok"},{"update" : "false", "stable" : "true"}),
+		"update_after" : ({"stale" : "update_after"},{"update" : "lazy", "stable" : "true"})
+	}
+	
+	# Returns the view query params for a per call stale option (None uses the database default, False forces an up to date index)
+	def _getStaleParams(self,stale=None):
+		
+		if stale is None:
+			stale = self._stale
+		
+		if stale not in Database._stale_params:
+			raise Exception("Unknown stale option %s" % (stale))
+		
+		(stale_params,update_params) = Database._stale_params[stale]
+		
+		return dict(update_params if self._use_update_param else stale_params)
+	
+	# Add single document
+	@_instrumented
+	def add(self,document):
+		
+		document.setPartitionedId()
+		
+		with _profilePhase("serialize"):
+			data = self._database_session.encode(document.instanceToDict())
+		
+		r = self._database_session.put("%s/%s" % (self._database_url,document._id),data=data)
+		
+		if r.status_code == 201:
+			document._rev = self._database_session.decode(r)["rev"]
+			document.setSaved(self)
+		else:
+			raise Exception(self._database_session.decode(r))
+		
+		return document
+	
+	# Updates a document
+	@_instrumented
+	def update(self,document):
+		
+		# Lock the document whilst updating
+		with self._lock(document._id):
+			
+			with _profilePhase("serialize"):
+				data = self._database_session.encode(document.instanceToDict())
+			
+			r = self._database_session.put("%s/%s" % (self._database_url,document._id),data=data)
+			
+			if r.status_code == 201:
+				document._rev = self._database_session.decode(r)["rev"]
+				document.setSaved(self)
+			else:
+				raise Exception(self._database_session.decode(r))
+			
+			# If this document has linked documents with indexes must update
+			if issubclass(document.__class__, Document) and document.__class__.hasLinksWithIndexes():
+				
+				self._updateLinkIndexes(document)
+
+			return document
+	
+	# Get single document
+	@_instrumented
+	def get(self,_id,rev=None,as_json=False,include=None):
+		
+		params = {}
+		if rev:
+			params = {"rev" : rev}
+		
+		r = self._database_session.get("%s/%s" % (self._database_url,_id), params = params, hedging = self._hedging)
+		
+		if r.status_code == 200:
+			document_data = self._database_session.decode(r)
+			
+			# See if just need to return json
+			if as_json:
+				return document_data
+			else:
+				return self._include([self._createDocument(document_data)],include)[0]
+	
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	# Get that returns rather than raises its error (for gets that try several databases)
+	def _getOrError(self,_id,rev=None,as_json=False):
+		
+		try:
+			return self.get(_id,rev=rev,as_json=as_json)
+		except Exception as e:
+			return e
+	
+	# Deletes a single document
+	@_instrumented
+	def delete(self,document):
+		
+		# Lock the document whilst deleting
+		with self._lock(document._id):
+			
+			r = self._database_session.delete("%s/%s?rev=%s" % (self._database_url,document._id,document._rev))
+			
+			if r.status_code != 200:
+				
+				raise Exception(self._database_session.decode(r))
+			
+		# If this document has linked documents must tidy up to stop orphans
+		if document.__class__.hasLinks():
+			
+			# Delete all linkdocuments that reference the deleted document
+			self.deleteAllLinks(document)
+	
+	# Upload an attachment to a document (adding the document first if it hasn't been), streaming data from a str, memoryview, mmap or file object
+	@_instrumented
+	def putAttachment(self,document,name,data,content_type="application/octet-stream",length=None):
+		"""
+		Args:
+			document (BaseDocument): The document to attach to, its _rev is updated
+			name (str): The attachment name
+			data (str, memoryview, mmap or file): The content, read from the current position of files
+		
+		Kwargs:
+			content_type (str): The attachment mime type
+			length (int): Number of bytes to send (needed for file objects that can't seek e.g. sockets)
+		"""
+		if not document.hasBeenAdded():
+			self.add(document)
+		
+		body = _AttachmentStream(data,length)
+		
+		with self._lock(document._id):
+			
+			r = self._database_session.put(
+				"%s/%s/%s" % (self._database_url,document._id,urllib.quote(name,safe="")),
+				params={"rev" : document._rev},
+				headers={"Content-Type" : content_type},
+				data=body
+			)
+			
+			if r.status_code in [201,202]:
+				document._rev = self._database_session.decode(r)["rev"]
+				document.setAttachmentStub(name,{"content_type" : content_type, "length" : len(body), "stub" : True})
+			else:
+				raise Exception(self._database_session.decode(r))
+		
+		return document
+	
+	# Download an attachment, writing it to sink in chunks if passed (returns the bytes written) otherwise returning its content
+	@_instrumented
+	def getAttachment(self,document,name,sink=None,chunk_size=65536):
+		
+		chunks = self.iterAttachment(document,name,chunk_size)
+		
+		if sink is None:
+			return "".join(chunks)
+		
+		length = 0
+		for chunk in chunks:
+			sink.write(chunk)
+			length += len(chunk)
+		
+		return length
+	
+	# Returns an iterator over the chunks of an attachment (the connection is held until it's exhausted)
+	@_instrumented
+	def iterAttachment(self,document,name,chunk_size=65536):
+		
+		# Accept a document or id
+		_id = document._id if isinstance(document,BaseDocument) else document
+		
+		r = self._database_session.get("%s/%s/%s" % (self._database_url,_id,urllib.quote(name,safe="")),stream=True)
+		
+		if r.status_code != 200:
+			raise Exception(self._database_session.decode(r))
+		
+		def chunks():
+			try:
+				for chunk in r.iter_content(chunk_size):
+					yield chunk
+			finally:
+				r.close()
+		
+		return chunks()
+	
+	# Removes an attachment from a document
+	@_instrumented
+	def deleteAttachment(self,document,name):
+		
+		with self._lock(document._id):
+			
+			r = self._database_session.delete("%s/%s/%s" % (self._database_url,document._id,urllib.quote(name,safe="")),params={"rev" : document._rev})
+			
+			if r.status_code in [200,202]:
+				document._rev = self._database_session.decode(r)["rev"]
+				document.removeAttachmentStub(name)
+			else:
+				raise Exception(self._database_session.decode(r))
+		
+		return document
+	
+	# Does document id exist
+	@_instrumented
+	def exists(self,_id):
+		
+		return [_id] == self.existsMultiple([_id])
+	
+	# Bulk doc API used for add/update/delete multiple (conflicts of documents in ignore_conflict_ids count as success e.g. for deterministic 
+	# ids that already exist)
+	def _bulkDocs(self,documents,ignore_conflict_ids=None):
+		
+		for document in documents:
+			document.setPartitionedId()
+		
+		with _profilePhase("serialize"):
+			data = self._database_session.encode({"docs": [document.instanceToDict() for document in documents]})
+		
+		headers = {"content-type": "application/json"}	
+		
+		r = self._database_session.post("%s/_bulk_docs" % (self._database_url),headers=headers,data=data)
+		
+		if r.status_code == 201:
+			documents_data = self._database_session.decode(r)
+			
+			# Return saved and failed documents
+			ok_documents = []
+			failed_documents = []
+			
+			# Create a hash map of id vs new rev (only succeeded updates/inserts will have a rev)
+			id_rev_map = dict([(document_data["id"],document_data["rev"]) for document_data in documents_data if "rev" in document_data])
+			
+			# Conflicted documents keep their existing rev
+			conflicted_ids = set([document_data["id"] for document_data in documents_data if document_data.get("error") == "conflict" and document_data["id"] in ignore_conflict_ids]) if ignore_conflict_ids else set()
+			
+			# Update existing objects
+			for document in documents:
+				
+				# See if succeeded
+				if document._id in id_rev_map:
+					
+					document._rev = id_rev_map[document._id]
+					document.setSaved(self)
+					ok_documents.append(document)
+				
+				elif document._id in conflicted_ids:
+					
+					ok_documents.append(document)
+				
+				# Failed due to conflict
+				else:
+					failed_documents.append(document)
+					
+			return (ok_documents,failed_documents)
+			
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	# Add multiple documents
+	@_instrumented
+	def addMultiple(self,documents):
+		return self._bulkDocs(documents)
+	
+	# Update multiple documents
+	@_instrumented
+	def updateMultiple(self,documents):
+		
+		ok_documents = []
+		failed_documents = []
+		
+		class_documents = {}
+		
+		# Must loop and place in dicts based on class
+		for document in documents:
+
+			documents = class_documents.setdefault(document.__class__,[])
+			documents.append(document)
+			
+		for document_class in class_documents:
+			
+			# If no links with indexes then can safely bulk update (as no linked documents to remove)
+			if not (issubclass(document.__class__, Document) and document_class.hasLinksWithIndexes()):
+				
+				(cls_ok_documents,cls_failed_documents) = self._bulkDocs(class_documents[document_class])
+				ok_documents.extend(cls_ok_documents)
+				failed_documents.extend(cls_failed_documents)
+				
+			else:
+				
+				# If links exist then must update one at a time and lock
+				for document in class_documents[document_class]:
+					
+					try:
+						
+						document = self.update(document)
+						ok_documents.append(document)
+						
+					except:
+						
+						failed_documents.append(document)
+						
+		return (ok_documents,failed_documents)
+	
+	# Delete multiple documents
+	@_instrumented
+	def deleteMultiple(self,documents):
+		
+		ok_documents = []
+		failed_documents = []
+		
+		class_documents = {}
+		
+		# Must loop and place in dicts based on class
+		for document in documents:
+			
+			# First mark for delete
+			document.setMarkedForDelete(True)
+			
+			documents = class_documents.setdefault(document.__class__,[])
+			documents.append(document)
+			
+		for document_class in class_documents:
+			
+			# If no links then can safely bulk delete (as no linked documents to remove)
+			if not document_class.hasLinks():
+				
+				(cls_ok_documents,cls_failed_documents) = self._bulkDocs(class_documents[document_class])
+				ok_documents.extend(cls_ok_documents)
+				failed_documents.extend(cls_failed_documents)
+				
+			else:
+				
+				# If links exist then must delete one at a time and lock
+				for document in class_documents[document_class]:
+					
+					try:
+						
+						self.delete(document)
+						ok_documents.append(document)
+						
+					except:
+						
+						failed_documents.append(document)
+						
+		return (ok_documents,failed_documents)
+
+	# Check for existence of multiple document ids (don't want to support documents as would then have to inflate first to check existance)
+	@_instrumented
+	def existsMultiple(self,_ids):
+		headers = {"content-type": "application/json"}	
+		
+		data = self._database_session.encode({"keys":_ids})
+		
+		r = self._database_session.post("%s/_all_docs" % (self._database_url), headers=headers,data=data)
+		
+		if r.status_code == 200:
+			
+			_ids_that_exist = []
+			for row in self._database_session.decode(r)["rows"]:
+				if not ("deleted" in row or "error" in row or (isinstance(row.get("value"),dict) and row["value"].get("deleted"))):
+					_ids_that_exist.append(row["id"])
+					
+			return _ids_that_exist
+		
+		else:
+			raise Exception(self._database_session.decode(r))
+		
+	# Tries to inflate a dict of data into a Document
+	def _createDocument(self,document_data):
+		
+		with _profilePhase("inflate"):
+			
+			# Is this a schema bound document
+			if "type_" in document_data and document_data["type_"] in BaseDocument.type_class_map:
+				
+				document_class = BaseDocument.type_class_map[document_data["type_"]]
+				
+				# Now check is the current version (or if missing means is a schema design doc)
+				if "schema_version_" not in document_data or ("schema_version_" in document_data and document_data["schema_version_"] == document_class.getCurrentSchemaVersion()):
+					
+					# Valid document so inflate
+					document = document_class(document_data=document_data)
+					document.setDatabase(self)
+					return document
+				
+				# Older version that can be upgraded in memory
+				elif self._migrate_on_read and issubclass(document_class,Document) and document_class.getMigrationChain(document_data["schema_version_"]) is not None:
+					
+					try:
+						
+						migrated_document_data = document_class.migrateDocumentData(document_data)
+						
+						if self._write_back is not None:
+							self._write_back.add(document_class,copy.deepcopy(migrated_document_data))
+						
+						document = document_class(document_data=migrated_document_data)
+						document.setDatabase(self)
+						return document
+					
+					except Exception:
+						
+						# Documents are read over and over so only warn the first time each fails
+						failure_key = (document_data.get("_id"),document_data["schema_version_"])
+						
+						if failure_key in self._migration_failures:
+							logging.getLogger("ormchair").debug("Couldn't migrate %s from version %s",failure_key[0],failure_key[1])
+						else:
+							
+							self._migration_failures[failure_key] = True
+							if len(self._migration_failures) > 10000:
+								self._migration_failures.popitem(last=False)
+							
+							logging.getLogger("ormchair").warning("Couldn't migrate %s from version %s",failure_key[0],failure_key[1],exc_info=True)
+			
+			# Could bind to existing schema so return as unbound document
+			return 	UnboundDocument(document_data)
+			
+	
+	# Pass a json response from a view query and inflates documents
+	def _processViewResponse(self,documents_data,as_json=False,**kwargs):
+		
+		documents = []
+		
+		with _profilePhase("process"):
+			
+			for row in documents_data["rows"]:
+				
+				if as_json and "doc" in row:
+					
+					documents.append(row["doc"])
+					
+				elif "doc" in row:
+					
+					documents.append(self._createDocument(row["doc"]))
+				
+				else:
+					
+					documents.append(row)
+				
+		return documents
+	
+	# Get multiple documents
+	@_instrumented
+	def getMultiple(self,_ids,as_json=False,include=None):
+		
+		headers = {"content-type": "application/json"}	
+		data = self._database_session.encode({"keys":_ids})
+		
+		r = self._database_session.post("%s/_all_docs?include_docs=true" % (self._database_url), headers=headers,data=data,hedging=self._hedging)
+		
+		if r.status_code == 200:
+			
+			return self._include(self._processViewResponse(self._database_session.decode(r),as_json),include)
+		
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	# Inflate the embedded links at the include property paths of documents, fetching the linked documents of each level of the paths 
+	# with one (chunked) getMultiple
+	@_instrumented
+	def loadEmbeddedLinks(self,documents,include,chunk_size=500):
+		"""
+		Args:
+			documents (list): The documents
+			include (list): Embedded link property paths e.g. ["author","author.company","reviewers","address.owner"], paths can 
+				go through dict and list properties and the linked documents' own embedded links
+		
+		Kwargs:
+			chunk_size (int): Maximum ids fetched per request
+		
+		Returns:
+			list: The documents
+		"""
+		_loadEmbeddedLinks(self,documents,include,chunk_size)
+		
+		return documents
+	
+	# Load the embedded links of documents if include paths passed
+	def _include(self,documents,include):
+		
+		if include:
+			self.loadEmbeddedLinks(documents,include)
+		
+		# Documents returned together have their embedded links loaded together in a loader scope
+		loader = getattr(_operation_context,"loader",None)
+		if loader is not None and loader.getDatabase() is self:
+			loader.addDocuments(documents)
+		
+		return documents
+	
+	# Get the documents of a partition in id order (partitioned databases only)
+	@_instrumented
+	def getByPartition(self,partition,startkey_docid=None,limit=None,skip=None,as_json=False):
+		"""
+		Args:
+			partition (str): The partition e.g. the partition key value of the documents
+		
+		Kwargs:
+			startkey_docid (str): Start from this document id (for paging)
+			limit (int): Maximum number of documents
+			skip (int): Number of documents to skip
+			as_json (bool): Return dicts rather than documents
+		"""
+		
+		params = {"include_docs" : "true"}
+		
+		if startkey_docid:
+			params["startkey"] = self._database_session.encode(startkey_docid)
+		
+		for (optional_param_arg,value) in [("limit",limit),("skip",skip)]:
+			if value:
+				params[optional_param_arg] = value
+		
+		r = self._database_session.get("%s_all_docs" % (self._getPartitionUrl(partition)),params=params,hedging=self._hedging)
+		
+		if r.status_code == 200:
+			
+			return self._processViewResponse(self._database_session.decode(r),as_json)
+		
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+	# Get the document count and sizes of a partition
+	@_instrumented
+	def getPartitionInfo(self,partition):
+		
+		r = self._database_session.get(self._getPartitionUrl(partition).rstrip("/"))
+		
+		if r.status_code == 200:
+			return self._database_session.decode(r)
+		else:
+			raise Exception(self._database_session.decode(r))
+
+	
+	# Add links to documents (link documents have deterministic ids so an existing link just conflicts)
+	@_instrumented
+	def addLinks(self,link_property,to_documents):
+		
+		# Get the from doc and property itself
+		(from_document,link_property) = link_property
+	
+		# See if need to add from doc
+		if not from_document.hasBeenAdded():
+			from_document = self.add(from_document)
+		
+		documents_to_add = []
+		link_documents = []
+		
+		# Only add each document and link once
+		document_ids = set()
+			
+		# Create new link document per to document
+		for to_document in to_documents:
+			
+			# The link document holds the (partitioned) id the document will be added with
+			to_document.setPartitionedId()
+			
+			# See if need add to doc
+			if not to_document.hasBeenAdded() and to_document._id not in document_ids:
+				documents_to_add.append(to_document)
+				document_ids.add(to_document._id)
+			
+			link_document = self._createLinkDocument(from_document,link_property,to_document)
+			
+			if link_document._id not in document_ids:
+				link_documents.append(link_document)
+				document_ids.add(link_document._id)
+		
+		# Add to database in one go, links that already exist conflict and count as added
+		(ok_documents,failed_documents) = self._bulkDocs(documents_to_add + link_documents,ignore_conflict_ids=set([link_document._id for link_document in link_documents]))
+		
+		if len(failed_documents) > 0:
+			
+			failed_ids = set([document._id for document in failed_documents])
+			
+			# Remove the links just added to documents that couldn't be added (links that already existed have no new rev)
+			orphaned_link_documents = [document for document in ok_documents if isinstance(document,_LinkDocument) and document.to_id in failed_ids and document._rev]
+			
+			for link_document in orphaned_link_documents:
+				link_document.setMarkedForDelete(True)
+			
+			if len(orphaned_link_documents) > 0:
+				self._bulkDocs(orphaned_link_documents)
+			
+			raise Exception("Couldn't add %s" % (", ".join(sorted(failed_ids))))
+		
+		return [document for document in ok_documents if isinstance(document,_LinkDocument)]
+	
+	# Re-saves link documents created before link document ids were deterministic (when they had random ids) under their deterministic 
+	# id, removing duplicates of the same link, so addLinks finds existing links rather than adding them again
+	@_instrumented
+	def migrateLinkDocumentIds(self,batch_size=500):
+		"""
+		Kwargs:
+			batch_size (int): Link documents read per request
+		
+		Returns:
+			int: The number of link documents moved to their deterministic id
+		"""
+		migrated = 0
+		cursor = None
+		
+		while True:
+			
+			params = {"include_docs" : True, "limit" : batch_size + 1}
+			
+			# Page by key and doc id as migrated documents leave the view
+			if cursor is not None:
+				params["startkey"] = self._database_session.encode(cursor[0])
+				params["startkey_docid"] = cursor[1]
+			
+			r = self._database_session.get("%s/_design/_linkdocument/_view/by_id" % (self._database_url), params = params)
+			
+			if r.status_code != 200:
+				raise Exception(self._database_session.decode(r))
+			
+			rows = self._database_session.decode(r)["rows"]
+			
+			# Each link is emitted from both ends
+			documents_data = {}
+			for row in rows[:batch_size]:
+				if row.get("doc") and row["doc"]["_id"] != _LinkDocument.getLinkDocumentId(row["doc"]["from_id"],row["doc"]["name"],row["doc"]["to_id"],row["doc"].get("reverse_name"),self._partitioned):
+					documents_data[row["doc"]["_id"]] = row["doc"]
+			
+			if len(documents_data) > 0:
+				
+				new_link_documents = []
+				
+				# New link document -> the old link document it replaces
+				old_link_documents = {}
+				
+				for document_data in documents_data.values():
+					
+					new_link_document = _LinkDocument(document_data=copy.deepcopy(document_data))
+					new_link_document._id = _LinkDocument.getLinkDocumentId(new_link_document.from_id,new_link_document.name,new_link_document.to_id,new_link_document.reverse_name,self._partitioned)
+					new_link_document._rev = None
+					new_link_documents.append(new_link_document)
+					
+					old_link_documents[id(new_link_document)] = _LinkDocument(document_data=copy.deepcopy(document_data))
+				
+				# Links already saved under their deterministic id conflict, so the old document is just a duplicate
+				(ok_documents,failed_documents) = self._bulkDocs(new_link_documents,ignore_conflict_ids=set([link_document._id for link_document in new_link_documents]))
+				
+				delete_documents = []
+				for new_link_document in ok_documents:
+					
+					old_link_document = old_link_documents[id(new_link_document)]
+					old_link_document.setMarkedForDelete(True)
+					delete_documents.append(old_link_document)
+				
+				(deleted_documents,failed_deletes) = self._bulkDocs(delete_documents)
+				migrated += len(deleted_documents)
+			
+			if len(rows) <= batch_size:
+				return migrated
+			
+			cursor = (rows[batch_size]["key"],rows[batch_size]["id"])
+	
+	# Creates the link document between two documents
+	def _createLinkDocument(self,from_document,link_property,to_document):
+		
+		link_document = _LinkDocument()
+		link_document.name = link_property.getName()
+		link_document.reverse_name = link_property.getReverse()
+		link_document.from_id = from_document._id
+		link_document.from_type = from_document.type_
+		link_document.to_id = to_document._id
+		link_document.to_type = to_document.type_
+		link_document._id = _LinkDocument.getLinkDocumentId(link_document.from_id,link_document.name,link_document.to_id,link_document.reverse_name,self._partitioned)
+
+		# Add indexes if present
+		for index_property_path in link_property.getIndexPropertyPaths():
+
+			(property_exists,property_value) = to_document.getPropertyValueByPath(index_property_path)
+			if property_exists:
+				link_document.indexes[index_property_path] = property_value
+
+		# Add reverse indexes if present
+		for reverse_index_property_path in link_property.getReverseIndexPropertyPaths():
+
+			(property_exists,property_value) = from_document.getPropertyValueByPath(reverse_index_property_path)
+			if property_exists:
+				link_document.reverse_indexes[reverse_index_property_path] = property_value
+		
+		return link_document
+	
+	# Add linked document
+	@_instrumented
+	def addLink(self,link_property,to_document):
+		
+		return self.addLinks(link_property, [to_document])
+	
+	# Get linked documents
+	@_instrumented
+	def getLinks(self,link_property,start_key=None,limit=None,as_json=False,stale=None,include=None):
+		
+		# Get the from doc and property itself
+		(from_document,link_property) = link_property
+		
+		start_key = [from_document._id,link_property.getName(),start_key] if start_key else [from_document._id,link_property.getName()]
+		end_key = [from_document._id,link_property.getName(),{}]
+		
+		params = {
+			"include_docs" : True,
+			"startkey" : self._database_session.encode(start_key),
+			"endkey" : self._database_session.encode(end_key)
+		}
+	
+		if limit:
+			params["limit"] = limit
+		
+		params.update(self._getStaleParams(stale))
+			
+		r = self._database_session.get("%s/_design/_linkdocument/_view/links_by_name" % (self._database_url), params = params, hedging = self._hedging)
+		
+		if r.status_code == 200:
+		
+			return self._include(self._processViewResponse(self._database_session.decode(r),as_json),include)
+		
+		else:
+		
+			raise Exception(self._database_session.decode(r))
+
+	# Get the linked documents using index
+	@_instrumented
+	def getLinksByIndex(self,link_property,index_property_path,index_property_value,start_key=None,limit=None,as_json=False,stale=None):
+
+		# Get the from doc and property itself
+		(from_document,link_property) = link_property
+		
+		start_key = [from_document._id,link_property.getName(),index_property_path,index_property_value,start_key] if start_key else [from_document._id,link_property.getName(),index_property_path,index_property_value]
+		end_key = [from_document._id,link_property.getName(),index_property_path,index_property_value,{}]
+		
+		params = {
+			"include_docs" : True,
+			"startkey" : self._database_session.encode(start_key),
+			"endkey" : self._database_session.encode(end_key)
+		}
+	
+		if limit:
+			params["limit"] = limit
+		
+		params.update(self._getStaleParams(stale))
+			
+		r = self._database_session.get("%s/_design/_linkdocument/_view/links_by_indexes" % (self._database_url), params = params, hedging = self._hedging)
+		
+		if r.status_code == 200:
+
+			return self._processViewResponse(self._database_session.decode(r),as_json)
+		
+		else:
+		
+			raise Exception(self._database_session.decode(r))
+	
+	# Delete a linked document
+	@_instrumented
+	def deleteLink(self,link_property,to_document):
+		
+		self.deleteLinks(link_property,[to_document])
+	
+	# Delete many linked documents
+	@_instrumented
+	def deleteLinks(self,link_property,to_documents):
+		
+		# Get the from doc and property itself
+		(from_document,link_property) = link_property
+		
+		# Lock the affected documents
+		document_ids_to_lock = [from_document._id]
+		
+		# Build the keys
+		_ids = []
+		for to_document in to_documents:
+			_ids.append([from_document._id,link_property.getName(),to_document._id])
+			document_ids_to_lock.append(to_document._id)
+			
+		headers = {"content-type": "application/json"}
+		
+		params = {
+			"include_docs" : True
+		}
+			
+		data = {"keys":_ids}
+		
+		# Fetch the link docs
+		r = self._database_session.post("%s/_design/_linkdocument/_view/by_name" % (self._database_url), headers=headers, params=params, data=self._database_session.encode(data))
+
+		if r.status_code == 200:
+
+			# Turn into docs (TODO just need id so add a deleteMultipleByIds) 
+			documents_to_delete = self._processViewResponse(self._database_session.decode(r),False)
+			
+			# Lock on the id's to stop links being added whilst delete is happening
+			with self._lock(document_ids_to_lock):
+			
+				# Finally delete the documents
+				return self.deleteMultiple(documents_to_delete)
+		
+		else:
+		
+			raise Exception(self._database_session.decode(r))	
+
+	# For a given document this returns all the linked documents
+	@_instrumented
+	def deleteAllLinks(self,from_document):
+		
+		headers = {"content-type": "application/json"}
+		
+		params = {
+			"include_docs" : True
+			
+		}
+
+		data = {"key" : from_document._id}
+
+		# Fetch the link docs
+		r = self._database_session.post("%s/_design/_linkdocument/_view/by_id" % (self._database_url), headers=headers, params=params,  data=self._database_session.encode(data))
+
+		if r.status_code == 200:
+
+			# Turn into docs (TODO just need id so add a deleteMultipleByIds) 
+			documents_to_delete = self._processViewResponse(self._database_session.decode(r),False)
+			
+			# Lock on the id's to stop links being added whilst delete is happening
+			with self._lock([from_document._id]):
+			
+				# Finally delete the documents
+				return self.deleteMultiple(documents_to_delete)
+		
+		else:
+		
+			raise Exception(self._database_session.decode(r))
+
+	# For a given document that has links, update the indexes on the LinkDocuments to reflect document values
+	def _updateLinkIndexes(self,document):
+		
+		headers = {"content-type": "application/json"}
+		
+		params = {
+			"include_docs" : True
+		}
+
+		data = {"key" : document._id}
+
+		# Fetch the link docs
+		r = self._database_session.post("%s/_design/_linkdocument/_view/by_id" % (self._database_url), headers=headers, params=params,  data=self._database_session.encode(data))
+
+		if r.status_code == 200:
+			
+			# Turn into docs
+			link_documents = self._processViewResponse(self._database_session.decode(r),False)
+			
+			# Updates index dict values
+			def update_index_dict(document,index_dict):
+
+				updated = False
+
+				for index_property_path in index_dict:
+					
+					# Get the correct property value
+					(property_exists,property_value) = document.getPropertyValueByPath(index_property_path)
+
+					if property_exists:
+
+						# See if value is different to index
+						if index_dict[index_property_path] != property_value:
+							updated = True 
+							index_dict[index_property_path] = property_value
+				
+					else:
+					
+						# If can't find the property then delete the index as schema must have changed
+						del index_dict[index_property_path]
+
+				return updated
+
+			# Loop over link documents update indexes
+			link_documents_to_update = []
+			
+			for link_document in link_documents:
+				
+				if link_document.to_id == document._id:
+					
+					# Normal index
+					if update_index_dict(document,link_document.indexes):
+						
+						link_documents_to_update.append(link_document)
+
+				elif link_document.from_id == document._id:
+					
+					# Reverse index
+					if update_index_dict(document,link_document.reverse_indexes):
+						
+						link_documents_to_update.append(link_document)
+
+			# If any documents need updating do
+			if len(link_documents_to_update) > 0:
+				
+				self.updateMultiple(link_documents_to_update)
+
+		else:
+		
+			raise Exception(self._database_session.decode(r))
+
+	# Loops over document classes and creates their schema's and if changed updates schema version and design docs for indexes
+	@_instrumented
+	def sync(self,staged=False,wait=False):
+		"""
+		Kwargs:
+			staged (bool): Deploy changed design documents blue/green e.g. build their indexes under a staging id and copy over the live id once built
+			wait (bool): Wait for staged deployments to complete
+		
+		Returns:
+			list: The staged DesignDocumentDeployments that were started
+		"""
+		
+		deployments = []
+		
+		# Loop each document class
+		for document_class_name in BaseDocument.type_class_map:
+			
+			document_class = BaseDocument.type_class_map[document_class_name]
+			
+			# Don't sync design documents and system documents (seperate process for them)
+			if not issubclass(document_class, DesignDocument) and document_class not in [BaseDocument,Document]:
+				
+				schema_version = None
+				
+				try:
+					
+					# Try and get
+					saved_schema_design_document = self.get(document_class.getSchemaDesignDocumentId(),as_json=True)
+					
+					# Got this far so must compare to see if it needs updating
+					current_schema_design_document = self._getSchemaDesignDocument(document_class)
+					
+					# Set the _rev and version properties so like for like comparison
+					current_schema_design_document._rev = saved_schema_design_document["_rev"]
+					current_schema_design_document.version = saved_schema_design_document["version"]
+					
+					update = False
+					
+					# Compare saved schema to see if need to update version
+					if current_schema_design_document.schema != saved_schema_design_document["schema"]:
+						current_schema_design_document.version = saved_schema_design_document["version"] + 1
+						update = True
+						
+					# See if more views/indexes have been added (e.g. not affecting the schema version)
+					elif json.dumps(current_schema_design_document.instanceToDict()) != json.dumps(saved_schema_design_document):
+						update = True
+					
+					if update and staged:
+						
+						# Keep the live schema version until the deployment has swapped the new design document in
+						deployments.append(self._deployDesignDocument(current_schema_design_document,document_class))
+						schema_version = saved_schema_design_document["version"]
+					
+					elif update:
+						schema_version = self.update(current_schema_design_document).version
+					else:
+						schema_version = current_schema_design_document.version
+	
+				# Add
+				except Exception as e:
+					
+					schema_version = self.add(self._getSchemaDesignDocument(document_class)).version
+					
+				# Set the schema version for document class
+				document_class.setCurrentSchemaVersion(schema_version)
+				
+				# Mango indexes live in their own design document
+				if self._index_backend == "mango":
+					self._syncMangoIndexes(document_class)
+				
+			# Check design documents and see if they have fixed id's...if so check for changes and sync if needed
+			elif issubclass(document_class, DesignDocument) and document_class.hasFixedId() and document_class.isSynced():
+				
+				current_design_document = document_class()
+				
+				# In a partitioned database design documents are partitioned unless they say otherwise, so keep these global
+				if self._partitioned and current_design_document.isPartitioned() is None:
+					current_design_document.setPartitioned(False)
+				
+				try:
+					
+					saved_design_document = self.get(current_design_document._id)
+					current_design_document._rev = saved_design_document._rev
+	
+					# Compare with saved (also check for unknown properties e.g. things in the doc that aren't in the schema)
+					if json.dumps(current_design_document.instanceToDict()) != json.dumps(saved_design_document.instanceToDict()) > 0:
+						
+						if staged:
+							deployments.append(self._deployDesignDocument(current_design_document))
+						else:
+							saved_design_document = self.update(current_design_document)
+				
+				except ValidationError:
+					
+					# Ok doc exists but couldn't create class so just grab document (TODO this is inefficient but only happens when syncing meh)
+					saved_design_document_json = self.get(current_design_document._id,as_json=True)
+					current_design_document._rev = saved_design_document_json["_rev"]
+					
+					if staged:
+						deployments.append(self._deployDesignDocument(current_design_document))
+					else:
+						saved_design_document = self.update(current_design_document)
+					
+				except Exception:
+					
+					# Doc doesn't exist so first sync so just add
+					saved_design_document = self.add(current_design_document)
+		
+		# Optionally block until the staged indexes have been built and swapped in
+		if wait:
+			for deployment in deployments:
+				deployment.wait()
+		
+		return deployments
+	
+	# Returns the schema design document of a document class, in a partitioned database its views are partitioned if the class is
+	def _getSchemaDesignDocument(self,document_class):
+		
+		schema_design_document = document_class.getSchemaDesignDocument(include_indexes=self._index_backend == "view")
+		
+		if self._partitioned:
+			schema_design_document.setPartitioned(document_class.hasPartitionKey())
+		
+		return schema_design_document
+	
+	# Creates the mango indexes of a document class (couchdb ignores indexes that already exist)
+	def _syncMangoIndexes(self,document_class):
+		
+		headers = {"content-type": "application/json"}
+		
+		for index_name in document_class._indexes:
+			
+			index_definition = getattr(document_class,index_name).getMangoIndexDefinition()
+			
+			if self._partitioned:
+				index_definition["partitioned"] = document_class.hasPartitionKey()
+			
+			data = self._database_session.encode(index_definition)
+			
+			r = self._database_session.post("%s_index" % (self._database_url),headers=headers,data=data)
+			
+			if r.status_code != 200:
+				raise Exception(self._database_session.decode(r))
+	
+	# Returns the id a design document is staged under whilst its index builds
+	def getStagingDesignDocumentId(self,design_document_id):
+		
+		return "%s_staging" % (design_document_id)
+	
+	# Writes a design document under its staging id and starts a background deployment to build the index and swap it in (then set
+	# the schema version of the document class if the design document is a schema design document)
+	def _deployDesignDocument(self,design_document,document_class=None):
+		
+		staging_document_id = self.getStagingDesignDocumentId(design_document._id)
+		
+		document_data = design_document.instanceToDict()
+		document_data["_id"] = staging_document_id
+		
+		# A previous deployment may have left a staging document behind
+		try:
+			document_data["_rev"] = self.get(staging_document_id,as_json=True)["_rev"]
+		except Exception:
+			document_data.pop("_rev",None)
+		
+		r = self._database_session.put("%s%s" % (self._database_url,staging_document_id),data=self._database_session.encode(document_data))
+		
+		if r.status_code != 201:
+			raise Exception(self._database_session.decode(r))
+		
+		deployment = DesignDocumentDeployment(self,design_document,staging_document_id,self._database_session.decode(r)["rev"],document_class)
+		deployment.start()
+		
+		return deployment
+	
+	# Blocks until the staging design document's index is built then copies it over the live design document
+	def _swapDesignDocument(self,design_document,staging_document_id,staging_rev,document_class=None):
+		
+		try:
+			
+			# All views in a design document share one index so querying one builds them all (partitioned views can only be queried by 
+			# partition so are left to couchdb's background indexer)
+			if len(design_document._views) > 0 and not (self._partitioned and design_document.isPartitioned() is not False):
+				
+				r = self._database_session.get("%s%s/_view/%s" % (self._database_url,staging_document_id,design_document._views[0]), params={"limit" : 0})
+				
+				if r.status_code != 200:
+					raise Exception(self._database_session.decode(r))
+			
+			# Copy is atomic and as the view signatures match the live id picks up the built index
+			live_rev = self.get(design_document._id,as_json=True)["_rev"]
+			headers = {"Destination": "%s?rev=%s" % (design_document._id,live_rev)}
+			
+			r = self._database_session.request("COPY","%s%s" % (self._database_url,staging_document_id),headers=headers)
+			
+			if r.status_code != 201:
+				raise Exception(self._database_session.decode(r))
+		
+		except Exception:
+			
+			# Don't leave the failed deployment's staging document (and its index) behind
+			try:
+				self._database_session.delete("%s%s?rev=%s" % (self._database_url,staging_document_id,staging_rev))
+			except Exception:
+				logging.getLogger("ormchair").warning("Couldn't delete staging design document %s",staging_document_id,exc_info=True)
+			
+			raise
+		
+		design_document._rev = self._database_session.decode(r)["rev"]
+		
+		# New documents are written with the new schema version now it's live
+		if document_class is not None:
+			document_class.setCurrentSchemaVersion(design_document.version)
+		
+		# Tidy up the staging document
+		r = self._database_session.delete("%s%s?rev=%s" % (self._database_url,staging_document_id,staging_rev))
+		
+		if r.status_code != 200:
+			raise Exception(self._database_session.decode(r))
+		
+		return design_document
+	
+	# Returns the ids of the design documents that sync() manages
+	def getDesignDocumentIds(self):
+		
+		design_document_ids = []
+		
+		for document_class in BaseDocument.type_class_map.values():
+			
+			if not issubclass(document_class, DesignDocument) and document_class not in [BaseDocument,Document]:
+				design_document_ids.append(document_class.getSchemaDesignDocumentId())
+			elif issubclass(document_class, DesignDocument) and document_class.hasFixedId() and document_class.isSynced():
+				design_document_ids.append(document_class.getFixedId())
+		
+		return sorted(design_document_ids)
+	
+	# Triggers the index build of every synced design document so the first real query doesn't pay for it
+	def warmUp(self,background=True):
+		"""
+		Kwargs:
+			background (bool): Build the indexes on a background thread, otherwise they are built before returning
+		
+		Returns:
+			BackgroundTask: The (started) warm up task, or True when not in the background
+		"""
+		
+		if not background:
+			self._warmUpIndexes(self.getDesignDocumentIds())
+			return True
+		
+		task = BackgroundTask(self._warmUpIndexes,self.getDesignDocumentIds())
+		task.start()
+		
+		return task
+	
+	# Queries one view per design document (all views in a design document share an index)
+	def _warmUpIndexes(self,design_document_ids):
+		
+		for design_document_id in design_document_ids:
+			
+			design_document_data = self.get(design_document_id,as_json=True)
+			view_names = sorted(design_document_data.get("views",{}).keys())
+			
+			# Partitioned views can only be queried by partition
+			if self._partitioned and design_document_data.get("options",{}).get("partitioned") is not False:
+				continue
+			
+			if len(view_names) > 0:
+				
+				r = self._database_session.get("%s%s/_view/%s" % (self._database_url,design_document_id,view_names[0]), params={"limit" : 0})
+				
+				if r.status_code != 200:
+					raise Exception(self._database_session.decode(r))
+	
+	# Returns the url of the couchdb server this database is on
+	def _getServerUrl(self):
+		
+		return self._database_url.rstrip("/").rsplit("/",1)[0]
+	
+	# Returns the name of the database
+	def _getDatabaseName(self):
+		
+		return self._database_url.rstrip("/").rsplit("/",1)[1]
+	
+	# Gets the indexing progress of the synced design documents e.g. for readiness checks and lag metrics
+	@_instrumented
+	def getIndexStatus(self):
+		"""
+		Returns:
+			dict: Keyed by design document id, each with the view update_seq, lag (in changes) behind the database update_seq, 
+			whether the indexer is running and its progress (percent) from _active_tasks. In a cluster the lag is approximate,
+			only 0 when the index has caught up
+		"""
+		
+		r = self._database_session.get(self._database_url)
+		
+		if r.status_code != 200:
+			raise Exception(self._database_session.decode(r))
+		
+		database_update_seq = self._database_session.decode(r)["update_seq"]
+		database_seq = _sequenceNumber(database_update_seq)
+		
+		# Running indexer tasks for this database
+		r = self._database_session.get("%s/_active_tasks" % (self._getServerUrl()))
+		
+		if r.status_code != 200:
+			raise Exception(self._database_session.decode(r))
+		
+		indexer_tasks = {}
+		for task in self._database_session.decode(r):
+			
+			# Sharded couchdb reports the shard file rather than the database name
+			task_database = task.get("database","")
+			if task.get("type") == "indexer" and (task_database == self._getDatabaseName() or task_database.split("/")[-1].split(".")[0] == self._getDatabaseName()):
+				
+				if "progress" in task:
+					progress = task["progress"]
+				elif task.get("total_changes"):
+					progress = 100 * task.get("changes_done",0) / task["total_changes"]
+				else:
+					progress = 0
+				
+				indexer_tasks.setdefault(task.get("design_document"),[]).append(progress)
+		
+		index_status = {}
+		
+		for design_document_id in self.getDesignDocumentIds():
+			
+			r = self._database_session.get("%s%s/_info" % (self._database_url,design_document_id))
+			
+			if r.status_code != 200:
+				raise Exception(self._database_session.decode(r))
+			
+			view_index = self._database_session.decode(r)["view_index"]
+			view_update_seq = view_index.get("update_seq",0)
+			view_seq = _sequenceNumber(view_update_seq)
+			
+			progress = indexer_tasks.get(design_document_id)
+			
+			index_status[design_document_id] = {
+				"update_seq" : view_seq,
+				"database_update_seq" : database_seq,
+				"lag" : _sequenceLag(database_update_seq,view_update_seq),
+				"updater_running" : view_index.get("updater_running",False) or progress is not None,
+				"progress" : min(progress) if progress else None
+			}
+		
+		return index_status
+	
+	# Blocks until all synced indexes have caught up with the database (triggering a warm up first)
+	@_instrumented
+	def waitUntilIndexed(self,timeout=None,poll_interval=0.5):
+		"""
+		Kwargs:
+			timeout (float): Seconds to wait before giving up
+			poll_interval (float): Seconds between index status checks
+		
+		Returns:
+			bool: True if all indexes caught up within the timeout
+		"""
+		
+		start = time.time()
+		
+		self.warmUp(background=True)
+		
+		while True:
+			
+			if all([status["lag"] == 0 for status in self.getIndexStatus().values()]):
+				return True
+			
+			if timeout is not None and time.time() - start >= timeout:
+				return False
+			
+			time.sleep(poll_interval)
+	
+	# Gets the documents by view. Passed in either a view property of Document class or design_document_id and document class
+	@_instrumented
+	def getByView(self,view_property=None,view_name=None,design_document_id=None,**kwargs):
+		
+		return self._include(self._processViewResponse(self._queryView(view_property,view_name,design_document_id,**kwargs),**kwargs),kwargs.get("include"))
+	
+	# Query a view returning the decoded response (rows with their keys and ids), only the rows of a partition if partition is passed
+	def _queryView(self,view_property=None,view_name=None,design_document_id=None,partition=None,**kwargs):
+		
+		database_url = self._getPartitionUrl(partition)
+			
+		# A view property as defined on a Document or DesignDocument
+		if view_property:
+		
+			# Get the parent class containing the property
+			view_parent_class = view_property.getParent()
+			
+			# What type of view property is this a) On a Document class, b) On a Design Document class
+			if issubclass(view_parent_class, DesignDocument):
+				
+				# Check for id arg
+				if not (view_parent_class.hasFixedId() or design_document_id):
+					raise Exception("Design document doesn't have a fixed id and design document id missing in args")
+				elif view_parent_class.hasFixedId():
+					design_document_id = view_parent_class.getFixedId()
+	
+				# Set the views url
+				url = "%s%s/_view/%s" % (database_url, design_document_id, view_property.getName())
+				
+			else:
+	
+				url = "%s%s/_view/%s" % (database_url, view_parent_class.getSchemaDesignDocumentId(), view_property.getName())
+		
+		# Direct access to the view
+		elif view_name and design_document_id:
+			
+			url = "%s%s/_view/%s" % (database_url, design_document_id, view_name)
+		
+		else:
+			
+			raise Exception("View property or view name and design document id missing in args")
+		
+		# Response type
+		headers = {"content-type": "application/json"}	
+		
+		# The params on the url (only include docs if not a reduce)
+		params = {}
+		if not ("group" in kwargs or "reduce" in kwargs or "include_docs" in kwargs):
+			params["include_docs"] = True
+			
+		for optional_param_arg in ["key","limit","skip","descending","group","group_level"]:
+			if optional_param_arg in kwargs and kwargs[optional_param_arg]:
+				params[optional_param_arg] = self._database_session.encode(kwargs[optional_param_arg])
+		
+		# Document ids aren't json encoded
+		for optional_param_arg in ["startkey_docid","endkey_docid"]:
+			if optional_param_arg in kwargs and kwargs[optional_param_arg]:
+				params[optional_param_arg] = kwargs[optional_param_arg]
+		
+		# Read mode e.g. stale="ok" answers from the existing index
+		params.update(self._getStaleParams(kwargs.get("stale")))
+		
+		# The data in the post body
+		data = {}
+		for optional_data_arg in ["keys","startkey","endkey"]:
+			if optional_data_arg in kwargs and kwargs[optional_data_arg]:
+				data[optional_data_arg] = kwargs[optional_data_arg]
+				
+		with _profilePhase("serialize"):
+			data = self._database_session.encode(data)
+		
+		# Do the post
+		r = self._database_session.post(url, headers=headers,params=params, data=data, hedging=self._hedging)
+	
+		if r.status_code == 200:
+			
+			return self._database_session.decode(r)
+		
+		else:
+
+			raise Exception(self._database_session.decode(r))
+	
+	# Gets the documents by index
+	@_instrumented
+	def getByIndex(self,index_property,**kwargs):
+		
+		if self._index_backend == "mango":
+			return self._getByMangoIndex(index_property,**kwargs)
+		
+		return self.getByView(**_getIndexViewArgs(index_property,kwargs))
+	
+	# Gets the documents by index using a mango query against the index's _index definition
+	def _getByMangoIndex(self,index_property,key=None,keys=None,startkey=None,endkey=None,limit=None,skip=None,descending=False,bookmark=None,fields=None,as_json=False,stale=None,partition=None,include=None,**kwargs):
+		
+		(selector,sort,use_index) = _getMangoIndexQuery(index_property,key,keys,startkey,endkey,descending)
+		
+		return self.find(selector,fields=fields,sort=sort,limit=limit,skip=skip,bookmark=bookmark,use_index=use_index,as_json=as_json,stale=stale,partition=partition,include=include)
+	
+	# Queries documents with a mango selector (couchdb 2.0+)
+	@_instrumented
+	def find(self,selector,fields=None,sort=None,limit=None,skip=None,bookmark=None,use_index=None,as_json=False,stale=None,partition=None,include=None):
+		"""
+		Args:
+			selector (dict): The mango selector e.g. {"type_" : "person", "name" : "Will"}
+		
+		Kwargs:
+			fields (list): Only return these property paths (documents are then returned as json as they are partial)
+			sort (list): Mango sort e.g. [{"name" : "asc"}]
+			limit (int): Maximum number of documents
+			skip (int): Number of documents to skip
+			bookmark (str): Bookmark from a previous FindResults to fetch the next page
+			use_index (list): Design document id and index name to use
+			as_json (bool): Return dicts rather than documents
+			stale (str): Read mode, "ok" or "update_after" answer from the existing index
+			partition (str): Only query the documents of this partition (partitioned databases only)
+			include (list): Embedded link property paths to load (see loadEmbeddedLinks)
+		
+		Returns:
+			FindResults: A list of the documents with the bookmark of the next page
+		"""
+		
+		headers = {"content-type": "application/json"}
+		
+		data = {"selector" : selector}
+		
+		for (optional_data_arg,value) in [("fields",fields),("sort",sort),("bookmark",bookmark),("use_index",use_index)]:
+			if value:
+				data[optional_data_arg] = value
+		
+		# 0 is a valid limit
+		for (optional_data_arg,value) in [("limit",limit),("skip",skip)]:
+			if value is not None:
+				data[optional_data_arg] = value
+		
+		# Mango only has an update flag, so both stale read modes skip the index update
+		if self._getStaleParams(stale):
+			data["update"] = False
+		
+		with _profilePhase("serialize"):
+			data = self._database_session.encode(data)
+		
+		r = self._database_session.post("%s_find" % (self._getPartitionUrl(partition)),headers=headers,data=data,hedging=self._hedging)
+		
+		if r.status_code == 200:
+			
+			response_data = self._database_session.decode(r)
+			
+			if as_json or fields:
+				documents = response_data["docs"]
+			else:
+				documents = self._include([self._createDocument(document_data) for document_data in response_data["docs"]],include)
+			
+			return FindResults(documents,response_data.get("bookmark"))
+		
+		else:
+			raise Exception(self._database_session.decode(r))
+	
+		
+
+# Returns the getByView kwargs to query an Index's view (its keys are prefixed with the index name)
+def _getIndexViewArgs(index_property,kwargs):
+	
+	kwargs = dict(kwargs)
+	
+	# Must prefix the passed in key with the indexes name (multiple values)
+	if "keys" in kwargs:
+		new_keys = []
+		for key in kwargs["keys"]:
+			key = list(key) if isinstance(key,list) else [key]
+			key.insert(0,index_property.getName())
+			new_keys.append(key)
+		kwargs["keys"] = new_keys
+		
+	# Must prefix the passed in key with the indexes name (single value)
+	for key_arg in ["key","startkey","endkey"]:
+		
+		# If key, startkey or endkey then put into a list
+		if key_arg in kwargs:
+			kwargs[key_arg] = [index_property.getName()] + (list(kwargs[key_arg]) if isinstance(kwargs[key_arg],list) else [kwargs[key_arg]])
+	
+	kwargs["view_name"] = "indexes_"
+	kwargs["design_document_id"] = index_property.getParent().getSchemaDesignDocumentId()
+	
+	return kwargs
+
+# Returns the selector, sort and use_index of a mango query against an Index's _index definition
+def _getMangoIndexQuery(index_property,key=None,keys=None,startkey=None,endkey=None,descending=False):
+	
+	document_class = index_property.getParent()
+	
+	# Descending views start from the high key
+	if descending:
+		(startkey,endkey) = (endkey,startkey)
+	
+	selector = index_property.getMangoSelector(key=key,keys=keys,startkey=startkey,endkey=endkey)
+	
+	# Sort must follow the index fields for the index to be usable
+	direction = "desc" if descending else "asc"
+	sort = [{field: direction} for field in ["type_"] + list(index_property.getFields())]
+	
+	use_index = [document_class.getMangoDesignDocumentId(),index_property.getName()]
+	
+	# Keys are or'ed so can't use the index order
+	if keys is not None:
+		sort = None
+	
+	return (selector,sort,use_index)
+
+
+# Sort key for a string following CouchDB's ICU collation: compared ignoring case and accents first (punctuation and symbols before 
+# digits before letters), then by accents, then by case with lowercase first e.g. "a" < "A" < "aa" < "b" < "B". This approximates
+# the ICU root collation so the order of punctuation and symbols between themselves can differ.
+def _stringCollationKey(value):
+	
+	if isinstance(value,str):
+		value = value.decode("utf-8","replace")
+	
+	primary = []
+	secondary = []
+	tertiary = []
+	
+	for character in unicodedata.normalize("NFD",value):
+		
+		# Accents belong to the previous character
+		if unicodedata.combining(character) and len(secondary) > 0:
+			secondary[-1] += (ord(character),)
+			continue
+		
+		folded = character.lower()
+		primary.append((2 if folded.isalpha() else 1 if folded.isdigit() else 0,folded))
+		secondary.append(())
+		tertiary.append(1 if character.isupper() else 0)
+	
+	return (tuple(primary),tuple(secondary),tuple(tertiary),value)
+
+# CouchDB view collation order (null, false, true, numbers, strings, arrays then objects)
+def _collationKey(value):
+	
+	if value is None:
+		return (0,)
+	elif value is False:
+		return (1,)
+	elif value is True:
+		return (2,)
+	elif isinstance(value,(int,long,float)):
+		return (3,value)
+	elif isinstance(value,basestring):
+		return (4,_stringCollationKey(value))
+	elif isinstance(value,(list,tuple)):
+		return (5,tuple([_collationKey(item) for item in value]))
+	elif isinstance(value,dict):
+		return (6,tuple([(key,_collationKey(item)) for (key,item) in sorted(value.iteritems())]))
+	
+	return (7,value)
+
+
+class _DescendingKey(object):
+	"""
+	Reverses the order of a sort key
+	"""
+	__slots__ = ["key"]
+	
+	def __init__(self,key):
+		
+		self.key = key
+	
+	def __lt__(self,other):
+		
+		return other.key < self.key
+	
+	def __eq__(self,other):
+		
+		return self.key == other.key
+	
+	def __ne__(self,other):
+		
+		return self.key != other.key
+
+
+# Merge iterators that are each sorted by key, priming them in parallel (as their first items can need a request)
+def _mergeSorted(iterators,key,descending=False,database_session=None,parallel=True):
+	
+	sentinel = object()
+	
+	if parallel:
+		firsts = _runParallel([_inCurrentContext(database_session)(functools.partial(next,iterator,sentinel)) for iterator in iterators])
+	else:
+		firsts = [next(iterator,sentinel) for iterator in iterators]
+	
+	heap = []
+	for (index,item) in enumerate(firsts):
+		if item is not sentinel:
+			heap.append((_DescendingKey(key(item)) if descending else key(item),index,item))
+	
+	heapq.heapify(heap)
+	
+	while heap:
+		
+		(sort_key,index,item) = heap[0]
+		yield item
+		
+		item = next(iterators[index],sentinel)
+		
+		if item is sentinel:
+			heapq.heappop(heap)
+		else:
+			heapq.heapreplace(heap,(_DescendingKey(key(item)) if descending else key(item),index,item))
+
+
+# Call functions on their own threads, returning their results (or raising the first error)
+def _runParallel(functions):
+	
+	if len(functions) == 1:
+		return [functions[0]()]
+	
+	results = [None] * len(functions)
+	
+	def run(index):
+		results[index] = functions[index]()
+	
+	tasks = [BackgroundTask(run,index) for index in range(len(functions))]
+	
+	for task in tasks:
+		task.start()
+	
+	for task in tasks:
+		task.wait()
+	
+	return results
+
+
+# Default shard function, a stable hash of the shard key
+def shardByHash(shard_key,shard_count):
+	
+	return (zlib.crc32(shard_key.encode("utf-8") if isinstance(shard_key,unicode) else shard_key) & 0xffffffff) % shard_count
+
+
+class ShardedDatabase(object):
+	"""
+	Spreads documents across several Databases, routing each by a shard function of its _id (or its type). Point reads and writes go
+	to the document's shard, view, index and find queries are sent to every shard and their results merged in order a page at a time,
+	and sync is run on every shard in parallel. Links aren't supported as linked documents can be on different shards. String keys are 
+	merged with an approximation of couchdb's ICU collation (case and accent insensitive first, lowercase before uppercase), so keys that
+	differ only in punctuation or symbols can be merged in a different order to a single database.
+	"""
+	def __init__(self,databases,shard_by="_id",shard_function=shardByHash,page_size=100):
+		"""
+		Args:
+			databases (list): The Database of each shard (in a fixed order, changing it moves documents between shards)
+		
+		Kwargs:
+			shard_by (str): Route documents by "_id" or by "type" (gets by _id are then sent to every shard)
+			shard_function (function): Returns the shard index for a shard key and the shard count
+			page_size (int): Rows fetched per shard at a time when merging query results
+		"""
+		if len(databases) == 0:
+			raise Exception("At least one database is required")
+		
+		if shard_by not in ["_id","type"]:
+			raise Exception("Unknown shard key %s" % (shard_by))
+		
+		if len(set([database.getIndexBackend() for database in databases])) > 1:
+			raise Exception("Shards must use the same index backend")
+		
+		self._databases = list(databases)
+		self._shard_by = shard_by
+		self._shard_function = shard_function
+		self._page_size = page_size
+		
+		# Used by _instrumented
+		self._database_session = self._databases[0]._database_session
+		self._database_url = ",".join([database.getUrl() for database in self._databases])
+	
+	def getDatabases(self):
+		
+		return list(self._databases)
+	
+	def getIndexBackend(self):
+		
+		return self._databases[0].getIndexBackend()
+	
+	# Get the shard a document (or _id when sharding by _id) belongs to
+	def getShard(self,document):
+		
+		if self._shard_by == "type":
+			
+			if not isinstance(document,BaseDocument):
+				raise Exception("Documents are sharded by type so their shard can't be found from an _id")
+			
+			shard_key = document.type_
+		
+		elif isinstance(document,BaseDocument):
+			
+			# Route by the id the document will be added with
+			document.setPartitionedId()
+			shard_key = document._id
+		
+		else:
+			shard_key = document
+		
+		return self._databases[self._shard_function(shard_key,len(self._databases))]
+	
+	# Group documents (or ids) by shard
+	def _groupByShard(self,documents):
+		
+		shard_documents = collections.OrderedDict()
+		
+		for document in documents:
+			shard_documents.setdefault(self.getShard(document),[]).append(document)
+		
+		return shard_documents
+	
+	# Call a Database method on every shard in parallel
+	def _scatter(self,method_name,*args,**kwargs):
+		
+		return _runParallel([_inCurrentContext(self._database_session)(functools.partial(getattr(database,method_name),*args,**kwargs)) for database in self._databases])
+	
+	# Call a Database method with the documents of each shard in parallel, returning the (shard documents,result) pairs
+	def _scatterDocuments(self,method_name,documents,**kwargs):
+		
+		shard_documents = self._groupByShard(documents)
+		
+		results = _runParallel([_inCurrentContext(self._database_session)(functools.partial(getattr(database,method_name),database_documents,**kwargs)) for (database,database_documents) in shard_documents.iteritems()])
+		
+		return zip(shard_documents.values(),results)
+	
+	@_instrumented
+	def add(self,document):
+		
+		return self.getShard(document).add(document)
+	
+	@_instrumented
+	def update(self,document):
+		
+		return self.getShard(document).update(document)
+	
+	@_instrumented
+	def delete(self,document):
+		
+		return self.getShard(document).delete(document)
+	
+	@_instrumented
+	def get(self,_id,rev=None,as_json=False,include=None):
+		
+		if self._shard_by == "_id":
+			return self._include([self.getShard(_id).get(_id,rev=rev,as_json=as_json)],include)[0]
+		
+		# Could be on any shard
+		errors = []
+		for result in self._scatter("_getOrError",_id,rev,as_json):
+			if isinstance(result,Exception):
+				errors.append(result)
+			else:
+				return self._include([result],include)[0]
+		
+		raise errors[0]
+	
+	@_instrumented
+	def exists(self,_id):
+		
+		return [_id] == self.existsMultiple([_id])
+	
+	@_instrumented
+	def existsMultiple(self,_ids):
+		
+		if self._shard_by == "_id":
+			_ids_that_exist = set(sum([result for (shard_ids,result) in self._scatterDocuments("existsMultiple",_ids)],[]))
+		else:
+			_ids_that_exist = set(sum(self._scatter("existsMultiple",_ids),[]))
+		
+		return [_id for _id in _ids if _id in _ids_that_exist]
+	
+	# Documents are returned in the order of _ids (with the not found rows of missing ids)
+	@_instrumented
+	def getMultiple(self,_ids,as_json=False,include=None):
+		
+		documents = {}
+		
+		if self._shard_by == "_id":
+			
+			for (shard_ids,shard_documents) in self._scatterDocuments("getMultiple",_ids,as_json=as_json):
+				documents.update(zip(shard_ids,shard_documents))
+		
+		else:
+			
+			# Keep the found documents
+			for shard_documents in self._scatter("getMultiple",_ids,as_json):
+				for (_id,document) in zip(_ids,shard_documents):
+					if _id not in documents or not _isNotFoundRow(document):
+						documents[_id] = document
+		
+		return self._include([documents[_id] for _id in _ids],include)
+	
+	# Inflate the embedded links at the include property paths of documents (the linked documents can be on any shard)
+	@_instrumented
+	def loadEmbeddedLinks(self,documents,include,chunk_size=500):
+		
+		_loadEmbeddedLinks(self,documents,include,chunk_size)
+		
+		return documents
+	
+	def loader(self,chunk_size=500):
+		
+		return EmbeddedLinkLoader(self,chunk_size=chunk_size)
+	
+	def _include(self,documents,include):
+		
+		if include:
+			self.loadEmbeddedLinks(documents,include)
+		
+		# Documents returned together have their embedded links loaded together in a loader scope
+		loader = getattr(_operation_context,"loader",None)
+		if loader is not None and loader.getDatabase() is self:
+			loader.addDocuments(documents)
+		
+		return documents
+	
+	@_instrumented
+	def addMultiple(self,documents):
+		
+		return self._mergeBulkResults(self._scatterDocuments("addMultiple",documents))
+	
+	@_instrumented
+	def updateMultiple(self,documents):
+		
+		return self._mergeBulkResults(self._scatterDocuments("updateMultiple",documents))
+	
+	@_instrumented
+	def deleteMultiple(self,documents):
+		
+		return self._mergeBulkResults(self._scatterDocuments("deleteMultiple",documents))
+	
+	def _mergeBulkResults(self,results):
+		
+		ok_documents = []
+		failed_documents = []
+		
+		for (shard_documents,(shard_ok_documents,shard_failed_documents)) in results:
+			ok_documents.extend(shard_ok_documents)
+			failed_documents.extend(shard_failed_documents)
+		
+		return (ok_documents,failed_documents)
+	
+	@_instrumented
+	def putAttachment(self,document,name,data,content_type="application/octet-stream",length=None):
+		
+		return self.getShard(document).putAttachment(document,name,data,content_type=content_type,length=length)
+	
+	@_instrumented
+	def getAttachment(self,document,name,sink=None,chunk_size=65536):
+		
+		return self.getShard(document).getAttachment(document,name,sink=sink,chunk_size=chunk_size)
+	
+	@_instrumented
+	def iterAttachment(self,document,name,chunk_size=65536):
+		
+		return self.getShard(document).iterAttachment(document,name,chunk_size=chunk_size)
+	
+	@_instrumented
+	def deleteAttachment(self,document,name):
+		
+		return self.getShard(document).deleteAttachment(document,name)
+	
+	# Sync every shard in parallel, returning all their staged deployments
+	@_instrumented
+	def sync(self,staged=False,wait=False):
+		
+		return sum(self._scatter("sync",staged=staged,wait=wait),[])
+	
+	def setStale(self,stale):
+		
+		for database in self._databases:
+			database.setStale(stale)
+	
+	def warmUp(self,background=True):
+		
+		return [database.warmUp(background=background) for database in self._databases]
+	
+	# Returns the index status of each shard
+	def getIndexStatus(self):
+		
+		return self._scatter("getIndexStatus")
+	
+	def waitUntilIndexed(self,timeout=None,poll_interval=0.5):
+		
+		return all(self._scatter("waitUntilIndexed",timeout=timeout,poll_interval=poll_interval))
+	
+	@_instrumented
+	def getByView(self,view_property=None,view_name=None,design_document_id=None,**kwargs):
+		
+		return self._include(list(self.iterByView(view_property,view_name,design_document_id,**kwargs)),kwargs.get("include"))
+	
+	# Yields the documents of a view query across the shards in key order, fetching each shard's rows a page at a time
+	def iterByView(self,view_property=None,view_name=None,design_document_id=None,**kwargs):
+		
+		for key in ["group","group_level","reduce"]:
+			if kwargs.get(key):
+				raise Exception("Reduce queries can't be merged across shards")
+		
+		skip = kwargs.pop("skip",None) or 0
+		limit = kwargs.pop("limit",None)
+		
+		# Each shard could hold all of the wanted rows
+		shard_limit = skip + limit if limit else None
+		
+		iterators = [self._iterViewRows(database,dict(kwargs,view_property=view_property,view_name=view_name,design_document_id=design_document_id),shard_limit) for database in self._databases]
+		
+		rows = _mergeSorted(iterators,lambda item: (_collationKey(item[1]["key"]),item[1]["id"]),kwargs.get("descending",False),self._database_session)
+		
+		for (database,row) in itertools.islice(rows,skip,skip + limit if limit else None):
+			yield database._processViewResponse({"rows" : [row]},**kwargs)[0]
+	
+	# Yields a shard's view rows, paging by the last key and document id
+	def _iterViewRows(self,database,view_kwargs,limit):
+		
+		kwargs = dict(view_kwargs)
+		
+		# Multiple keys can't be paged
+		paging = "keys" not in kwargs
+		
+		if paging and "key" in kwargs:
+			kwargs["startkey"] = kwargs["endkey"] = kwargs.pop("key")
+		
+		first_page_kwargs = dict(kwargs)
+		fetched = 0
+		
+		while True:
+			
+			page_limit = (min(self._page_size,limit - fetched) if limit else self._page_size) if paging else limit
+			
+			rows = database._queryView(**dict(kwargs,limit=page_limit))["rows"]
+			
+			for row in rows:
+				yield (database,row)
+			
+			fetched += len(rows)
+			
+			if not paging or len(rows) < page_limit or (limit and fetched >= limit):
+				return
+			
+			# Continue after the last row, keys that aren't sent (falsy) fall back to skipping
+			if rows[-1]["key"]:
+				kwargs = dict(first_page_kwargs,startkey=rows[-1]["key"],startkey_docid=rows[-1]["id"],skip=1)
+			else:
+				kwargs = dict(first_page_kwargs,skip=fetched)
+	
+	@_instrumented
+	def getByIndex(self,index_property,**kwargs):
+		
+		if self.getIndexBackend() == "mango":
+			return self._getByMangoIndex(index_property,**kwargs)
+		
+		return self._include(list(self.iterByView(**_getIndexViewArgs(index_property,kwargs))),kwargs.get("include"))
+	
+	def _getByMangoIndex(self,index_property,key=None,keys=None,startkey=None,endkey=None,limit=None,skip=None,descending=False,bookmark=None,fields=None,as_json=False,stale=None,partition=None,include=None,**kwargs):
+		
+		(selector,sort,use_index) = _getMangoIndexQuery(index_property,key,keys,startkey,endkey,descending)
+		
+		return self.find(selector,fields=fields,sort=sort,limit=limit,skip=skip,bookmark=bookmark,use_index=use_index,as_json=as_json,stale=stale,partition=partition,include=include)
+	
+	# Queries every shard, merging the results by the sort
+	@_instrumented
+	def find(self,selector,fields=None,sort=None,limit=None,skip=None,bookmark=None,use_index=None,as_json=False,stale=None,partition=None,include=None):
+		
+		if bookmark:
+			raise Exception("Bookmarks can't be used across shards, use skip and limit")
+		
+		skip = skip or 0
+		shard_limit = skip + limit if limit is not None else None
+		
+		# Merge the json then inflate (fields must include the sort fields)
+		results = self._scatter("find",selector,fields=fields,sort=sort,limit=shard_limit,use_index=use_index,as_json=True,stale=stale,partition=partition)
+		
+		iterators = [iter([(database,document_data) for document_data in shard_results]) for (database,shard_results) in zip(self._databases,results)]
+		
+		sort_fields = [sort_field.keys()[0] if isinstance(sort_field,dict) else sort_field for sort_field in (sort or [])]
+		descending = bool(sort) and isinstance(sort[0],dict) and sort[0].values()[0] == "desc"
+		
+		documents = _mergeSorted(iterators,lambda item: [_collationKey(_getDocumentPath(item[1],sort_field)) for sort_field in sort_fields],descending,parallel=False)
+		
+		documents = [document_data if (as_json or fields) else database._createDocument(document_data) for (database,document_data) in itertools.islice(documents,skip,skip + limit if limit is not None else None)]
+		
+		return FindResults(self._include(documents,include))
+
+
+class SchemaMigration(object):
+	"""
+	Upgrades the documents saved with older schema versions to the current version using the migrations registered with @migration.
+	Old documents are streamed a page at a time from the _design/_migration view, upgraded and validated by a pool of worker threads
+	and written back with chunked _bulk_docs. Progress is checkpointed in a _local document so a stopped migration resumes where it
+	left off, and max_rate throttles it so it can run as a background job against a live database.
+	"""
+	def __init__(self,database,document_classes=None,batch_size=500,workers=4,max_rate=None,checkpoint=True):
+		"""
+		Args:
+			database (Database): The (synced) database to migrate
+		
+		Kwargs:
+			document_classes (list): Document classes to migrate, defaults to those with registered migrations
+			batch_size (int): Documents read and written per _bulk_docs request
+			workers (int): Batches upgraded and written in parallel
+			max_rate (float): Maximum documents per second
+			checkpoint (bool): Save progress to (and resume from) a _local document
+		"""
+		if document_classes is None:
+			document_classes = [document_class for document_class in BaseDocument.type_class_map.values() if issubclass(document_class,Document) and document_class.hasMigrations()]
+		
+		self._database = database
+		self._document_classes = sorted(document_classes,key=lambda document_class: document_class.__name__.lower())
+		self._batch_size = batch_size
+		self._workers = workers
+		self._max_rate = max_rate
+		self._checkpoint = checkpoint
+		
+		self._lock = threading.Lock()
+		self._progress = {}
+		self._stopped = False
+	
+	# Migrate every document class, returning a report keyed by type
+	def run(self,dry_run=False,resume=True):
+		"""
+		Kwargs:
+			dry_run (bool): Upgrade and validate the documents without writing them, to report the throughput and failures
+			resume (bool): Continue from the checkpoint of a previous run (documents that failed then aren't retried)
+		
+		Returns:
+			dict: Keyed by type, the to_version, documents scanned, migrated (or would be when a dry run) and failed, the ids of the
+			first failures, the elapsed seconds and documents per second
+		"""
+		self._stopped = False
+		
+		self._syncDesignDocument()
+		
+		for document_class in self._document_classes:
+			
+			if self._stopped:
+				break
+			
+			self._migrateClass(document_class,dry_run,resume)
+		
+		return self.getProgress()
+	
+	# Create (or update) the migration view, which sync() leaves out
+	def _syncDesignDocument(self):
+		
+		design_document = _MigrationDesignDocument()
+		
+		# Global so it finds documents of every partition
+		if self._database.isPartitioned():
+			design_document.setPartitioned(False)
+		
+		try:
+			saved_design_document_json = self._database.get(design_document._id,as_json=True)
+		except Exception:
+			saved_design_document_json = None
+		
+		if saved_design_document_json is None:
+			self._database.add(design_document)
+		else:
+			design_document._rev = saved_design_document_json["_rev"]
+			
+			if design_document.instanceToDict() != saved_design_document_json:
+				self._database.update(design_document)
+	
+	# Run on a background thread
+	def start(self,dry_run=False,resume=True):
+		"""
+		Returns:
+			BackgroundTask: The (started) migration task
+		"""
+		task = BackgroundTask(self.run,dry_run,resume)
+		task.start()
+		
+		return task
+	
+	# Stop after the batches being written
+	def stop(self):
+		
+		self._stopped = True
+	
+	# Get the report so far
+	def getProgress(self):
+		
+		with self._lock:
+			return copy.deepcopy(self._progress)
+	
+	# Returns the id of the _local document holding a document class's checkpoint
+	def _getCheckpointId(self,document_class):
+		
+		return "_local/ormchair_migration_%s" % (document_class.__name__.lower())
+	
+	# Get the saved checkpoint of a document class (None if there isn't one)
+	def getCheckpoint(self,document_class):
+		
+		try:
+			return self._database.get(self._getCheckpointId(document_class),as_json=True)
+		except Exception:
+			return None
+	
+	# Remove the checkpoint so the next run starts from the beginning
+	def resetCheckpoint(self,document_class):
+		
+		checkpoint = self.getCheckpoint(document_class)
+		
+		if checkpoint is not None:
+			
+			r = self._database._database_session.delete("%s%s" % (self._database.getUrl(),checkpoint["_id"]),params={"rev" : checkpoint["_rev"]})
+			
+			if r.status_code != 200:
+				raise Exception(self._database._database_session.decode(r))
+	
+	def _saveCheckpoint(self,document_class,checkpoint):
+		
+		r = self._database._database_session.put("%s%s" % (self._database.getUrl(),checkpoint["_id"]),data=self._database._database_session.encode(checkpoint))
+		
+		if r.status_code != 201:
+			raise Exception(self._database._database_session.decode(r))
+		
+		checkpoint["_rev"] = self._database._database_session.decode(r)["rev"]
+	
+	def _migrateClass(self,document_class,dry_run,resume):
+		
+		type_ = document_class.__name__.lower()
+		to_version = document_class.getCurrentSchemaVersion()
+		
+		if to_version is None:
+			raise MigrationError("Schema version of %s unknown, sync the database first" % (type_))
+		
+		checkpoint = None
+		cursor = None
+		
+		if self._checkpoint and not dry_run:
+			
+			checkpoint = self.getCheckpoint(document_class) or {"_id" : self._getCheckpointId(document_class)}
+			
+			# Only resume a migration to the same version
+			if resume and checkpoint.get("to_version") == to_version:
+				cursor = (checkpoint["startkey"],checkpoint["startkey_docid"])
+			
+			checkpoint["to_version"] = to_version
+		
+		progress = {"to_version" : to_version, "scanned" : 0, "migrated" : 0, "failed" : 0, "failed_ids" : [], "elapsed" : 0, "documents_per_second" : 0, "dry_run" : dry_run}
+		
+		with self._lock:
+			self._progress[type_] = progress
+		
+		start = time.time()
+		exhausted = False
+		
+		while not (exhausted or self._stopped):
+			
+			# Pages are read in turn (each starts after the last) then upgraded and written in parallel
+			pages = []
+			
+			while len(pages) < self._workers:
+				
+				rows = self._readPage(type_,to_version,cursor)
+				
+				if len(rows) > 0:
+					pages.append(rows)
+					cursor = (rows[-1]["key"],rows[-1]["id"])
+				
+				if len(rows) < self._batch_size:
+					exhausted = True
+					break
+			
+			if len(pages) == 0:
+				break
+			
+			results = _runParallel([_inCurrentContext(self._database._database_session)(functools.partial(self._migrateBatch,document_class,rows,dry_run)) for rows in pages])
+			
+			with self._lock:
+				
+				for (scanned,migrated,failed_ids) in results:
+					
+					progress["scanned"] += scanned
+					progress["migrated"] += migrated
+					progress["failed"] += len(failed_ids)
+					progress["failed_ids"].extend(failed_ids[:max(100 - len(progress["failed_ids"]),0)])
+				
+				progress["elapsed"] = time.time() - start
+				progress["documents_per_second"] = progress["scanned"] / progress["elapsed"] if progress["elapsed"] > 0 else 0
+			
+			if checkpoint is not None:
+				
+				(checkpoint["startkey"],checkpoint["startkey_docid"]) = cursor
+				self._saveCheckpoint(document_class,checkpoint)
+			
+			# Throttle to max_rate documents per second
+			if self._max_rate:
+				
+				delay = progress["scanned"] / float(self._max_rate) - (time.time() - start)
+				
+				if delay > 0:
+					time.sleep(delay)
+		
+		return progress
+	
+	# Read the next page of a type's documents saved with older schema versions (null versions can't be migrated so are left)
+	def _readPage(self,type_,to_version,cursor):
+		
+		kwargs = {"startkey" : [type_,0], "endkey" : [type_,to_version - 1], "limit" : self._batch_size, "stale" : False}
+		
+		# Migrated documents drop out of the view so the last row is only skipped if it's still there e.g. it failed
+		if cursor is not None:
+			kwargs.update({"startkey" : cursor[0], "startkey_docid" : cursor[1], "limit" : self._batch_size + 1})
+		
+		rows = self._database._queryView(view_name="by_schema_version",design_document_id=_MigrationDesignDocument.getFixedId(),**kwargs)["rows"]
+		
+		if cursor is not None and len(rows) > 0 and (rows[0]["key"],rows[0]["id"]) == cursor:
+			rows = rows[1:]
+		
+		return rows[:self._batch_size]
+	
+	# Upgrade, validate and write a page of documents, returning the number scanned, migrated and the ids that failed
+	def _migrateBatch(self,document_class,rows,dry_run):
+		
+		documents = []
+		failed_ids = []
+		
+		for row in rows:
+			
+			# Deleted since the view was read
+			if row.get("doc") is None:
+				continue
+			
+			try:
+				documents.append(document_class(document_data=document_class.migrateDocumentData(row["doc"])))
+			except Exception:
+				failed_ids.append(row["id"])
+		
+		migrated = len(documents)
+		
+		if len(documents) > 0 and not dry_run:
+			
+			(ok_documents,failed_documents) = self._database.updateMultiple(documents)
+			
+			migrated = len(ok_documents)
+			failed_ids.extend([document._id for document in failed_documents])
+		
+		if not dry_run:
+			
+			metrics = self._database._database_session.metrics
+			metrics.incrementCounter("ormchair_migrated_documents_total",migrated,labels={"type" : document_class.__name__.lower(), "status" : "ok"})
+			metrics.incrementCounter("ormchair_migrated_documents_total",len(failed_ids),labels={"type" : document_class.__name__.lower(), "status" : "failed"})
+		
+		return (len(rows),migrated,failed_ids)
+
+
+class MigrationWriteBack(object):
+	"""
+	Writes documents that a Database upgraded on read back in batches on a background thread, so the cost of a migration is spread over
+	normal traffic. A document is only written once however often it's read before the batch is flushed, and documents changed since
+	they were read conflict and are skipped (whoever changed them saved the current version). close() (or Database.close()) writes 
+	what's pending and stops the thread, and is called at exit.
+	"""
+	def __init__(self,batch_size=100,flush_interval=1.0,max_pending=10000):
+		"""
+		Kwargs:
+			batch_size (int): Documents written per _bulk_docs request
+			flush_interval (float): Maximum seconds an upgraded document waits to be written
+			max_pending (int): Upgraded documents waiting to be written beyond this are dropped (they're upgraded again when next read)
+		"""
+		self._batch_size = batch_size
+		self._flush_interval = flush_interval
+		self._max_pending = max_pending
+		
+		self._database = None
+		self._condition = threading.Condition()
+		self._pending = collections.OrderedDict()
+		self._thread = None
+		self._closed = False
+		
+		self._stats = {"queued" : 0, "written" : 0, "conflicts" : 0, "dropped" : 0, "errors" : 0}
+	
+	def setDatabase(self,database):
+		
+		self._database = database
+	
+	# Queue an upgraded document's json to be written
+	def add(self,document_class,document_data):
+		
+		with self._condition:
+			
+			if self._closed or (document_data["_id"] not in self._pending and len(self._pending) >= self._max_pending):
+				self._stats["dropped"] += 1
+				return
+			
+			self._pending[document_data["_id"]] = (document_class,document_data)
+			self._stats["queued"] += 1
+			
+			if self._thread is None:
+				
+				self._thread = threading.Thread(target=self._run)
+				self._thread.daemon = True
+				self._thread.start()
+				
+				# Don't lose what's pending when the process exits
+				atexit.register(self.close)
+			
+			if len(self._pending) >= self._batch_size:
+				self._condition.notify()
+	
+	# Get the number of documents waiting to be written
+	def getPendingCount(self):
+		
+		with self._condition:
+			return len(self._pending)
+	
+	def getStats(self):
+		
+		with self._condition:
+			return dict(self._stats,pending=len(self._pending))
+	
+	# Write everything that's pending now
+	def flush(self):
+		
+		while self._writeBatch():
+			pass
+	
+	# Write what's pending and stop the background thread (documents upgraded afterwards aren't written back)
+	def close(self,timeout=None):
+		
+		with self._condition:
+			
+			if self._closed:
+				return
+			
+			self._closed = True
+			self._condition.notify()
+		
+		if self._thread is not None:
+			self._thread.join(timeout)
+		
+		self.flush()
+	
+	def _run(self):
+		
+		while True:
+			
+			with self._condition:
+				
+				if self._closed:
+					return
+				
+				if len(self._pending) < self._batch_size:
+					self._condition.wait(self._flush_interval)
+			
+			self.flush()
+	
+	# Write the next batch, returning False when nothing was pending
+	def _writeBatch(self):
+		
+		with self._condition:
+			
+			batch = []
+			while len(self._pending) > 0 and len(batch) < self._batch_size:
+				batch.append(self._pending.popitem(last=False)[1])
+		
+		if len(batch) == 0:
+			return False
+		
+		try:
+			
+			(ok_documents,failed_documents) = self._database.updateMultiple([document_class(document_data=document_data) for (document_class,document_data) in batch])
+			
+			with self._condition:
+				self._stats["written"] += len(ok_documents)
+				self._stats["conflicts"] += len(failed_documents)
+			
+			metrics = self._database._database_session.metrics
+			metrics.incrementCounter("ormchair_migration_write_backs_total",len(ok_documents),labels={"status" : "ok"})
+			metrics.incrementCounter("ormchair_migration_write_backs_total",len(failed_documents),labels={"status" : "conflict"})
+		
+		except Exception:
+			
+			# The documents are upgraded again when next read
+			logging.getLogger("ormchair").warning("Couldn't write back %d migrated documents",len(batch),exc_info=True)
+			
+			with self._condition:
+				self._stats["errors"] += len(batch)
+		
+		return True
+
+
+# Parses include property paths e.g. ["author.company","reviewers"] into a tree {"author" : {"company" : {}}, "reviewers" : {}}
+def _getIncludeTree(include):
+	
+	if isinstance(include,basestring):
+		include = [include]
+	
+	include_tree = {}
+	
+	for property_path in include:
+		
+		node = include_tree
+		for property_name in property_path.split("."):
+			node = node.setdefault(property_name,{})
+	
+	return include_tree
+
+# Collects the (EmbeddedLinkProperty, EmbeddedLink, include subtree) that an include tree reaches from a schema instance, through its
+# dict and list properties
+def _collectEmbeddedLinks(instance,include_tree,embedded_links):
+	
+	for (property_name,include_subtree) in include_tree.iteritems():
+		
+		schema_property = getattr(instance.__class__,property_name,None)
+		
+		if isinstance(schema_property,EmbeddedLinkProperty):
+			
+			schema_property._checkForPropertyValue(instance)
+			embedded_links.append((schema_property,instance._property_values[property_name],include_subtree))
+		
+		elif isinstance(schema_property,DictProperty):
+			
+			_collectEmbeddedLinks(getattr(instance,property_name),include_subtree,embedded_links)
+		
+		elif isinstance(schema_property,ListProperty):
+			
+			# Each item is a schema instance with the item value in _property
+			for list_instance in list.__iter__(getattr(instance,property_name)):
+				_collectEmbeddedLinks(list_instance,{"_property" : include_subtree},embedded_links)
+		
+		else:
+			raise PropertyPathNotFoundError("%s of %s isn't an embedded link, dict or list property" % (property_name,instance.__class__.__name__))
+
+# Inflates the embedded links at the include paths of documents, a level of the paths at a time, with each level's linked documents
+# fetched by one (chunked) getMultiple of their unique ids
+def _loadEmbeddedLinks(database,documents,include,chunk_size):
+	
+	include_tree = _getIncludeTree(include)
+	level = [(document,include_tree) for document in documents if isinstance(document,BaseDocument)]
+	
+	# Linked documents by id, so a document linked to more than once is fetched and inflated once
+	linked_documents = {}
+	
+	while len(level) > 0:
+		
+		embedded_links = []
+		for (instance,include_subtree) in level:
+			_collectEmbeddedLinks(instance,include_subtree,embedded_links)
+		
+		for (embedded_link_property,embedded_link,include_subtree) in embedded_links:
+			if embedded_link._inflated:
+				linked_documents.setdefault(embedded_link._id,embedded_link._document)
+		
+		_ids = []
+		for (embedded_link_property,embedded_link,include_subtree) in embedded_links:
+			if embedded_link._id and embedded_link._id not in linked_documents:
+				linked_documents[embedded_link._id] = None
+				_ids.append(embedded_link._id)
+		
+		for i in range(0,len(_ids),chunk_size):
+			for document in database.getMultiple(_ids[i:i + chunk_size]):
+				if isinstance(document,BaseDocument):
+					linked_documents[document._id] = document
+		
+		level = []
+		for (embedded_link_property,embedded_link,include_subtree) in embedded_links:
+			
+			document = linked_documents.get(embedded_link._id)
+			
+			# Missing and unbound documents are left as ids
+			if not embedded_link._inflated and isinstance(document,embedded_link_property.getLinkedClass()):
+				embedded_link._document = document
+				embedded_link._inflated = True
+			
+			if embedded_link._inflated and include_subtree:
+				level.append((embedded_link._document,include_subtree))
+
+
+# The include path of an embedded link from a schema instance e.g. "meta.editor" or "reviewers" (None if it isn't under the instance)
+def _getEmbeddedLinkPath(instance,embedded_link):
+	
+	for (property_name,property_value) in instance._property_values.iteritems():
+		
+		if property_value is embedded_link:
+			return property_name
+		
+		schema_property = getattr(instance.__class__,property_name,None)
+		
+		if isinstance(schema_property,DictProperty):
+			
+			property_path = _getEmbeddedLinkPath(property_value,embedded_link)
+			if property_path is not None:
+				return "%s.%s" % (property_name,property_path)
+		
+		elif isinstance(schema_property,ListProperty):
+			
+			# Each item is a schema instance with the item value in _property, which isn't part of the path
+			for list_instance in list.__iter__(property_value):
+				
+				property_path = _getEmbeddedLinkPath(list_instance,embedded_link)
+				if property_path is not None:
+					return ".".join([property_name] + property_path.split(".")[1:])
+	
+	return None
+
+
+class EmbeddedLinkProxy(object):
+	"""
+	Returned for an embedded link that isn't inflated when it's read in a loader scope. Reading any attribute but _id loads the linked 
+	document, along with every other link waiting in the scope, and is then passed through to it.
+	"""
+	__slots__ = ("_loader","_embedded_link_property","_embedded_link")
+	
+	def __init__(self,loader,embedded_link_property,embedded_link):
+		
+		object.__setattr__(self,"_loader",loader)
+		object.__setattr__(self,"_embedded_link_property",embedded_link_property)
+		object.__setattr__(self,"_embedded_link",embedded_link)
+	
+	@property
+	def _id(self):
+		
+		return self._embedded_link._id
+	
+	# Get the linked document, loading it if needed (None if it doesn't exist)
+	def getDocument(self):
+		
+		return self._loader._resolve(self._embedded_link_property,self._embedded_link)
+	
+	def _getDocumentOrRaise(self):
+		
+		document = self.getDocument()
+		
+		if document is None:
+			raise LinkedDocumentNotFoundError("Linked %s %s not found" % (self._embedded_link_property.getLinkedClass().__name__,self._id))
+		
+		return document
+	
+	def __getattr__(self,name):
+		
+		return getattr(self._getDocumentOrRaise(),name)
+	
+	def __setattr__(self,name,value):
+		
+		setattr(self._getDocumentOrRaise(),name,value)
+	
+	# Compares as the linked document's id so code written against ids still works
+	def __eq__(self,other):
+		
+		if isinstance(other,(BaseDocument,EmbeddedLinkProxy)):
+			return self._id == other._id
+		
+		return self._id == other
+	
+	def __ne__(self,other):
+		
+		return not self.__eq__(other)
+	
+	def __hash__(self):
+		
+		return hash(self._id)
+	
+	def __nonzero__(self):
+		
+		return True
+	
+	def __repr__(self):
+		
+		return "<EmbeddedLinkProxy %s %s>" % (self._embedded_link_property.getLinkedClass().__name__,self._id)
+
+
+class EmbeddedLinkLoader(object):
+	"""
+	A scope (use via database.loader()) in which reading an embedded link that isn't inflated returns an EmbeddedLinkProxy. Links read
+	in the scope wait until a proxy is first dereferenced (or dispatch is called) and are then loaded with one (chunked) getMultiple. 
+	Reading a link of a document also queues the same link of the documents returned with it by the same Database call, so traversing 
+	them takes a request per level. Documents are memoized by id for the life of the scope.
+	"""
+	def __init__(self,database,chunk_size=500):
+		
+		self._database = database
+		self._chunk_size = chunk_size
+		
+		self._lock = threading.RLock()
+		
+		# Loaded documents by id (None if missing)
+		self._documents = {}
+		
+		# (EmbeddedLinkProperty, EmbeddedLink) waiting to be loaded
+		self._pending = []
+		
+		# The documents returned together by a Database call, by id() of each document, and the link paths queued across them
+		self._batches = {}
+		self._queued_paths = set()
+		
+		self._stats = {"requests" : 0, "loaded" : 0, "missing" : 0}
+		
+		self._previous_loader = None
+	
+	def __enter__(self):
+		
+		self._previous_loader = getattr(_operation_context,"loader",None)
+		_operation_context.loader = self
+		
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		
+		_operation_context.loader = self._previous_loader
+		
+		return False
+	
+	def getDatabase(self):
+		
+		return self._database
+	
+	# Get the number of links waiting to be loaded
+	def getPendingCount(self):
+		
+		with self._lock:
+			return len(self._pending)
+	
+	# Get the number of getMultiple requests made, documents loaded and ids not found
+	def getStats(self):
+		
+		with self._lock:
+			return dict(self._stats)
+	
+	# Memoize documents and record that they were returned together
+	def addDocuments(self,documents):
+		
+		batch = [document for document in documents if isinstance(document,BaseDocument)]
+		
+		with self._lock:
 			
-		# A view property as defined on a Document or DesignDocument
-		if view_property:
+			for document in batch:
+				self._documents.setdefault(document._id,document)
+				self._batches[id(document)] = batch
+	
+	# Load every link waiting in the scope
+	def dispatch(self):
 		
-			# Get the parent class containing the property
-			view_parent_class = view_property.getParent()
+		with self._lock:
 			
-			# What type of view property is this a) On a Document class, b) On a Design Document class
-			if issubclass(view_parent_class, DesignDocument):
+			pending = self._pending
+			self._pending = []
+			
+			_ids = []
+			unique_ids = set()
+			for (embedded_link_property,embedded_link) in pending:
+				if embedded_link._id not in self._documents and embedded_link._id not in unique_ids:
+					unique_ids.add(embedded_link._id)
+					_ids.append(embedded_link._id)
+			
+			loaded = []
+			for i in range(0,len(_ids),self._chunk_size):
 				
-				# Check for id arg
-				if not (view_parent_class.hasFixedId() or design_document_id):
-					raise Exception("Design document doesn't have a fixed id and design document id missing in args")
-				elif view_parent_class.hasFixedId():
-					design_document_id = view_parent_class.getFixedId()
+				self._stats["requests"] += 1
+				
+				for document in self._database.getMultiple(_ids[i:i + self._chunk_size]):
+					if isinstance(document,BaseDocument):
+						loaded.append(document)
+			
+			self.addDocuments(loaded)
+			
+			for _id in _ids:
+				self._documents.setdefault(_id,None)
+			
+			self._stats["loaded"] += len(loaded)
+			self._stats["missing"] += len(_ids) - len(loaded)
+			
+			for (embedded_link_property,embedded_link) in pending:
+				self._inflate(embedded_link_property,embedded_link)
 	
-				# Set the views url
-				url = "%s%s/_view/%s" % (self._database_url, design_document_id, view_property.getName())
+	# Called by EmbeddedLinkProperty for a link that isn't inflated, returns the linked document if memoized else a proxy
+	def _getLinkedDocument(self,embedded_link_property,instance,embedded_link):
+		
+		with self._lock:
+			
+			if embedded_link._id in self._documents:
 				
+				if self._inflate(embedded_link_property,embedded_link):
+					return embedded_link._document
+			
 			else:
+				
+				self._pending.append((embedded_link_property,embedded_link))
+				self._queueBatchLinks(embedded_link_property,instance,embedded_link)
+		
+		return EmbeddedLinkProxy(self,embedded_link_property,embedded_link)
 	
-				url = "%s%s/_view/%s" % (self._database_url, view_parent_class.getSchemaDesignDocumentId(), view_property.getName())
+	# Queue the link at the same path of the documents returned with this link's document
+	def _queueBatchLinks(self,embedded_link_property,instance,embedded_link):
 		
-		# Direct access to the view
-		elif view_name and design_document_id:
-			
-			url = "%s%s/_view/%s" % (self._database_url, design_document_id, view_name)
+		root_instance = instance.getRootInstance()
+		batch = self._batches.get(id(root_instance))
 		
-		else:
-			
-			raise Exception("View property or view name and design document id missing in args")
+		if batch is None:
+			return
 		
-		# Response type
-		headers = {"content-type": "application/json"}	
+		property_path = embedded_link_property.getName() if instance is root_instance else _getEmbeddedLinkPath(root_instance,embedded_link)
 		
-		# The params on the url (only include docs if not a reduce)
-		params = {}
-		if not ("group" in kwargs or "reduce" in kwargs or "include_docs" in kwargs):
-			params["include_docs"] = True
-			
-		for optional_param_arg in ["key","limit","skip","startkey_docid","endkey_docid","descending","group","group_level"]:
-			if optional_param_arg in kwargs and kwargs[optional_param_arg]:
-				params[optional_param_arg] = json.dumps(kwargs[optional_param_arg])
+		if property_path is None or (id(batch),property_path) in self._queued_paths:
+			return
 		
-		# The data in the post body
-		data = {}
-		for optional_data_arg in ["keys","startkey","endkey"]:
-			if optional_data_arg in kwargs and kwargs[optional_data_arg]:
-				data[optional_data_arg] = kwargs[optional_data_arg]
-				
-		# Do the post
-		r = self._database_session.post(url, headers=headers,params=params, data=json.dumps(data))
-	
-		if r.status_code == 200:
-			
-			return self._processViewResponse(r.json(),**kwargs)
+		self._queued_paths.add((id(batch),property_path))
 		
-		else:
-
-			raise Exception(r.json())
+		include_tree = _getIncludeTree(property_path)
+		
+		for document in batch:
+			
+			embedded_links = []
+			
+			# Documents of other classes may not have the path
+			try:
+				_collectEmbeddedLinks(document,include_tree,embedded_links)
+			except PropertyPathNotFoundError:
+				continue
+			
+			for (batch_embedded_link_property,batch_embedded_link,include_subtree) in embedded_links:
+				if not batch_embedded_link._inflated and batch_embedded_link._id and batch_embedded_link._id not in self._documents:
+					self._pending.append((batch_embedded_link_property,batch_embedded_link))
 	
-	# Gets the documents by index
-	def getByIndex(self,index_property,**kwargs):
+	# Inflate a link from the memoized documents, returns whether it's inflated
+	def _inflate(self,embedded_link_property,embedded_link):
 		
-		# Get the parent document class from the property
-		document_class = index_property.getParent()
+		document = self._documents.get(embedded_link._id)
 		
-		# Must prefix the passed in key with the indexes name (multiple values)
-		if "keys" in kwargs:
-			new_keys = []
-			for key in kwargs["keys"]:
-				if not isinstance(key,list):
-					key = [key]
-				key.insert(0,index_property.getName())
-				new_keys.append(key)
-			kwargs["keys"] = new_keys
-			
-		# Must prefix the passed in key with the indexes name (single value)
-		for key_arg in ["key","startkey","endkey"]:
+		if not embedded_link._inflated and isinstance(document,embedded_link_property.getLinkedClass()):
+			embedded_link._document = document
+			embedded_link._inflated = True
+		
+		return embedded_link._inflated
+	
+	# Get the linked document of a proxy, loading the links waiting in the scope if needed
+	def _resolve(self,embedded_link_property,embedded_link):
+		
+		with self._lock:
 			
-			# If key, startkey or endkey then put into a list
-			if key_arg in kwargs and not isinstance(kwargs[key_arg],list):
-				kwargs[key_arg] = [kwargs[key_arg]]
+			if embedded_link._id not in self._documents:
 				
-			if key_arg in kwargs:
-				kwargs[key_arg].insert(0,index_property.getName())
+				# The link may have been given another id since the proxy was returned
+				if (embedded_link_property,embedded_link) not in self._pending:
+					self._pending.append((embedded_link_property,embedded_link))
+				
+				self.dispatch()
+			
+			if self._inflate(embedded_link_property,embedded_link):
+				return embedded_link._document
 			
-		return self.getByView(view_name="indexes_", design_document_id=document_class.getSchemaDesignDocumentId(),**kwargs)
+			return None
+
+
+# The value at a property path of a document's json (None if missing)
+def _getDocumentPath(document_data,property_path):
 	
+	for property_name in property_path.split("."):
+		
+		if not isinstance(document_data,dict):
+			return None
 		
+		document_data = document_data.get(property_name)
+	
+	return document_data
+
+# Is this a getMultiple row for a missing document
+def _isNotFoundRow(document):
+	
+	return isinstance(document,dict) and "error" in document and "key" in document
+
 
 class Index(object):
 	"""
@@ -1650,6 +5900,7 @@ class Index(object):
 	"""
 	# args is a list of paths e.g. "address.address_1","name"
 	def __init__(self,*args):
+		self._fields = tuple(args)
 		self._property_paths = tuple(["doc." + property_path for property_path in args])
 
 	def setName(self,name):
@@ -1672,6 +5923,111 @@ class Index(object):
 		emit_string = "emit([" + mask_string + "],doc);"
 		
 		return emit_string % emit_keys
+	
+	# Get the property paths that make up the index
+	def getFields(self):
+		
+		return self._fields
+	
+	# Create the mango (_index) definition used instead of the map function by the mango index backend
+	def getMangoIndexDefinition(self):
+		
+		return {
+			"index" : {
+				"fields" : ["type_"] + list(self._fields)
+			},
+			"ddoc" : self._parent.getMangoDesignDocumentId().split("/",1)[1],
+			"name" : self._name,
+			"type" : "json"
+		}
+	
+	# Create a mango selector from view style key args e.g. key, keys, startkey and endkey
+	def getMangoSelector(self,key=None,keys=None,startkey=None,endkey=None):
+		
+		selector = {"type_" : self._parent.__name__.lower()}
+		
+		def as_list(value):
+			return value if isinstance(value,list) else [value]
+		
+		if keys is not None:
+			
+			selector["$or"] = [dict(zip(self._fields,as_list(key_values))) for key_values in keys]
+		
+		elif key is not None:
+			
+			selector.update(zip(self._fields,as_list(key)))
+		
+		elif startkey is not None or endkey is not None:
+			
+			startkey = as_list(startkey)[:len(self._fields)] if startkey is not None else []
+			endkey = as_list(endkey)[:len(self._fields)] if endkey is not None else None
+			
+			# Equal leading values become equality conditions (except the last of a shorter endkey, which keys sort after)
+			position = 0
+			while endkey is not None and position < min(len(startkey),len(endkey)) and startkey[position] == endkey[position] and not position + 1 == len(endkey) < len(self._fields):
+				selector[self._fields[position]] = startkey[position]
+				position += 1
+			
+			# The rest of the keys are compared in order like the view, so a later field is only bounded when the earlier are equal
+			conditions = [condition for condition in [self._getLowerBound(startkey,position),self._getUpperBound(endkey,position)] if condition is not None]
+			
+			if len(conditions) == 1:
+				selector.update(conditions[0])
+			elif len(conditions) > 1:
+				selector["$and"] = conditions
+		
+		# Every index field must be in the selector for couchdb to use the index
+		for field in self._fields:
+			if field not in selector:
+				selector[field] = {"$exists" : True}
+		
+		return selector
+	
+	# Selector for the keys from the startkey's position on that are at least the startkey (None if they all are)
+	def _getLowerBound(self,startkey,position):
+		
+		if position >= len(startkey):
+			return None
+		
+		field = self._fields[position]
+		rest = self._getLowerBound(startkey,position + 1)
+		
+		if rest is None:
+			return {field : {"$gte" : startkey[position]}}
+		
+		return {"$or" : [{field : {"$gt" : startkey[position]}},{"$and" : [{field : startkey[position]},rest]}]}
+	
+	# Selector for the keys from the endkey's position on that are at most the endkey (None if they all are). {} is higher than
+	# any value so bounds nothing, and keys longer than a shorter endkey sort after it
+	def _getUpperBound(self,endkey,position):
+		
+		if endkey is None or position >= len(endkey) or endkey[position] == {}:
+			return None
+		
+		field = self._fields[position]
+		
+		if position + 1 == len(self._fields):
+			return {field : {"$lte" : endkey[position]}}
+		
+		if position + 1 == len(endkey):
+			return {field : {"$lt" : endkey[position]}}
+		
+		rest = self._getUpperBound(endkey,position + 1)
+		
+		if rest is None:
+			return {field : {"$lte" : endkey[position]}}
+		
+		return {"$or" : [{field : {"$lt" : endkey[position]}},{"$and" : [{field : endkey[position]},rest]}]}
+
+
+class FindResults(list):
+	"""
+	The documents returned by a mango query along with the bookmark for fetching the next page
+	"""
+	def __init__(self,documents,bookmark=None):
+		
+		super(FindResults,self).__init__(documents)
+		self.bookmark = bookmark
 
 
 class View(object):
@@ -1755,6 +6111,32 @@ def _id(id):
 	return decorator
 
 
+def partitionKey(property_path):
+	"""
+	Decorator to partition a document class by a property e.g. @partitionKey("account_id") gives documents ids of the form account_id:docid, 
+	so in a partitioned database their indexes can be queried a partition (one shard) at a time
+	"""
+	def decorator(document_class):
+		document_class._partition_key = property_path
+		return document_class
+	return decorator
+
+
+def migration(document_class,from_version):
+	"""
+	Decorator to register a function that upgrades the json of a document class from schema version from_version to from_version + 1 e.g.
+	
+		@migration(Person,0)
+		def splitName(document_data):
+			(document_data["first_name"],document_data["last_name"]) = document_data.pop("name").split(" ",1)
+			return document_data
+	"""
+	def decorator(function):
+		document_class.addMigration(from_version,function)
+		return function
+	return decorator
+
+
 class BaseDocumentMetaClass(SchemaMetaClass):
 	""" 
 	Metaclass for basedocument
@@ -1792,6 +6174,9 @@ class BaseDocumentMetaClass(SchemaMetaClass):
 		# Set class property
 		base_document_class._views = _views
 		
+		# Properties stored as attachments
+		base_document_class._attachment_properties = [name for name in base_document_class._properties if isinstance(getattr(base_document_class,name),AttachmentProperty)]
+		
 		
 		return base_document_class
 
@@ -1815,6 +6200,12 @@ class BaseDocument(Schema):
 		
 		super(BaseDocument,self).__init__()
 		
+		# Attachment stubs (name -> content_type, length etc.), sent back with the document so updates keep the attachments
+		self._attachment_stubs = {}
+		
+		# The database the document was read from or saved to (used to fetch attachment properties)
+		self._database = None
+		
 		# Set the classname as the type if not got a default set
 		self.type_ = self.__class__.__name__.lower()
 		
@@ -1844,12 +6235,78 @@ class BaseDocument(Schema):
 		
 		# Loop over properties
 		for property_name in self._properties:
-			if not (property_name == "_rev" and self._rev == None):
+			if not (property_name == "_rev" and self._rev == None) and property_name not in self._attachment_properties:
 				
 				document_data[property_name] = getattr(self.__class__,property_name).instanceToDict(self)		
 		
+		attachments = copy.deepcopy(self._attachment_stubs)
+		
+		# Attachment properties send their content inline when changed
+		for property_name in self._attachment_properties:
+			
+			attachment = getattr(self.__class__,property_name).attachmentToDict(self)
+			
+			if attachment is None:
+				attachments.pop(property_name,None)
+			else:
+				attachments[property_name] = attachment
+		
+		if attachments:
+			document_data["_attachments"] = attachments
+		
 		return document_data
 	
+	# Set the values from a dict, keeping any attachment stubs
+	def instanceFromDict(self,dict_data,ignore_properties=None):
+		
+		if isinstance(dict_data,dict) and "_attachments" in dict_data:
+			
+			self._attachment_stubs = dict([(name,dict(attachment,stub=True)) for (name,attachment) in dict_data.pop("_attachments").iteritems() if "data" not in attachment])
+		
+		super(BaseDocument,self).instanceFromDict(dict_data,ignore_properties)
+		
+		# Attachment properties are loaded from their stubs on access
+		for property_name in self._attachment_properties:
+			self._property_values.pop(property_name,None)
+	
+	# Get the names of the document's attachments
+	def getAttachmentNames(self):
+		
+		return sorted(self._attachment_stubs.keys())
+	
+	def hasAttachment(self,name):
+		
+		return name in self._attachment_stubs
+	
+	# Get an attachment's stub (content_type, length etc.)
+	def getAttachmentStub(self,name):
+		
+		return self._attachment_stubs.get(name)
+	
+	def setAttachmentStub(self,name,stub):
+		
+		self._attachment_stubs[name] = stub
+	
+	def removeAttachmentStub(self,name):
+		
+		self._attachment_stubs.pop(name,None)
+	
+	# Called by the database once the document has been saved
+	def setSaved(self,database):
+		
+		self._database = database
+		
+		for property_name in self._attachment_properties:
+			getattr(self.__class__,property_name).setSaved(self)
+	
+	def getDatabase(self):
+		
+		return self._database
+	
+	def setDatabase(self,database):
+		
+		self._database = database
+	
 	def __eq__(self,other):
 		
 		return self.instanceToDict() == other.instanceToDict()
@@ -1859,6 +6316,47 @@ class BaseDocument(Schema):
 		
 		return not (self._rev == None)
 	
+	# Is the document class partitioned (by the @partitionKey decorator)
+	@classmethod
+	def hasPartitionKey(cls):
+		
+		return getattr(cls,"_partition_key",None) is not None
+	
+	# Get the property path the document class is partitioned by
+	@classmethod
+	def getPartitionKey(cls):
+		
+		return getattr(cls,"_partition_key",None)
+	
+	# Get the partition of the document (None if the class isn't partitioned)
+	def getPartition(self):
+		
+		if not self.hasPartitionKey():
+			return None
+		
+		# The partition is fixed once added (documents added before the class was partitioned aren't in one)
+		if self.hasBeenAdded():
+			return self._id.split(":",1)[0] if ":" in self._id else None
+		
+		(found,partition) = self.getPropertyValueByPath(self._partition_key)
+		
+		return unicode(partition) if found else None
+	
+	# Prefix the id with the partition, called before the document is first added
+	def setPartitionedId(self):
+		
+		if not self.hasPartitionKey() or self.hasBeenAdded():
+			return
+		
+		partition = self.getPartition()
+		
+		if not partition:
+			raise ValidationError("Partition key %s is missing" % (self._partition_key))
+		elif ":" in partition or partition.startswith("_"):
+			raise ValidationError("Partition %s can't contain : or start with _" % (partition))
+		
+		self._id = "%s:%s" % (partition,self._id.split(":",1)[-1])
+	
 	# Mark this document for delete
 	def setMarkedForDelete(self,marked_for_delete=True):
 		
@@ -1869,12 +6367,17 @@ class DesignDocument(BaseDocument):
 	"""
 	Base class that design document classes should extend
 	"""
+	# Whether sync() manages the design document (those only some databases need are created when used instead)
+	_synced = True
 
 	def __init__(self,document_data=None):
 		
 		# Used to store actual values of views (can't store in descriptor objects as they are static)
 		self._view_values = {}
 		
+		# Design document options e.g. partitioned
+		self._options = {}
+		
 		super(DesignDocument,self).__init__(document_data=document_data)
 		
 		# Use fixed id if set
@@ -1893,6 +6396,9 @@ class DesignDocument(BaseDocument):
 			
 			document_data["views"][view_name] = getattr(self,view_name)
 		
+		if self._options:
+			document_data["options"] = dict(self._options)
+		
 		return document_data
 	
 	# Set the values of the schema from a dict	
@@ -1914,6 +6420,8 @@ class DesignDocument(BaseDocument):
 			# Remove from dict for validation for extraneous properties
 			if "views" in dict_data:
 				del dict_data["views"]
+			
+			self._options = dict_data.pop("options",None) or {}
 		
 		super(DesignDocument,self).instanceFromDict(dict_data)
 	
@@ -1928,6 +6436,22 @@ class DesignDocument(BaseDocument):
 	def getFixedId(cls):
 		
 		return cls._fixed_id
+	
+	# Is the design document created by sync()
+	@classmethod
+	def isSynced(cls):
+		
+		return cls._synced
+	
+	# Set whether the views are partitioned (only in a partitioned database, their queries then need a partition)
+	def setPartitioned(self,partitioned):
+		
+		self._options["partitioned"] = partitioned
+	
+	# Are the views partitioned (None if not set, which in a partitioned database means they are)
+	def isPartitioned(self):
+		
+		return self._options.get("partitioned")
 					
 	
 	
@@ -2010,6 +6534,12 @@ class Document(BaseDocument):
 	# Static map to store the current version
 	_current_schema_version = {}
 	
+	# Static map of (type, from version) to migration function
+	_migrations = {}
+	
+	# Static map of (type, from version, to version) to composed migrations
+	_migration_chains = {}
+	
 	# Used to keep track of which schema version created this
 	schema_version_ = NumberProperty(required=True)
 	
@@ -2038,15 +6568,101 @@ class Document(BaseDocument):
 		
 		Document._current_schema_version[cls.__name__.lower()] = schema_version
 	
+	# Register a function that upgrades the json of this class from schema version from_version to from_version + 1
+	@classmethod
+	def addMigration(cls,from_version,function):
+		
+		Document._migrations[(cls.__name__.lower(),from_version)] = function
+		Document._migration_chains.clear()
+	
+	# Get the migration from a schema version (None if not registered)
+	@classmethod
+	def getMigration(cls,from_version):
+		
+		return Document._migrations.get((cls.__name__.lower(),from_version))
+	
+	@classmethod
+	def hasMigrations(cls):
+		
+		return any([type_ == cls.__name__.lower() for (type_,from_version) in Document._migrations])
+	
+	# Get a function that applies the migrations from a schema version to the current version (or to_version) in turn, None if any are
+	# missing. Chains are composed once per class and versions.
+	@classmethod
+	def getMigrationChain(cls,from_version,to_version=None):
+		
+		if to_version is None:
+			to_version = cls.getCurrentSchemaVersion()
+		
+		key = (cls.__name__.lower(),from_version,to_version)
+		
+		if key not in Document._migration_chains:
+			Document._migration_chains[key] = cls._composeMigrations(from_version,to_version)
+		
+		return Document._migration_chains[key]
+	
+	@classmethod
+	def _composeMigrations(cls,from_version,to_version):
+		
+		if from_version is None or to_version is None or from_version > to_version:
+			return None
+		
+		migrations = []
+		
+		for version in range(int(from_version),int(to_version)):
+			
+			migration = cls.getMigration(version)
+			
+			if migration is None:
+				return None
+			
+			migrations.append(migration)
+		
+		def migration_chain(document_data):
+			
+			for (version,migration) in enumerate(migrations,int(from_version) + 1):
+				document_data = migration(document_data)
+				document_data["schema_version_"] = version
+			
+			return document_data
+		
+		return migration_chain
+	
+	# Upgrade the json of an older schema version to the current version (or to_version) by applying the registered migrations in turn
+	@classmethod
+	def migrateDocumentData(cls,document_data,to_version=None):
+		
+		if to_version is None:
+			to_version = cls.getCurrentSchemaVersion()
+		
+		version = document_data.get("schema_version_")
+		
+		if version is None or to_version is None:
+			raise MigrationError("Schema version of %s unknown, sync the database first" % (cls.__name__.lower()))
+		
+		migration_chain = cls.getMigrationChain(version,to_version)
+		
+		if migration_chain is None:
+			raise MigrationError("No migrations from version %s to %s of %s" % (version,to_version,cls.__name__.lower()))
+		
+		# Migrations are passed a copy they can change
+		return migration_chain(copy.deepcopy(document_data))
+	
 	# Get the document id
 	@classmethod
 	def getSchemaDesignDocumentId(cls):
 		
 		return "_design/_schema_%s" % (cls.__name__.lower())
 	
-	# Schema design doc contains index and link views
+	# Get the id of the design document holding the mango indexes
+	@classmethod
+	def getMangoDesignDocumentId(cls):
+		
+		return "_design/_mango_%s" % (cls.__name__.lower())
+	
+	# Schema design doc contains index and link views (indexes can be left out when they are mango indexes)
 	@classmethod
-	def getSchemaDesignDocument(cls):
+	def getSchemaDesignDocument(cls,include_indexes=True):
 		
 		# Create an instance of the schema document
 		schema_design_document = cls._schema_design_document_class()
@@ -2058,7 +6674,7 @@ class Document(BaseDocument):
 		# Set the views
 		
 		# First the indexes
-		if len(cls._indexes):
+		if len(cls._indexes) and include_indexes:
 			
 			function_string = "function(doc){"
 			function_string += "if(doc.type_=='%s'){" % (cls.__name__.lower())
@@ -2119,6 +6735,27 @@ class _LinkDocument(Document):
 		self.indexes = getattr(self,"indexes",{})
 		self.reverse_indexes = getattr(self,"reverse_indexes",{})
 
+	# Deterministic id for the link between two documents (the same from either side of a reverse link), in a partitioned database the 
+	# link is stored in the partition of the first document of the link key
+	@classmethod
+	def getLinkDocumentId(cls,from_id,name,to_id,reverse_name=None,partitioned=False):
+		
+		link_key = (from_id,name,to_id)
+		
+		if reverse_name:
+			link_key = min(link_key,(to_id,reverse_name,from_id))
+		
+		link_document_id = "link_%s" % (hashlib.sha1(json.dumps(link_key)).hexdigest())
+		
+		if partitioned:
+			
+			if ":" not in link_key[0]:
+				raise ValidationError("Can't link %s in a partitioned database as it isn't in a partition" % (link_key[0]))
+			
+			link_document_id = "%s:%s" % (link_key[0].split(":",1)[0],link_document_id)
+		
+		return link_document_id
+
 	# Overridden so that indexes added to the dict 
 	def instanceToDict(self):
 
@@ -2141,6 +6778,16 @@ class _LinkDocument(Document):
 		super(_LinkDocument,self).instanceFromDict(dict_data)
 	
 	
+"""
+Used to store the lease on a document held by a LeaseLock
+"""
+class _LeaseDocument(Document):
+	
+	document_id = StringProperty()
+	owner = StringProperty()
+	expires = NumberProperty()
+
+
 """
 Design document dealing with links
 """
@@ -2197,4 +6844,25 @@ class _LinkDesignDocument(DesignDocument):
 				"}"
 			"}"
 		)
-	})		
\ No newline at end of file
+	})
+
+
+"""
+Design document used to find the documents saved with older schema versions, created by the first SchemaMigration.run() rather
+than sync() so databases that are never migrated don't build its index
+"""
+@_id("_design/_migration")
+class _MigrationDesignDocument(DesignDocument):
+	
+	_synced = False
+	
+	# Documents by type and schema version
+	by_schema_version = View({
+		"map" :(
+			"function(doc) {"
+				"if(doc.schema_version_ != null) {"
+					"emit([doc.type_,doc.schema_version_],null);"
+				"}"
+			"}"
+		)
+	})
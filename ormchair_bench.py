@@ -0,0 +1,392 @@
+'''
+ormchair_bench - a load generator that runs named scenarios against couchdb (or the stand-in server in ormchair_testing) and reports
+throughput, latency percentiles and HTTP requests per Database call e.g.
+
+	python -m ormchair_bench ingest mixed --threads 8 --operations 500
+	python -m ormchair_bench links --url http://127.0.0.1:5984 --username admin --password secret
+	python -m ormchair_bench index_scan --latency 0.002 --json
+
+Without --url an in-process stand-in server is started (with optional injected --latency). Scenarios: ingest, mixed, links, index_scan
+and cold_sync.
+
+Created on 19 Oct 2026
+
+@author: Will Ogden
+'''
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+import ormchair
+import ormchair_testing
+
+
+class BenchPet(ormchair.Document):
+
+	name = ormchair.StringProperty()
+
+
+class BenchPerson(ormchair.Document):
+
+	name = ormchair.StringProperty()
+	age = ormchair.IntegerProperty()
+	address = ormchair.DictProperty(
+		address_1 = ormchair.StringProperty(),
+		postcode = ormchair.StringProperty()
+	)
+
+	pets = ormchair.LinkProperty(BenchPet,reverse="owner")
+
+	get_by_name = ormchair.Index("name")
+	get_by_postcode_and_age = ormchair.Index("address.postcode","age")
+
+
+POSTCODES = ["PC%d" % (i) for i in range(100)]
+
+
+# Returns a person with random (but seeded) values
+def createPerson(generator,names=1000):
+
+	person = BenchPerson()
+	person.name = "name_%d" % (generator.randint(0,names - 1))
+	person.age = generator.randint(1,100)
+	person.address.address_1 = "%d The Street" % (generator.randint(1,1000))
+	person.address.postcode = generator.choice(POSTCODES)
+
+	return person
+
+# Returns the percentile of a sorted list of timings
+def percentile(timings,percent):
+
+	return timings[min(int(len(timings) * percent / 100.0),len(timings) - 1)] if timings else 0
+
+
+class Scenario(object):
+	"""
+	Base class for scenarios. setUp runs once before the timed run, then each worker thread calls runOperation, which returns the name
+	of the Database method it called (the logical operation the latency and HTTP requests are reported against).
+	"""
+	name = None
+	description = None
+
+	def __init__(self,session,database,options):
+
+		self.session = session
+		self.database = database
+		self.options = options
+
+	def setUp(self):
+
+		self.database.sync()
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		raise NotImplementedError()
+
+	def tearDown(self):
+
+		pass
+
+	# Add documents in batches
+	def _load(self,generator,count):
+
+		documents = []
+		for i in range(0,count,self.options.batch_size):
+
+			batch = [createPerson(generator) for j in range(min(self.options.batch_size,count - i))]
+			self.database.addMultiple(batch)
+			documents.extend(batch)
+
+		return documents
+
+
+class IngestScenario(Scenario):
+
+	name = "ingest"
+	description = "Bulk ingest with addMultiple (--batch-size documents per call)"
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		self.database.addMultiple([createPerson(generator) for i in range(self.options.batch_size)])
+
+		return "addMultiple"
+
+
+class MixedScenario(Scenario):
+
+	name = "mixed"
+	description = "Gets and updates of existing documents (--read-ratio of operations are gets)"
+
+	def setUp(self):
+
+		super(MixedScenario,self).setUp()
+
+		self.documents = self._load(random.Random(self.options.seed),self.options.documents)
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		document = generator.choice(self.documents)
+
+		if generator.random() < self.options.read_ratio:
+
+			self.database.get(document._id)
+			return "get"
+
+		else:
+
+			document.age = generator.randint(1,100)
+			self.database.update(document)
+			return "update"
+
+
+class LinksScenario(Scenario):
+
+	name = "links"
+	description = "addLinks fan out from a new person to --fan-out new pets"
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		person = createPerson(generator)
+
+		pets = []
+		for i in range(self.options.fan_out):
+			pet = BenchPet()
+			pet.name = "pet_%d" % (i)
+			pets.append(pet)
+
+		self.database.addLinks(person.pets,pets)
+
+		return "addLinks"
+
+
+class IndexScanScenario(Scenario):
+
+	name = "index_scan"
+	description = "getByIndex key lookups and range scans over --documents documents"
+
+	def setUp(self):
+
+		super(IndexScanScenario,self).setUp()
+
+		self._load(random.Random(self.options.seed),self.options.documents)
+
+		# Build the indexes before timing
+		self.database.waitUntilIndexed()
+		self.database.getByIndex(BenchPerson.get_by_name,key="name_0",limit=1)
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		if iteration % 2:
+
+			self.database.getByIndex(BenchPerson.get_by_name,key="name_%d" % (generator.randint(0,999)))
+
+		else:
+
+			postcode = generator.choice(POSTCODES)
+			self.database.getByIndex(BenchPerson.get_by_postcode_and_age,startkey=[postcode,18],endkey=[postcode,65])
+
+		return "getByIndex"
+
+
+class ColdSyncScenario(Scenario):
+
+	name = "cold_sync"
+	description = "sync() of the design documents into a new empty database"
+
+	def setUp(self):
+
+		self._database_names = []
+		self._lock = threading.Lock()
+
+	def runOperation(self,generator,worker_index,iteration):
+
+		database_name = "%s_cold_%d_%d" % (self.options.database,worker_index,iteration)
+
+		with self._lock:
+			self._database_names.append(database_name)
+
+		if self.session.databaseExists(database_name):
+			self.session.deleteDatabase(database_name)
+
+		self.session.createDatabase(database_name).sync()
+
+		return "sync"
+
+	def tearDown(self):
+
+		for database_name in self._database_names:
+			self.session.deleteDatabase(database_name)
+
+
+SCENARIOS = dict([(scenario_class.name,scenario_class) for scenario_class in [IngestScenario,MixedScenario,LinksScenario,IndexScanScenario,ColdSyncScenario]])
+
+
+def runScenario(session,scenario_class,options):
+	"""
+	Runs a scenario with options.threads worker threads each making options.operations operations
+
+	Returns:
+		dict: The scenario name, elapsed time and per operation count, errors, throughput, latency percentiles and requests per call
+	"""
+	if session.databaseExists(options.database):
+		session.deleteDatabase(options.database)
+
+	database = session.createDatabase(options.database)
+	scenario = scenario_class(session,database,options)
+	scenario.setUp()
+
+	# Only count the timed run
+	metrics = session.getMetrics()
+	metrics.reset()
+
+	timings = {}
+	errors = {}
+	lock = threading.Lock()
+
+	def worker(worker_index):
+
+		generator = random.Random("%s-%d" % (options.seed,worker_index))
+
+		worker_timings = {}
+		worker_errors = []
+
+		for iteration in range(options.operations):
+
+			start = time.time()
+
+			try:
+				operation = scenario.runOperation(generator,worker_index,iteration)
+				worker_timings.setdefault(operation,[]).append(time.time() - start)
+			except Exception as e:
+				worker_errors.append(e)
+
+		with lock:
+			for (operation,operation_timings) in worker_timings.iteritems():
+				timings.setdefault(operation,[]).extend(operation_timings)
+			errors[worker_index] = worker_errors
+
+	threads = [threading.Thread(target=worker,args=(i,)) for i in range(options.threads)]
+
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.time() - start
+
+	scenario.tearDown()
+	session.deleteDatabase(options.database)
+
+	operations = {}
+	for (operation,operation_timings) in timings.iteritems():
+
+		operation_timings.sort()
+
+		operations[operation] = {
+			"count" : len(operation_timings),
+			"throughput" : len(operation_timings) / elapsed,
+			"p50" : percentile(operation_timings,50),
+			"p95" : percentile(operation_timings,95),
+			"p99" : percentile(operation_timings,99),
+			"requests_per_call" : float(metrics.getCounter("ormchair_operation_http_requests_total",{"operation" : operation})) / len(operation_timings)
+		}
+
+	return {
+		"scenario" : scenario_class.name,
+		"threads" : options.threads,
+		"elapsed" : elapsed,
+		"errors" : sum([len(worker_errors) for worker_errors in errors.values()]),
+		"operations" : operations
+	}
+
+
+def printResult(result):
+
+	print "%s: %d threads, %.2fs, %d errors" % (result["scenario"],result["threads"],result["elapsed"],result["errors"])
+	print "  %-14s %8s %10s %10s %10s %10s %10s" % ("operation","count","ops/s","p50 (ms)","p95 (ms)","p99 (ms)","requests")
+
+	for operation in sorted(result["operations"].keys()):
+
+		operation_result = result["operations"][operation]
+		print "  %-14s %8d %10.1f %10.2f %10.2f %10.2f %10.2f" % (
+			operation,
+			operation_result["count"],
+			operation_result["throughput"],
+			operation_result["p50"] * 1000,
+			operation_result["p95"] * 1000,
+			operation_result["p99"] * 1000,
+			operation_result["requests_per_call"]
+		)
+
+
+def parseArguments(argv=None):
+
+	parser = argparse.ArgumentParser(description="Run load scenarios against couchdb through ormchair")
+	parser.add_argument("scenarios",nargs="*",metavar="scenario",help="Scenarios to run, one of %s (default all)" % (", ".join(sorted(SCENARIOS.keys()))))
+	parser.add_argument("--url",help="CouchDB url (default starts an in-process stand-in server)")
+	parser.add_argument("--username")
+	parser.add_argument("--password")
+	parser.add_argument("--database",default="ormchair_bench",help="Name of the (recreated) database to run in")
+	parser.add_argument("--threads",type=int,default=4)
+	parser.add_argument("--operations",type=int,default=100,help="Operations per thread")
+	parser.add_argument("--documents",type=int,default=1000,help="Documents loaded before the mixed and index_scan scenarios")
+	parser.add_argument("--batch-size",type=int,default=100)
+	parser.add_argument("--fan-out",type=int,default=10)
+	parser.add_argument("--read-ratio",type=float,default=0.8)
+	parser.add_argument("--latency",type=float,default=0,help="Latency injected by the stand-in server")
+	parser.add_argument("--latency-jitter",type=float,default=0)
+	parser.add_argument("--seed",type=int,default=1)
+	parser.add_argument("--json-codec",default="json",help="json, simplejson, ujson or auto")
+	parser.add_argument("--compression",action="store_true",help="Gzip large request bodies and accept gzipped responses")
+	parser.add_argument("--compress-responses",action="store_true",help="Have the stand-in server gzip responses")
+	parser.add_argument("--json",action="store_true",help="Print the results as json")
+	options = parser.parse_args(argv)
+
+	for scenario_name in options.scenarios:
+		if scenario_name not in SCENARIOS:
+			parser.error("Unknown scenario %s" % (scenario_name))
+
+	return options
+
+
+def main(argv=None):
+
+	options = parseArguments(argv)
+
+	server = None
+	url = options.url
+
+	if url is None:
+		server = ormchair_testing.FakeCouchDBServer(latency=options.latency,latency_jitter=options.latency_jitter,seed=options.seed,compress_responses=options.compress_responses).start()
+		url = server.getUrl()
+
+	try:
+
+		session = ormchair.Session(url,username=options.username,password=options.password,json_codec=options.json_codec,compression=options.compression)
+
+		results = []
+		for scenario_name in (options.scenarios or sorted(SCENARIOS.keys())):
+
+			result = runScenario(session,SCENARIOS[scenario_name],options)
+			results.append(result)
+
+			if not options.json:
+				printResult(result)
+
+		if options.json:
+			print json.dumps(results,indent=4,sort_keys=True)
+
+	finally:
+
+		if server:
+			server.stop()
+
+	return results
+
+
+if __name__ == "__main__":
+
+	main()
@@ -0,0 +1,1352 @@
+'''
+ormchair_testing - an in-process stand-in for CouchDB used for testing and benchmarking ormchair e.g.
+
+	with ormchair_testing.FakeCouchDBServer(latency=0.002,seed=1) as server:
+		session = ormchair.Session(server.getUrl())
+		...
+		print server.getRequestCounts()
+
+or run standalone with python ormchair_testing.py --port 5984 --latency 0.002
+
+Created on 18 Oct 2026
+
+@author: Will Ogden
+'''
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import urllib
+import base64
+import random
+import json
+import uuid
+import time
+import copy
+import re
+import socket
+import zlib
+import argparse
+
+# Views are sorted in the same collation order as ormchair merges sharded results
+from ormchair import _collationKey
+
+
+class MapFunctionError(Exception):
+	"""
+	Used when a javascript map function can't be understood by the stand-in server
+	"""
+	def __init__(self, message):
+		Exception.__init__(self, message)
+
+
+class _Undefined(object):
+	"""
+	Represents a javascript undefined value
+	"""
+	pass
+
+_UNDEFINED = _Undefined()
+
+
+class _MapFunctionTranslator(object):
+	"""
+	Translates the small subset of javascript used by ormchair's map functions into python e.g.
+
+		function(doc){ if(doc.type_=='pet'){ emit([doc.name,doc._id],doc); } }
+
+	Only conditions that compare a doc path with a literal, emits of doc paths, literals, arrays and objects
+	and for in loops over a doc object are supported.
+	"""
+	_token_re = re.compile(r"""\s*(?:(?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|(?P<number>-?\d+(?:\.\d+)?)|(?P<name>[A-Za-z_$][A-Za-z0-9_$]*)|(?P<op>===|!==|==|!=|[{}()\[\];,.:]))""")
+
+	def __init__(self,source):
+
+		self._tokens = self._tokenise(source)
+		self._position = 0
+
+	def _tokenise(self,source):
+
+		tokens = []
+		position = 0
+		source = source.strip()
+
+		while position < len(source):
+
+			match = self._token_re.match(source,position)
+			if not match or match.end() == position:
+				if source[position:].strip() == "":
+					break
+				raise MapFunctionError("Unexpected character at %d" % position)
+
+			for kind in ["string","number","name","op"]:
+				if match.group(kind) is not None:
+					value = match.group(kind)
+					if kind == "string":
+						value = value[1:-1].decode("string_escape")
+					elif kind == "number":
+						value = float(value) if "." in value else int(value)
+					tokens.append((kind,value))
+					break
+
+			position = match.end()
+
+		return tokens
+
+	def _peek(self):
+
+		return self._tokens[self._position] if self._position < len(self._tokens) else (None,None)
+
+	def _next(self):
+
+		token = self._peek()
+		self._position += 1
+		return token
+
+	def _expect(self,value):
+
+		(kind,token_value) = self._next()
+		if token_value != value or kind == "string":
+			raise MapFunctionError("Expected %s but found %s" % (value,token_value))
+
+	# Returns a python function taking a doc and an emit callback
+	def translate(self):
+
+		self._expect("function")
+		self._expect("(")
+		(kind,argument_name) = self._next()
+		self._expect(")")
+
+		statements = self._parseBlock(argument_name)
+
+		if self._position != len(self._tokens):
+			raise MapFunctionError("Unexpected trailing tokens")
+
+		def map_function(doc,emit):
+			scope = {argument_name: doc}
+			for statement in statements:
+				statement(scope,emit)
+
+		return map_function
+
+	def _parseBlock(self,argument_name):
+
+		self._expect("{")
+		statements = []
+
+		while self._peek()[1] != "}":
+
+			statement = self._parseStatement(argument_name)
+			if statement:
+				statements.append(statement)
+
+		self._expect("}")
+
+		return statements
+
+	def _parseStatement(self,argument_name):
+
+		(kind,value) = self._peek()
+
+		if value == ";":
+			self._next()
+			return None
+
+		elif kind == "name" and value == "if":
+
+			self._next()
+			self._expect("(")
+			left = self._parseExpression()
+			(kind,operator) = self._next()
+			right = self._parseExpression()
+			self._expect(")")
+
+			if operator in ["==","==="]:
+				compare = lambda a,b: a == b
+			elif operator in ["!=","!=="]:
+				compare = lambda a,b: a != b
+			else:
+				raise MapFunctionError("Unsupported operator %s" % operator)
+
+			statements = self._parseBlock(argument_name)
+
+			def if_statement(scope,emit):
+				if compare(left(scope),right(scope)):
+					for statement in statements:
+						statement(scope,emit)
+
+			return if_statement
+
+		elif kind == "name" and value == "for":
+
+			self._next()
+			self._expect("(")
+			(kind,loop_variable) = self._next()
+			if loop_variable == "var":
+				(kind,loop_variable) = self._next()
+			self._expect("in")
+			iterable = self._parseExpression()
+			self._expect(")")
+
+			statements = self._parseBlock(argument_name)
+
+			def for_statement(scope,emit):
+				value = iterable(scope)
+				if isinstance(value,dict):
+					for key in value:
+						scope[loop_variable] = key
+						for statement in statements:
+							statement(scope,emit)
+
+			return for_statement
+
+		elif kind == "name" and value == "emit":
+
+			self._next()
+			self._expect("(")
+			key = self._parseExpression()
+			self._expect(",")
+			value = self._parseExpression()
+			self._expect(")")
+
+			def emit_statement(scope,emit):
+				emit(_toJSON(key(scope)),_toJSON(value(scope)))
+
+			return emit_statement
+
+		raise MapFunctionError("Unsupported statement %s" % value)
+
+	def _parseExpression(self):
+
+		(kind,value) = self._next()
+
+		if kind in ["string","number"]:
+			return lambda scope: value
+
+		elif kind == "name" and value in ["null","true","false"]:
+			literal = {"null": None,"true": True,"false": False}[value]
+			return lambda scope: literal
+
+		elif kind == "name":
+
+			# Property access e.g. doc.a.b or doc.a[key]
+			accessors = []
+			while self._peek()[1] in [".","["]:
+				(kind,operator) = self._next()
+				if operator == ".":
+					(kind,name) = self._next()
+					accessors.append(lambda scope,name=name: name)
+				else:
+					accessors.append(self._parseExpression())
+					self._expect("]")
+
+			def property_expression(scope,name=value):
+
+				if name not in scope:
+					raise MapFunctionError("Unknown variable %s" % name)
+
+				current = scope[name]
+				for accessor in accessors:
+					if current is _UNDEFINED or current is None:
+						raise TypeError("Cannot read property of undefined")
+					key = accessor(scope)
+					current = current.get(key,_UNDEFINED) if isinstance(current,dict) else _UNDEFINED
+
+				return current
+
+			return property_expression
+
+		elif value == "[":
+
+			items = []
+			while self._peek()[1] != "]":
+				items.append(self._parseExpression())
+				if self._peek()[1] == ",":
+					self._next()
+			self._expect("]")
+
+			return lambda scope: [item(scope) for item in items]
+
+		elif value == "{":
+
+			items = []
+			while self._peek()[1] != "}":
+				(kind,key) = self._next()
+				self._expect(":")
+				items.append((key,self._parseExpression()))
+				if self._peek()[1] == ",":
+					self._next()
+			self._expect("}")
+
+			return lambda scope: dict([(key,item(scope)) for (key,item) in items])
+
+		raise MapFunctionError("Unsupported expression %s" % value)
+
+
+# Convert a value into its JSON form (undefined values in arrays become null)
+def _toJSON(value):
+
+	if value is _UNDEFINED:
+		return None
+	elif isinstance(value,list):
+		return [_toJSON(item) for item in value]
+	elif isinstance(value,dict):
+		return dict([(key,_toJSON(item)) for (key,item) in value.iteritems() if item is not _UNDEFINED])
+
+	return value
+
+
+# Query string booleans are case insensitive
+def _boolParam(query,name):
+
+	return query.get(name,"").lower() == "true"
+
+
+# Returns the value at a dotted path in a document
+def _getPath(document,path):
+
+	current = document
+	for name in path.split("."):
+		if isinstance(current,dict) and name in current:
+			current = current[name]
+		else:
+			return _UNDEFINED
+
+	return current
+
+
+# Checks a document matches a mango selector
+def _matchesSelector(document,selector):
+
+	for (field,condition) in selector.iteritems():
+
+		if field == "$and":
+			if not all([_matchesSelector(document,sub_selector) for sub_selector in condition]):
+				return False
+		elif field == "$or":
+			if not any([_matchesSelector(document,sub_selector) for sub_selector in condition]):
+				return False
+		elif field == "$not":
+			if _matchesSelector(document,condition):
+				return False
+		else:
+			value = _getPath(document,field)
+
+			if not isinstance(condition,dict) or not any([key.startswith("$") for key in condition]):
+				condition = {"$eq": condition}
+
+			for (operator,operand) in condition.iteritems():
+
+				if operator == "$exists":
+					if (value is not _UNDEFINED) != operand:
+						return False
+					continue
+
+				if value is _UNDEFINED:
+					return False
+
+				if operator == "$eq" and not (value == operand):
+					return False
+				elif operator == "$ne" and not (value != operand):
+					return False
+				elif operator == "$gt" and not (_collationKey(value) > _collationKey(operand)):
+					return False
+				elif operator == "$gte" and not (_collationKey(value) >= _collationKey(operand)):
+					return False
+				elif operator == "$lt" and not (_collationKey(value) < _collationKey(operand)):
+					return False
+				elif operator == "$lte" and not (_collationKey(value) <= _collationKey(operand)):
+					return False
+				elif operator == "$in" and value not in operand:
+					return False
+				elif operator == "$nin" and value in operand:
+					return False
+				elif operator not in ["$eq","$ne","$gt","$gte","$lt","$lte","$in","$nin"]:
+					raise MapFunctionError("Unsupported selector operator %s" % operator)
+
+	return True
+
+
+class _HTTPError(Exception):
+	"""
+	Used to return a CouchDB style error response
+	"""
+	def __init__(self, status, error, reason):
+		Exception.__init__(self, reason)
+		self.status = status
+		self.error = error
+		self.reason = reason
+
+
+class _FakeDatabase(object):
+	"""
+	Stores the documents of a single stand-in database
+	"""
+	def __init__(self,name,partitioned=False):
+
+		self.name = name
+		self.partitioned = partitioned
+		self.update_seq = 0
+
+		# document id -> {"doc","rev","deleted","seq","attachments"}
+		self.documents = {}
+
+		# seq -> document id (only the latest seq of each document is kept)
+		self.sequence_ids = {}
+
+		# view index signature -> _FakeViewIndex
+		self.view_indexes = {}
+
+	def nextRev(self,rev):
+
+		generation = int(rev.split("-")[0]) + 1 if rev else 1
+		return "%d-%s" % (generation,uuid.uuid4().hex)
+
+	def getDocument(self,_id):
+
+		entry = self.documents.get(_id)
+		if entry and not entry["deleted"]:
+			return entry
+
+		return None
+
+	def saveDocument(self,document_data,rev=None):
+
+		document_data = copy.deepcopy(document_data)
+		_id = document_data.get("_id") or uuid.uuid4().hex
+		rev = rev or document_data.get("_rev")
+		deleted = document_data.get("_deleted",False) is True
+
+		self._validatePartitioning(_id,document_data)
+
+		entry = self.documents.get(_id)
+
+		# Conflict checking (a deleted document can be recreated without a rev)
+		if entry and not entry["deleted"] and entry["rev"] != rev:
+			raise _HTTPError(409,"conflict","Document update conflict.")
+		elif rev and not (entry and entry["rev"] == rev):
+			raise _HTTPError(409,"conflict","Document update conflict.")
+
+		new_rev = self.nextRev(entry["rev"] if entry else None)
+
+		for key in ["_id","_rev","_deleted"]:
+			document_data.pop(key,None)
+
+		attachments = document_data.pop("_attachments",None)
+
+		if entry:
+			del self.sequence_ids[entry["seq"]]
+
+		self.update_seq += 1
+		self.sequence_ids[self.update_seq] = _id
+
+		self.documents[_id] = {
+			"doc": document_data,
+			"rev": new_rev,
+			"deleted": deleted,
+			"seq": self.update_seq,
+			"attachments": self._mergeAttachments(entry,attachments,deleted)
+		}
+
+		return (_id,new_rev)
+
+	# Partitioned databases need partition:docid ids, design documents can only be partitioned in a partitioned database
+	def _validatePartitioning(self,_id,document_data):
+
+		if _id.startswith("_design/"):
+			if document_data.get("options",{}).get("partitioned") is True and not self.partitioned:
+				raise _HTTPError(400,"invalid_design_doc","partitioned option cannot be true in a non-partitioned database.")
+		elif self.partitioned and not _id.startswith("_local/"):
+			if ":" not in _id or _id.startswith("_"):
+				raise _HTTPError(400,"illegal_docid","Doc id must be of form partition:id")
+
+	# Is a design document partitioned (they are by default in a partitioned database)
+	def isPartitionedDesignDocument(self,design_document_id):
+
+		entry = self.getDocument(design_document_id)
+		return self.partitioned and not (entry and entry["doc"].get("options",{}).get("partitioned") is False)
+
+	# Inline attachments are stored, stubs keep the previous revision's attachment
+	def _mergeAttachments(self,entry,attachments,deleted):
+
+		if deleted or not attachments:
+			return {}
+
+		previous = entry["attachments"] if entry else {}
+		merged = {}
+		for (name,attachment) in attachments.iteritems():
+			if attachment.get("stub") and name in previous:
+				merged[name] = previous[name]
+			elif "data" in attachment:
+				merged[name] = {
+					"content_type": attachment.get("content_type","application/octet-stream"),
+					"data": base64.b64decode(attachment["data"])
+				}
+
+		return merged
+
+	def documentToDict(self,_id,entry):
+
+		document_data = {"_id": _id,"_rev": entry["rev"]}
+		if entry["deleted"]:
+			document_data["_deleted"] = True
+		document_data.update(copy.deepcopy(entry["doc"]))
+
+		if entry["attachments"]:
+			document_data["_attachments"] = dict([(name,{
+				"content_type": attachment["content_type"],
+				"length": len(attachment["data"]),
+				"stub": True,
+				"revpos": int(entry["rev"].split("-")[0])
+			}) for (name,attachment) in entry["attachments"].iteritems()])
+
+		return document_data
+
+	def changedSince(self,since):
+
+		for seq in sorted([seq for seq in self.sequence_ids if seq > since]):
+			yield (seq,self.sequence_ids[seq])
+
+
+class _FakeViewIndex(object):
+	"""
+	An incrementally updated index of the views in a design document
+	"""
+	def __init__(self,map_functions):
+
+		# view name -> python map function
+		self.map_functions = map_functions
+
+		# The database seq the index has been built up to
+		self.update_seq = 0
+
+		# view name -> document id -> [(key,value),...]
+		self.rows = dict([(view_name,{}) for view_name in map_functions])
+
+	def update(self,database):
+
+		for (seq,_id) in database.changedSince(self.update_seq):
+
+			entry = database.documents[_id]
+
+			for (view_name,map_function) in self.map_functions.iteritems():
+
+				self.rows[view_name].pop(_id,None)
+
+				# Design documents are never indexed
+				if entry["deleted"] or _id.startswith("_design/"):
+					continue
+
+				emitted = []
+				document_data = database.documentToDict(_id,entry)
+
+				try:
+					map_function(document_data,lambda key,value: emitted.append((key,value)))
+				except (TypeError,KeyError):
+					# Same as couchjs, a map function that errors just skips the document
+					emitted = []
+
+				if emitted:
+					self.rows[view_name][_id] = emitted
+
+		self.update_seq = database.update_seq
+
+	def query(self,view_name):
+
+		rows = []
+		for (_id,emitted) in self.rows[view_name].iteritems():
+			for (key,value) in emitted:
+				rows.append({"id": _id,"key": key,"value": value})
+
+		rows.sort(key=lambda row: (_collationKey(row["key"]),row["id"]))
+
+		return rows
+
+
+# Built in views of the link design document (they use a for in loop which is translated, but are kept in python for speed)
+def _linkDocumentViews():
+
+	def by_id(doc,emit):
+		if doc.get("type_") == "_linkdocument":
+			emit(doc.get("from_id"),None)
+			emit(doc.get("to_id"),None)
+
+	def by_name(doc,emit):
+		if doc.get("type_") == "_linkdocument":
+			emit([doc.get("from_id"),doc.get("name"),doc.get("to_id")],{"_id": doc["_id"]})
+			emit([doc.get("to_id"),doc.get("reverse_name"),doc.get("from_id")],{"_id": doc["_id"]})
+
+	def links_by_name(doc,emit):
+		if doc.get("type_") == "_linkdocument":
+			emit([doc.get("from_id"),doc.get("name"),doc.get("to_id")],{"_id": doc.get("to_id")})
+			emit([doc.get("to_id"),doc.get("reverse_name"),doc.get("from_id")],{"_id": doc.get("from_id")})
+
+	def links_by_indexes(doc,emit):
+		if doc.get("type_") == "_linkdocument":
+			for property_path in doc.get("indexes",{}):
+				emit([doc.get("from_id"),doc.get("name"),property_path,doc["indexes"][property_path],doc.get("to_id")],{"_id": doc.get("to_id")})
+			for property_path in doc.get("reverse_indexes",{}):
+				emit([doc.get("to_id"),doc.get("reverse_name"),property_path,doc["reverse_indexes"][property_path],doc.get("from_id")],{"_id": doc.get("from_id")})
+
+	return {
+		"by_id": by_id,
+		"by_name": by_name,
+		"links_by_name": links_by_name,
+		"links_by_indexes": links_by_indexes
+	}
+
+
+class FakeCouchDBServer(object):
+	"""
+	An in-process HTTP server that implements the parts of the CouchDB API used by ormchair. Views are built by
+	translating the simple javascript map functions ormchair generates, other map functions can be registered as python
+	functions with registerView. Latency and failures can be injected to test and benchmark ormchair's behaviour.
+	"""
+	def __init__(self,host="127.0.0.1",port=0,latency=0,latency_jitter=0,failure_rate=0,seed=None,compress_responses=False,cluster=None):
+		"""
+		Kwargs:
+			host (str): The host to listen on
+			port (int): The port to listen on (0 picks a free port)
+			latency (float): Seconds added to every request
+			latency_jitter (float): Maximum random seconds added on top of latency
+			failure_rate (float): Fraction of requests (0 to 1) that fail with a 500 error
+			seed (int): Seed for the random latency and failures so runs are repeatable
+			compress_responses (bool): Gzip JSON responses of 1KB or more when the client accepts gzip (as a compressing proxy would)
+			cluster (FakeCouchDBServer): Another server to share databases with, as another node of the same cluster
+		"""
+		self._host = host
+		self._port = port
+		self._latency = latency
+		self._latency_jitter = latency_jitter
+		self._failure_rate = failure_rate
+		self.compress_responses = compress_responses
+		self._random = random.Random(seed)
+
+		if cluster is None:
+			self._lock = threading.RLock()
+			self._databases = {}
+			self._registered_views = {}
+		else:
+			self._lock = cluster._lock
+			self._databases = cluster._databases
+			self._registered_views = cluster._registered_views
+
+		self._request_counts = {}
+
+		self._http_server = None
+		self._thread = None
+
+	def start(self):
+
+		server = self
+
+		class Handler(_FakeCouchDBRequestHandler):
+			fake_server = server
+
+		self._http_server = _ThreadingHTTPServer((self._host,self._port),Handler)
+		self._port = self._http_server.server_address[1]
+
+		# A short poll interval so stop (and restarting nodes in tests) is quick
+		self._thread = threading.Thread(target=self._http_server.serve_forever,kwargs={"poll_interval": 0.05})
+		self._thread.daemon = True
+		self._thread.start()
+
+		return self
+
+	def stop(self):
+
+		if self._http_server:
+			self._http_server.shutdown()
+			self._http_server.closeConnections()
+			self._http_server.server_close()
+			self._http_server = None
+
+	def __enter__(self):
+
+		return self.start()
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+
+		self.stop()
+		return False
+
+	def getUrl(self):
+
+		return "http://%s:%d" % (self._host,self._port)
+
+	# Set latency and failure injection
+	def setLatency(self,latency,latency_jitter=0):
+
+		self._latency = latency
+		self._latency_jitter = latency_jitter
+
+	def setFailureRate(self,failure_rate):
+
+		self._failure_rate = failure_rate
+
+	# Register a python map function for a view that can't be translated e.g. registerView("_design/all","all",lambda doc,emit: emit(doc["_id"],None))
+	def registerView(self,design_document_id,view_name,map_function):
+
+		with self._lock:
+			self._registered_views[(design_document_id,view_name)] = map_function
+
+	# Returns the number of requests handled per (method,endpoint)
+	def getRequestCounts(self):
+
+		with self._lock:
+			return dict(self._request_counts)
+
+	def resetRequestCounts(self):
+
+		with self._lock:
+			self._request_counts = {}
+
+	def _countRequest(self,method,endpoint):
+
+		with self._lock:
+			self._request_counts[(method,endpoint)] = self._request_counts.get((method,endpoint),0) + 1
+
+	def _injectFaults(self):
+
+		with self._lock:
+			delay = self._latency + (self._random.random() * self._latency_jitter if self._latency_jitter else 0)
+			fail = self._failure_rate and self._random.random() < self._failure_rate
+
+		if delay:
+			time.sleep(delay)
+
+		if fail:
+			raise _HTTPError(500,"injected_failure","Failure injected by stand-in server")
+
+	def _getDatabase(self,name):
+
+		if name not in self._databases:
+			raise _HTTPError(404,"not_found","Database does not exist.")
+
+		return self._databases[name]
+
+	# Returns the (possibly shared) view index for a design document
+	def _getViewIndex(self,database,design_document_id):
+
+		entry = database.getDocument(design_document_id)
+		if not entry:
+			raise _HTTPError(404,"not_found","missing")
+
+		views = entry["doc"].get("views",{})
+
+		# Design documents with identical views share an index (as CouchDB does)
+		signature = json.dumps([design_document_id if (design_document_id,view_name) in self._registered_views else None for view_name in sorted(views)] + [views],sort_keys=True)
+
+		if signature not in database.view_indexes:
+
+			map_functions = {}
+			for (view_name,view) in views.iteritems():
+
+				if (design_document_id,view_name) in self._registered_views:
+					map_functions[view_name] = self._registered_views[(design_document_id,view_name)]
+				elif design_document_id == "_design/_linkdocument" and view_name in _linkDocumentViews():
+					map_functions[view_name] = _linkDocumentViews()[view_name]
+				elif isinstance(view.get("map"),basestring):
+					try:
+						map_functions[view_name] = _MapFunctionTranslator(view["map"]).translate()
+					except MapFunctionError as e:
+						raise _HTTPError(500,"map_function_error","%s: %s" % (view_name,e))
+
+			database.view_indexes[signature] = _FakeViewIndex(map_functions)
+
+		return database.view_indexes[signature]
+
+	def handle(self,method,path,query,headers,body):
+
+		segments = [urllib.unquote(segment) for segment in path.split("/") if segment != ""]
+
+		# Partition scoped requests e.g. /db/_partition/name/_all_docs
+		partition = None
+		if len(segments) > 2 and segments[1] == "_partition":
+			partition = segments[2]
+			segments[1:3] = []
+
+		# Join design document ids e.g. _design/name
+		if len(segments) > 2 and segments[1] in ["_design","_local"]:
+			segments[1:3] = ["%s/%s" % (segments[1],segments[2])]
+
+		endpoint = self._endpointName(segments)
+		self._countRequest(method,endpoint)
+		self._injectFaults()
+
+		with self._lock:
+
+			if partition is not None:
+				return self._routePartition(method,segments,query,body,partition)
+
+			return self._route(method,segments,query,headers,body)
+
+	def _endpointName(self,segments):
+
+		if len(segments) == 0:
+			return "/"
+		elif len(segments) == 1:
+			return segments[0] if segments[0].startswith("_") else "database"
+		elif len(segments) >= 4 and segments[2] == "_view":
+			return "view"
+		elif segments[1].startswith("_") and not (segments[1].startswith("_design/") or segments[1].startswith("_local/")):
+			return segments[1]
+		elif len(segments) >= 3 and segments[2] == "_info":
+			return "_info"
+		elif len(segments) >= 3:
+			return "attachment"
+
+		return "doc"
+
+	def _route(self,method,segments,query,headers,body):
+
+		if len(segments) == 0:
+			return (200,{"couchdb": "Welcome","version": "stand-in"})
+
+		name = segments[0]
+
+		# Server level endpoints
+		if name == "_session":
+			return (200,{"ok": True,"name": None,"roles": ["_admin"]})
+		elif name == "_all_dbs":
+			return (200,sorted(self._databases.keys()))
+		elif name == "_active_tasks":
+			return (200,[])
+		elif name == "_uuids":
+			return (200,{"uuids": [uuid.uuid4().hex for i in range(int(query.get("count",1)))]})
+
+		# Database level endpoints
+		if len(segments) == 1:
+
+			if method == "PUT":
+				if name in self._databases:
+					raise _HTTPError(412,"file_exists","The database could not be created, the file already exists.")
+				self._databases[name] = _FakeDatabase(name,partitioned=_boolParam(query,"partitioned"))
+				return (201,{"ok": True})
+
+			database = self._getDatabase(name)
+
+			if method == "GET":
+				return (200,{
+					"db_name": name,
+					"doc_count": len([entry for entry in database.documents.values() if not entry["deleted"]]),
+					"doc_del_count": len([entry for entry in database.documents.values() if entry["deleted"]]),
+					"update_seq": database.update_seq,
+					"props": {"partitioned": True} if database.partitioned else {}
+				})
+			elif method == "DELETE":
+				del self._databases[name]
+				return (200,{"ok": True})
+			elif method == "POST":
+				(_id,rev) = database.saveDocument(self._parseBody(body))
+				return (201,{"ok": True,"id": _id,"rev": rev})
+
+		database = self._getDatabase(name)
+		resource = segments[1]
+
+		if resource == "_bulk_docs" and method == "POST":
+			return self._bulkDocs(database,self._parseBody(body))
+		elif resource == "_all_docs":
+			return self._allDocs(database,query,self._parseBody(body) if method == "POST" else {})
+		elif resource == "_changes":
+			return self._changes(database,query)
+		elif resource == "_find" and method == "POST":
+			return self._find(database,self._parseBody(body))
+		elif resource == "_index" and method == "POST":
+			return self._createIndex(database,self._parseBody(body))
+		elif len(segments) >= 4 and segments[2] == "_view":
+			return self._view(database,resource,segments[3],query,self._parseBody(body) if method == "POST" else {})
+		elif len(segments) == 3 and segments[2] == "_info":
+			view_index = self._getViewIndex(database,resource)
+			return (200,{"name": resource.split("/",1)[1],"view_index": {"update_seq": view_index.update_seq,"updater_running": False,"compact_running": False}})
+		elif len(segments) >= 3:
+			return self._attachment(database,resource,"/".join(segments[2:]),method,query,headers,body)
+
+		return self._document(database,resource,method,query,headers,body)
+
+	# Partition scoped info, _all_docs, _find and view queries
+	def _routePartition(self,method,segments,query,body,partition):
+
+		database = self._getDatabase(segments[0])
+
+		if not database.partitioned:
+			raise _HTTPError(400,"bad_request","database is not partitioned")
+
+		if len(segments) == 1 and method == "GET":
+			documents = [entry for (_id,entry) in database.documents.iteritems() if _id.startswith(partition + ":")]
+			return (200,{
+				"db_name": database.name,
+				"partition": partition,
+				"doc_count": len([entry for entry in documents if not entry["deleted"]]),
+				"doc_del_count": len([entry for entry in documents if entry["deleted"]])
+			})
+		elif segments[1] == "_all_docs":
+			return self._allDocs(database,query,self._parseBody(body) if method == "POST" else {},partition)
+		elif segments[1] == "_find" and method == "POST":
+			return self._find(database,self._parseBody(body),partition)
+		elif len(segments) >= 4 and segments[2] == "_view":
+			return self._view(database,segments[1],segments[3],query,self._parseBody(body) if method == "POST" else {},partition)
+
+		raise _HTTPError(400,"bad_request","Unsupported partition request")
+
+	def _parseBody(self,body):
+
+		if not body:
+			return {}
+
+		try:
+			return json.loads(body)
+		except ValueError:
+			raise _HTTPError(400,"bad_request","invalid UTF-8 JSON")
+
+	def _document(self,database,_id,method,query,headers,body):
+
+		if method == "GET" or method == "HEAD":
+
+			entry = database.getDocument(_id)
+			if not entry or ("rev" in query and query["rev"] != entry["rev"]):
+				raise _HTTPError(404,"not_found","deleted" if _id in database.documents else "missing")
+
+			document_data = database.documentToDict(_id,entry)
+			if _boolParam(query,"attachments"):
+				for (name,attachment) in entry["attachments"].iteritems():
+					document_data["_attachments"][name] = {"content_type": attachment["content_type"],"data": base64.b64encode(attachment["data"])}
+
+			return (200,document_data)
+
+		elif method == "PUT":
+
+			document_data = self._parseBody(body)
+			document_data["_id"] = _id
+			(_id,rev) = database.saveDocument(document_data,rev=query.get("rev"))
+			return (201,{"ok": True,"id": _id,"rev": rev})
+
+		elif method == "DELETE":
+
+			rev = query.get("rev")
+			entry = database.getDocument(_id)
+			if not entry:
+				raise _HTTPError(404,"not_found","missing")
+			(_id,rev) = database.saveDocument({"_id": _id,"_rev": rev,"_deleted": True})
+			return (200,{"ok": True,"id": _id,"rev": rev})
+
+		elif method == "COPY":
+
+			entry = database.getDocument(_id)
+			if not entry:
+				raise _HTTPError(404,"not_found","missing")
+
+			destination = headers.get("Destination","")
+			(destination_id,separator,destination_query) = destination.partition("?")
+			destination_rev = urlparse.parse_qs(destination_query).get("rev",[None])[0]
+
+			document_data = database.documentToDict(_id,entry)
+			document_data.pop("_attachments",None)
+			document_data["_id"] = urllib.unquote(destination_id)
+			document_data["_rev"] = destination_rev
+
+			(destination_id,rev) = database.saveDocument(document_data)
+			database.documents[destination_id]["attachments"] = dict(entry["attachments"])
+
+			return (201,{"ok": True,"id": destination_id,"rev": rev})
+
+		raise _HTTPError(405,"method_not_allowed","Only GET,HEAD,PUT,DELETE,COPY allowed")
+
+	def _attachment(self,database,_id,name,method,query,headers,body):
+
+		if method == "GET" or method == "HEAD":
+
+			entry = database.getDocument(_id)
+			if not entry or name not in entry["attachments"]:
+				raise _HTTPError(404,"not_found","Document is missing attachment")
+
+			attachment = entry["attachments"][name]
+			return (200,_RawResponse(attachment["data"],attachment["content_type"]))
+
+		elif method == "PUT":
+
+			entry = database.getDocument(_id)
+			rev = query.get("rev")
+			document_data = database.documentToDict(_id,entry) if entry else {"_id": _id}
+			if rev:
+				document_data["_rev"] = rev
+			elif entry:
+				document_data.pop("_rev")
+
+			attachments = entry["attachments"] if entry else {}
+			(_id,rev) = database.saveDocument(document_data)
+			attachments = dict(attachments)
+			attachments[name] = {"content_type": headers.get("Content-Type","application/octet-stream"),"data": body}
+			database.documents[_id]["attachments"] = attachments
+
+			return (201,{"ok": True,"id": _id,"rev": rev})
+
+		elif method == "DELETE":
+
+			entry = database.getDocument(_id)
+			if not entry or name not in entry["attachments"]:
+				raise _HTTPError(404,"not_found","Document is missing attachment")
+
+			document_data = database.documentToDict(_id,entry)
+			document_data["_rev"] = query.get("rev")
+			attachments = dict(entry["attachments"])
+			(_id,rev) = database.saveDocument(document_data)
+			del attachments[name]
+			database.documents[_id]["attachments"] = attachments
+
+			return (200,{"ok": True,"id": _id,"rev": rev})
+
+		raise _HTTPError(405,"method_not_allowed","Only GET,HEAD,PUT,DELETE allowed")
+
+	def _bulkDocs(self,database,data):
+
+		results = []
+		for document_data in data.get("docs",[]):
+
+			try:
+				(_id,rev) = database.saveDocument(document_data)
+				results.append({"ok": True,"id": _id,"rev": rev})
+			except _HTTPError as e:
+				results.append({"id": document_data.get("_id"),"error": e.error,"reason": e.reason})
+
+		return (201,results)
+
+	def _allDocs(self,database,query,data,partition=None):
+
+		include_docs = _boolParam(query,"include_docs")
+		keys = data.get("keys") if "keys" in data else (json.loads(query["keys"]) if "keys" in query else None)
+
+		rows = []
+		if keys is not None:
+
+			for key in keys:
+				entry = database.documents.get(key)
+				if not entry:
+					rows.append({"key": key,"error": "not_found"})
+				elif entry["deleted"]:
+					rows.append({"id": key,"key": key,"value": {"rev": entry["rev"],"deleted": True},"doc": None} if include_docs else {"id": key,"key": key,"value": {"rev": entry["rev"],"deleted": True}})
+				else:
+					row = {"id": key,"key": key,"value": {"rev": entry["rev"]}}
+					if include_docs:
+						row["doc"] = database.documentToDict(key,entry)
+					rows.append(row)
+
+			return (200,{"total_rows": len(rows),"offset": 0,"rows": rows})
+
+		for _id in sorted([_id for (_id,entry) in database.documents.iteritems() if not entry["deleted"] and (partition is None or _id.startswith(partition + ":"))]):
+			row = {"id": _id,"key": _id,"value": {"rev": database.documents[_id]["rev"]}}
+			if include_docs:
+				row["doc"] = database.documentToDict(_id,database.documents[_id])
+			rows.append(row)
+
+		return (200,self._sliceRows(rows,query,data,lambda row: row["key"]))
+
+	# Applies key, startkey, endkey, descending, skip and limit
+	def _sliceRows(self,rows,query,data,row_key):
+
+		params = dict([(key,json.loads(value)) for (key,value) in query.iteritems() if key in ["key","startkey","endkey","start_key","end_key","descending","skip","limit","inclusive_end","startkey_docid","endkey_docid"] and key not in ["startkey_docid","endkey_docid"]])
+		for key in ["startkey_docid","endkey_docid"]:
+			if key in query:
+				params[key] = query[key]
+		params.update(dict([(key,value) for (key,value) in data.iteritems() if key != "keys"]))
+
+		total_rows = len(rows)
+		descending = params.get("descending",False)
+		if descending:
+			rows = list(reversed(rows))
+
+		startkey = params.get("startkey",params.get("start_key"))
+		endkey = params.get("endkey",params.get("end_key"))
+		inclusive_end = params.get("inclusive_end",True)
+
+		if "key" in params:
+			rows = [row for row in rows if _collationKey(row_key(row)) == _collationKey(params["key"])]
+
+		if startkey is not None:
+			start = _collationKey(startkey)
+			rows = [row for row in rows if (_collationKey(row_key(row)) <= start if descending else _collationKey(row_key(row)) >= start)]
+
+			# Rows with the start key begin from this document id (for paging)
+			if "startkey_docid" in params:
+				rows = [row for row in rows if not (_collationKey(row_key(row)) == start and (row["id"] > params["startkey_docid"] if descending else row["id"] < params["startkey_docid"]))]
+
+		if endkey is not None:
+			end = _collationKey(endkey)
+			if descending:
+				rows = [row for row in rows if (_collationKey(row_key(row)) >= end if inclusive_end else _collationKey(row_key(row)) > end)]
+			else:
+				rows = [row for row in rows if (_collationKey(row_key(row)) <= end if inclusive_end else _collationKey(row_key(row)) < end)]
+
+		offset = total_rows - len(rows)
+		skip = params.get("skip",0) or 0
+		rows = rows[skip:]
+
+		if params.get("limit") is not None:
+			rows = rows[:params["limit"]]
+
+		return {"total_rows": total_rows,"offset": offset + skip,"rows": rows}
+
+	def _view(self,database,design_document_id,view_name,query,data,partition=None):
+
+		view_index = self._getViewIndex(database,design_document_id)
+
+		if database.isPartitionedDesignDocument(design_document_id) and partition is None:
+			raise _HTTPError(400,"query_parse_error","`partition` parameter is mandatory for queries to this view.")
+		elif partition is not None and not database.isPartitionedDesignDocument(design_document_id):
+			raise _HTTPError(400,"query_parse_error","`partition` parameter is not supported on this design document")
+
+		if view_name not in view_index.map_functions:
+			raise _HTTPError(404,"not_found","missing_named_view")
+
+		stale = query.get("stale")
+		update = query.get("update","").lower()
+
+		# stale=ok / update=false answer from the existing index, update_after updates after answering
+		if not (stale in ["ok","update_after"] or update in ["false","lazy"]):
+			view_index.update(database)
+
+		rows = view_index.query(view_name)
+
+		if partition is not None:
+			rows = [row for row in rows if row["id"].startswith(partition + ":")]
+
+		keys = data.get("keys") if "keys" in data else (json.loads(query["keys"]) if "keys" in query else None)
+		if keys is not None:
+			keyed_rows = []
+			for key in keys:
+				keyed_rows.extend([row for row in rows if _collationKey(row["key"]) == _collationKey(key)])
+			result = self._sliceRows(keyed_rows,dict([(k,v) for (k,v) in query.iteritems() if k in ["skip","limit","descending"]]),{},lambda row: row["key"])
+		else:
+			result = self._sliceRows(rows,query,data,lambda row: row["key"])
+
+		result["total_rows"] = len(rows)
+
+		if _boolParam(query,"include_docs"):
+			for row in result["rows"]:
+				linked_id = row["value"]["_id"] if isinstance(row["value"],dict) and "_id" in row["value"] else row["id"]
+				entry = database.getDocument(linked_id)
+				row["doc"] = database.documentToDict(linked_id,entry) if entry else None
+
+		if stale == "update_after" or update == "lazy":
+			view_index.update(database)
+
+		return (200,result)
+
+	def _changes(self,database,query):
+
+		since = int(query.get("since",0) or 0)
+		limit = int(query["limit"]) if "limit" in query else None
+		include_docs = _boolParam(query,"include_docs")
+
+		results = []
+		last_seq = since
+		for (seq,_id) in database.changedSince(since):
+
+			entry = database.documents[_id]
+			change = {"seq": seq,"id": _id,"changes": [{"rev": entry["rev"]}]}
+			if entry["deleted"]:
+				change["deleted"] = True
+			if include_docs:
+				change["doc"] = database.documentToDict(_id,entry)
+
+			results.append(change)
+			last_seq = seq
+
+			if limit and len(results) >= limit:
+				break
+
+		return (200,{"results": results,"last_seq": last_seq})
+
+	def _createIndex(self,database,data):
+
+		fields = data.get("index",{}).get("fields",[])
+		name = data.get("name") or uuid.uuid4().hex
+		design_document_id = "_design/%s" % (data.get("ddoc") or uuid.uuid4().hex)
+
+		entry = database.getDocument(design_document_id)
+		design_document = database.documentToDict(design_document_id,entry) if entry else {"_id": design_document_id,"language": "query","views": {}}
+
+		view = {"map": {"fields": dict([(field if isinstance(field,basestring) else field.keys()[0],"asc") for field in fields])},"reduce": "_count","options": {"def": {"fields": fields}}}
+
+		if design_document["views"].get(name) == view:
+			return (200,{"result": "exists","id": design_document_id,"name": name})
+
+		design_document["views"][name] = view
+		database.saveDocument(design_document)
+
+		return (200,{"result": "created","id": design_document_id,"name": name})
+
+	def _find(self,database,data,partition=None):
+
+		selector = data.get("selector",{})
+		skip = data.get("skip",0)
+		limit = data.get("limit",25)
+
+		if data.get("bookmark") and data["bookmark"] != "nil":
+			skip += int(base64.b64decode(data["bookmark"]))
+
+		documents = []
+		for _id in sorted(database.documents):
+			entry = database.documents[_id]
+			if entry["deleted"] or _id.startswith("_design/") or (partition is not None and not _id.startswith(partition + ":")):
+				continue
+			document_data = database.documentToDict(_id,entry)
+			if _matchesSelector(document_data,selector):
+				documents.append(document_data)
+
+		for sort_field in reversed(data.get("sort",[])):
+			(field,direction) = (sort_field,"asc") if isinstance(sort_field,basestring) else sort_field.items()[0]
+			documents.sort(key=lambda document_data: _collationKey(_toJSON(_getPath(document_data,field))),reverse=direction == "desc")
+
+		documents = documents[skip:skip + limit]
+
+		if data.get("fields"):
+			documents = [dict([(field,_getPath(document_data,field)) for field in data["fields"] if _getPath(document_data,field) is not _UNDEFINED]) for document_data in documents]
+
+		return (200,{"docs": documents,"bookmark": base64.b64encode(str(skip + len(documents)))})
+
+
+class _RawResponse(object):
+	"""
+	A non JSON response body e.g. attachment data
+	"""
+	def __init__(self,data,content_type):
+		self.data = data
+		self.content_type = content_type
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self,server_address,RequestHandlerClass):
+
+		BaseHTTPServer.HTTPServer.__init__(self,server_address,RequestHandlerClass)
+
+		# Open (keep alive) connections and their handler threads, closed on stop
+		self._connections = {}
+		self._connections_lock = threading.Lock()
+		self._closing = False
+
+	def process_request(self,request,client_address):
+
+		thread = threading.Thread(target=self.process_request_thread,args=(request,client_address))
+		thread.daemon = True
+
+		with self._connections_lock:
+			self._connections[request] = thread
+
+		thread.start()
+
+	def shutdown_request(self,request):
+
+		with self._connections_lock:
+			self._connections.pop(request,None)
+
+		BaseHTTPServer.HTTPServer.shutdown_request(self,request)
+
+	# Connections closed by stop can error in their handler threads
+	def handle_error(self,request,client_address):
+
+		if not self._closing:
+			BaseHTTPServer.HTTPServer.handle_error(self,request,client_address)
+
+	# Close the open connections and wait for their handler threads to finish
+	def closeConnections(self,timeout=5):
+
+		with self._connections_lock:
+			self._closing = True
+			connections = self._connections.items()
+
+		for (connection,thread) in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+		for (connection,thread) in connections:
+			thread.join(timeout)
+
+
+class _FakeCouchDBRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	protocol_version = "HTTP/1.1"
+	fake_server = None
+
+	# Send each response in one write without waiting on delayed acks
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def _handle(self):
+
+		parsed_url = urlparse.urlparse(self.path)
+		query = dict([(key,values[-1]) for (key,values) in urlparse.parse_qs(parsed_url.query,keep_blank_values=True).iteritems()])
+
+		body = ""
+		if "Content-Length" in self.headers:
+			body = self.rfile.read(int(self.headers["Content-Length"]))
+
+		# CouchDB accepts gzipped request bodies
+		if body and self.headers.get("Content-Encoding") == "gzip":
+			body = zlib.decompress(body,16 + zlib.MAX_WBITS)
+
+		try:
+			(status,response) = self.fake_server.handle(self.command,parsed_url.path,query,self.headers,body)
+		except _HTTPError as e:
+			(status,response) = (e.status,{"error": e.error,"reason": e.reason})
+		except Exception as e:
+			(status,response) = (500,{"error": "unknown_error","reason": str(e)})
+
+		if isinstance(response,_RawResponse):
+			(content_type,response_body) = (response.content_type,response.data)
+		else:
+			(content_type,response_body) = ("application/json",json.dumps(response) + "\n")
+
+		content_encoding = None
+		if self.fake_server.compress_responses and content_type == "application/json" and len(response_body) >= 1024 and "gzip" in self.headers.get("Accept-Encoding",""):
+			compressor = zlib.compressobj(6,zlib.DEFLATED,16 + zlib.MAX_WBITS)
+			(content_encoding,response_body) = ("gzip",compressor.compress(response_body) + compressor.flush())
+
+		self.send_response(status)
+		self.send_header("Content-Type",content_type)
+		if content_encoding:
+			self.send_header("Content-Encoding",content_encoding)
+		self.send_header("Content-Length",str(len(response_body)))
+		if self.path.startswith("/_session"):
+			self.send_header("Set-Cookie","AuthSession=stand-in; Version=1; Path=/; HttpOnly")
+		self.end_headers()
+
+		if self.command != "HEAD":
+			self.wfile.write(response_body)
+
+	do_GET = _handle
+	do_PUT = _handle
+	do_POST = _handle
+	do_DELETE = _handle
+	do_HEAD = _handle
+	do_COPY = _handle
+
+	def log_message(self, format, *args):
+		pass
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Run a stand-in CouchDB server for testing ormchair")
+	parser.add_argument("--host",default="127.0.0.1")
+	parser.add_argument("--port",type=int,default=5984)
+	parser.add_argument("--latency",type=float,default=0,help="Seconds added to every request")
+	parser.add_argument("--latency-jitter",type=float,default=0,help="Maximum random seconds added on top of latency")
+	parser.add_argument("--failure-rate",type=float,default=0,help="Fraction of requests that fail with a 500 error")
+	parser.add_argument("--seed",type=int)
+	args = parser.parse_args()
+
+	server = FakeCouchDBServer(args.host,args.port,args.latency,args.latency_jitter,args.failure_rate,args.seed).start()
+	print "Stand-in CouchDB listening on %s" % (server.getUrl())
+
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.stop()
@@ -7,7 +7,7 @@ setup(
 	long_description=open('README').read(),
 	author='Will Ogden',
 	url='https://github.com/willogden/ormchair',
-	py_modules=['ormchair'],
+	py_modules=['ormchair','ormchair_testing','ormchair_bench'],
 	packages=['tests',],
 	install_requires=['requests>=1.2.0']
 )
\ No newline at end of file
@@ -4,8 +4,39 @@ Created on 19 Apr 2013
 @author: Will Ogden
 '''
 import unittest
+import threading
+import logging
+import gc
 import sys
+import os
+import time
+import requests
+import tempfile
+import mmap
+import StringIO
+import io
+import atexit
+import uuid
 import ormchair
+import ormchair_testing
+import ormchair_bench
+
+# Set ORMCHAIR_COUCHDB_URL to run the database tests against a real couchdb, otherwise an in-process stand-in is used
+_couchdb_url = os.environ.get("ORMCHAIR_COUCHDB_URL")
+
+def getCouchDBUrl():
+	
+	global _couchdb_url
+	
+	if _couchdb_url is None:
+		server = ormchair_testing.FakeCouchDBServer().start()
+		
+		# Stop before interpreter shutdown so handler threads don't outlive the modules
+		atexit.register(server.stop)
+		
+		_couchdb_url = server.getUrl()
+	
+	return _couchdb_url
 
 class SchemaTestCase(unittest.TestCase):
 	
@@ -558,274 +589,1724 @@ class LinkPropertyTestCase(unittest.TestCase):
 		
 		self.assertTrue(hasattr(linked_class,reverse_property_name))
 		self.assertIsInstance(getattr(linked_class,reverse_property_name), ormchair.LinkProperty)
+		self.assertEqual(getattr(linked_class,reverse_property_name).getReverse(),"link_property_to_a")
 	
 	def test_has_links(self):
 		
 		self.assertTrue(self.schema_class_a.hasLinks())
 		self.assertTrue(self.schema_class_b.hasLinks())
 	
+	def test_link_document_id(self):
+		
+		link_document_id = ormchair._LinkDocument.getLinkDocumentId("b1","link_property_to_a","a1","link_property_to_b")
+		
+		self.assertEqual(link_document_id,ormchair._LinkDocument.getLinkDocumentId("b1","link_property_to_a","a1","link_property_to_b"))
+		self.assertEqual(link_document_id,ormchair._LinkDocument.getLinkDocumentId("a1","link_property_to_b","b1","link_property_to_a"))
+		self.assertNotEqual(link_document_id,ormchair._LinkDocument.getLinkDocumentId("b1","link_property_to_a","a2","link_property_to_b"))
+	
 
-class SessionTestCase(unittest.TestCase):
+class BasicLockTestCase(unittest.TestCase):
 	
 	def setUp(self):
 		
-		self.session = ormchair.Session("http://127.0.0.1:5984",username="testadmin", password="testadmin")
-		if self.session.databaseExists("test_ormchair"):
-			self.session.deleteDatabase("test_ormchair")
-
+		self.stripe_count = ormchair.BasicLock.stripe_count
+		ormchair.BasicLock.setStripeCount(8)
+	
 	def tearDown(self):
 		
-		self.session = None
+		ormchair.BasicLock.setStripeCount(self.stripe_count)
+	
+	def test_stripe_index(self):
 		
-	def test_create_database(self):
+		stripe_index = ormchair.BasicLock.getStripeIndex("document_1")
 		
-		test_ormchair_db = self.session.createDatabase("test_ormchair")
-		self.assertIsInstance(test_ormchair_db,ormchair.Database)
+		self.assertEqual(stripe_index,ormchair.BasicLock.getStripeIndex("document_1"))
+		self.assertTrue(0 <= stripe_index < 8)
+		self.assertEqual(len(ormchair.BasicLock.getMetrics()),8)
+	
+	def test_reentrant(self):
+		
+		with ormchair.BasicLock(["document_1","document_2"]):
+			with ormchair.BasicLock(["document_1"]):
+				pass
 		
+		metrics = ormchair.BasicLock.getMetrics()[ormchair.BasicLock.getStripeIndex("document_1")]
+		self.assertEqual(metrics["acquisitions"],2)
+		self.assertEqual(metrics["contended"],0)
 	
-	def test_get_database(self):
+	def test_contention(self):
+		
+		acquired = threading.Event()
+		release = threading.Event()
+		
+		def hold():
+			with ormchair.BasicLock(["document_1"]):
+				acquired.set()
+				release.wait()
+		
+		thread = threading.Thread(target=hold)
+		thread.start()
+		acquired.wait()
+		
+		threading.Timer(0.05,release.set).start()
+		
+		with ormchair.BasicLock(["document_1","document_2","document_3"]):
+			pass
+		
+		thread.join()
+		
+		metrics = ormchair.BasicLock.getMetrics()[ormchair.BasicLock.getStripeIndex("document_1")]
+		self.assertEqual(metrics["contended"],1)
+		self.assertGreater(metrics["max_wait_time"],0)
+		self.assertGreater(metrics["max_hold_time"],0)
 		
-		self.session.createDatabase("test_ormchair")
-		test_ormchair_db = self.session.getDatabase("test_ormchair")
-		self.assertIsInstance(test_ormchair_db,ormchair.Database)
 
-			
-	def test_delete_database(self):
+class MetricsRegistryTestCase(unittest.TestCase):
+	
+	def setUp(self):
 		
-		self.session.createDatabase("test_ormchair")
-		self.assertTrue(self.session.databaseExists("test_ormchair"))
-		self.session.deleteDatabase("test_ormchair")
-		self.assertFalse(self.session.databaseExists("test_ormchair"))
+		self.metrics = ormchair.MetricsRegistry(buckets=[0.1,1])
+		self.metrics.incrementCounter("requests_total",labels={"method" : "GET"})
+		self.metrics.incrementCounter("requests_total",2,labels={"method" : "GET"})
+		self.metrics.observe("request_seconds",0.05,labels={"method" : "GET"})
+		self.metrics.observe("request_seconds",0.5,labels={"method" : "GET"})
+	
+	def tearDown(self):
 		
-class DatabaseTestCase(unittest.TestCase):
+		self.metrics = None
+	
+	def test_to_dict(self):
+		
+		metrics_dict = self.metrics.toDict()
+		
+		self.assertEqual(metrics_dict["counters"]["requests_total"],[{"labels" : {"method" : "GET"}, "value" : 3}])
+		self.assertEqual(metrics_dict["histograms"]["request_seconds"],[{"labels" : {"method" : "GET"}, "buckets" : {0.1 : 1, 1 : 2}, "sum" : 0.55, "count" : 2}])
+	
+	def test_to_prometheus(self):
+		
+		prometheus_text = self.metrics.toPrometheus()
+		
+		self.assertIn('# TYPE requests_total counter\nrequests_total{method="GET"} 3\n',prometheus_text)
+		self.assertIn('request_seconds_bucket{method="GET",le="0.1"} 1\n',prometheus_text)
+		self.assertIn('request_seconds_bucket{method="GET",le="+Inf"} 2\n',prometheus_text)
+		self.assertIn('request_seconds_count{method="GET"} 2\n',prometheus_text)
+
+
+class TracerTestCase(unittest.TestCase):
 	
 	def setUp(self):
 		
-		self.session = ormchair.Session("http://127.0.0.1:5984",username="testadmin", password="testadmin")
+		self.exporter = ormchair.InMemorySpanExporter()
+		self.log_records = []
 		
-		if self.session.databaseExists("test_ormchair"):
-			self.session.deleteDatabase("test_ormchair")
+		class ListHandler(logging.Handler):
+			def emit(handler,record):
+				self.log_records.append(record)
 		
-		self.test_ormchair_db = self.session.createDatabase("test_ormchair")
+		self.logger = logging.getLogger("ormchair.test_tracer")
+		self.logger.propagate = False
+		self.logger.addHandler(ListHandler())
 		
-		# Test data
-		@ormchair._id("_design/all_pets")
-		class AllPetsDesignDocument(ormchair.DesignDocument):
-			
-			all_pets = ormchair.View({
-				"map" :(
-					'function(doc) {'
-						'if(doc.type_=="pet") {'
-							'emit(doc._id,null);'
-						'}'
-					'}'
-				)
-			})
+		self.tracer = ormchair.Tracer(self.exporter,slow_threshold=0,logger=self.logger)
+	
+	def tearDown(self):
+		
+		self.logger.handlers = []
+		self.tracer = None
+		self.exporter = None
+	
+	def test_nested_spans(self):
+		
+		with self.tracer.startSpan("Database.update") as root_span:
+			with self.tracer.startSpan("HTTP PUT",{"method" : "PUT", "endpoint" : "doc"}):
+				pass
+			with self.tracer.startSpan("Database.updateMultiple"):
+				with self.tracer.startSpan("HTTP POST",{"method" : "POST", "endpoint" : "_bulk_docs"}):
+					pass
+		
+		self.assertIsNone(self.tracer.getCurrentSpan())
+		self.assertEqual(self.exporter.getRootSpans(),[root_span])
+		self.assertEqual([span.name for span in root_span.children],["HTTP PUT","Database.updateMultiple"])
+		self.assertEqual(root_span.children[1].children[0].trace_id,root_span.trace_id)
+		self.assertEqual(root_span.toDict()["children"][1]["parent_id"],root_span.span_id)
+		self.assertEqual(len(self.exporter.getSpans()),4)
+	
+	def test_span_error(self):
 		
+		try:
+			with self.tracer.startSpan("Database.get"):
+				raise ValueError("missing")
+		except ValueError:
+			pass
 		
-		class Pet(ormchair.Document):
+		self.assertEqual(self.exporter.getSpans("Database.get")[0].error,"ValueError('missing',)")
+		self.assertIsNone(self.tracer.getCurrentSpan())
 	
-			name = ormchair.StringProperty(default="dog")
-			
-			all = ormchair.View({
-				"map" :(
-					'function(doc) {'
-						'if(doc.type_=="pet") {'
-							'emit(doc._id,null);'
-						'}'
-					'}'
-				)
-			})
-				
+	def test_slow_operation_log(self):
 		
-		class Person(ormchair.Document):
-			
-			name = ormchair.StringProperty(default="joe bloggs")
-			address = ormchair.DictProperty(
-				address_1 = ormchair.StringProperty(),
-				address_2 = ormchair.StringProperty(default="wessex"),
-				postcode = ormchair.DictProperty(
-					postcode_1 = ormchair.StringProperty(),
-					postcode_2 = ormchair.StringProperty(),
-					extra_postcodes = ormchair.ListProperty(
-						ormchair.StringProperty()
-					)
-				)
-			)
-			
-			other_addresses = ormchair.ListProperty(
-				ormchair.DictProperty(
-					address_1 = ormchair.StringProperty(),
-					address_2 = ormchair.StringProperty(default="wessex")
-				)
-			)
-			
-			related_pets = ormchair.LinkProperty(Pet,reverse="owner",index_property_paths=["name"],reverse_index_property_paths=["address.postcode.postcode_1"])
-			
-			best_pet = ormchair.EmbeddedLinkProperty(Pet)
-			
-			owned_pets = ormchair.ListProperty(
-				ormchair.EmbeddedLinkProperty(Pet)
-			)
-			
-			
-			get_by_name = ormchair.Index("name")
-			get_by_name_and_address = ormchair.Index("name","address.address_1")
+		with self.tracer.startSpan("Database.addLinks"):
+			with self.tracer.startSpan("HTTP PUT",{"method" : "PUT", "endpoint" : "doc"}):
+				pass
+			with self.tracer.startSpan("HTTP PUT",{"method" : "PUT", "endpoint" : "doc"}):
+				pass
 		
-		self.pet_class = Pet
-		self.person_class = Person
-		self.all_pets_design_document_class = AllPetsDesignDocument
+		self.assertEqual(len(self.log_records),1)
+		self.assertIn("Slow operation Database.addLinks",self.log_records[0].getMessage())
+		self.assertIn("with 2 HTTP requests (2 x PUT doc)",self.log_records[0].getMessage())
+
+
+class FakeCouchDBServerTestCase(unittest.TestCase):
+	
+	def setUp(self):
 		
-		self.test_ormchair_db.sync()
+		class Note(ormchair.Document):
+			text = ormchair.StringProperty()
 		
+		self.note_class = Note
+		
+		self.server = ormchair_testing.FakeCouchDBServer(seed=1).start()
+		self.session = ormchair.Session(self.server.getUrl())
+		self.database = self.session.createDatabase("test_fake_couchdb")
+	
 	def tearDown(self):
 		
+		self.server.stop()
+		self.server = None
 		self.session = None
-		self.pet_class = None
-		self.person_class = None
-		self.all_pets_design_document_class = None
-		self.test_ormchair_db = None
+		self.database = None
+		self.note_class = None
 	
-	def test_sync(self):
+	def test_map_function_translator(self):
 		
-		all_pets_design_document = self.test_ormchair_db.get("_design/all_pets")
-		pet_schema_design_document = self.test_ormchair_db.get(self.pet_class.getSchemaDesignDocumentId())
-		person_schema_design_document = self.test_ormchair_db.get(self.person_class.getSchemaDesignDocumentId())
+		map_function = ormchair_testing._MapFunctionTranslator("function(doc){ if(doc.type_=='pet'){ emit([doc.name,doc.owner.name],doc._id); } }").translate()
 		
-		self.assertTrue(issubclass(all_pets_design_document.__class__,ormchair.DesignDocument))
-		self.assertTrue(issubclass(pet_schema_design_document.__class__,ormchair.DesignDocument))
-		self.assertTrue(issubclass(person_schema_design_document.__class__,ormchair.DesignDocument))
+		emitted = []
+		map_function({"_id" : "1", "type_" : "pet", "name" : "Pooch", "owner" : {"name" : "Will"}},lambda key,value: emitted.append((key,value)))
+		map_function({"_id" : "2", "type_" : "person", "name" : "Will"},lambda key,value: emitted.append((key,value)))
 		
-		self.assertTrue(len(all_pets_design_document._rev)>0)
-		self.assertTrue(len(pet_schema_design_document._rev)>0)
-		self.assertTrue(len(person_schema_design_document._rev)>0)
+		self.assertEqual(emitted,[(["Pooch","Will"],"1")])
 	
-	def test_add_document(self):
+	def test_request_counts(self):
 		
-		person1 = self.person_class()
-		person1.name = "Will"
-
-		try:
-			person1 = self.test_ormchair_db.add(person1)
-			person1_fetched = self.test_ormchair_db.get(person1._id)
-			self.assertEqual(person1, person1_fetched)
-		except Exception as e:
-			self.fail()
+		self.server.resetRequestCounts()
 		
-	def test_add_documents(self):
+		note = self.note_class()
+		self.database.add(note)
+		self.database.get(note._id)
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		self.assertEqual(self.server.getRequestCounts(),{("PUT","doc") : 1, ("GET","doc") : 1})
+	
+	def test_latency(self):
 		
-		person2 = self.person_class()
-		person2.name = "Tom"
+		self.server.setLatency(0.05)
 		
-		pet1 = self.pet_class()
-		pet1.name = "Pooch"
+		start = time.time()
+		self.database.existsMultiple(["missing"])
 		
-		pet2 = self.pet_class()
-		pet2.name = "Snoop"
+		self.assertGreaterEqual(time.time() - start,0.05)
+	
+	def test_failure_rate(self):
 		
-		self.assertNotEqual(person1.name, person2.name)
-		self.assertNotEqual(pet1.name, pet2.name)
+		self.server.setFailureRate(1)
 		
-		try:
-			self.test_ormchair_db.addMultiple([person1,person2,pet1,pet2])
-			fetched = self.test_ormchair_db.getMultiple([person1._id,person2._id,pet1._id,pet2._id])
-			self.assertEqual(person1, fetched[0])
-			self.assertEqual(person2, fetched[1])
-			self.assertEqual(pet1, fetched[2])
-			self.assertEqual(pet2, fetched[3])
-			
-		except Exception as e:
-			self.fail()
-			
-	def test_delete_document(self):
+		r = requests.get("%s/test_fake_couchdb" % (self.server.getUrl()))
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		self.assertEqual(r.status_code,500)
+		self.assertEqual(r.json()["error"],"injected_failure")
+	
+	def test_changes(self):
 		
-		self.test_ormchair_db.add(person1)
+		self.database.add(self.note_class())
+		second_note = self.database.add(self.note_class())
 		
-		person1_fetched = self.test_ormchair_db.get(person1._id)
-		self.assertEquals(person1, person1_fetched)
+		r = requests.get("%s/test_fake_couchdb/_changes" % (self.server.getUrl()),params={"since" : 1})
 		
-		self.test_ormchair_db.delete(person1)
-		self.assertRaises(Exception, self.test_ormchair_db.get,person1._id)
+		self.assertEqual([change["id"] for change in r.json()["results"]],[second_note._id])
+		self.assertEqual(r.json()["last_seq"],2)
+
+
+class NodePoolTestCase(unittest.TestCase):
+	
+	def setUp(self):
 		
-	def test_delete_documents(self):
+		class Note(ormchair.Document):
+			text = ormchair.StringProperty()
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		self.note_class = Note
 		
-		person2 = self.person_class()
-		person2.name = "Tom"
+		# Three nodes of one cluster
+		self.primary = ormchair_testing.FakeCouchDBServer().start()
+		self.servers = [self.primary] + [ormchair_testing.FakeCouchDBServer(cluster=self.primary).start() for i in range(2)]
 		
-		self.test_ormchair_db.addMultiple([person1,person2])
+		self.node_pool = ormchair.NodePool([server.getUrl() for server in self.servers],backoff=0.05)
+		self.session = ormchair.Session(self.node_pool,username="testadmin",password="testadmin")
+		self.database = self.session.createDatabase("test_node_pool")
 		
-		persons_fetched = self.test_ormchair_db.getMultiple([person1._id,person2._id])
-		self.assertIn(person1, persons_fetched)
-		self.assertIn(person2, persons_fetched)
+		self.notes = [self.note_class() for i in range(6)]
+		self.database.addMultiple(self.notes)
 		
-		self.test_ormchair_db.deleteMultiple([person1,person2])
-		self.assertRaises(Exception, self.test_ormchair_db.getMultiple,[person1._id,person2._id])
-			
-	def test_update_documents(self):
+		for server in self.servers:
+			server.resetRequestCounts()
+	
+	def tearDown(self):
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		for server in self.servers:
+			server.stop()
+	
+	def test_read_balancing(self):
 		
-		person2 = self.person_class()
-		person2.name = "Tom"
-				
-		try:
-			self.test_ormchair_db.addMultiple([person1,person2])
-			
-			# Make rev old version so update should fail for person1
-			old_rev = person1._rev
-			person1.name = "Will2"
-			self.test_ormchair_db.update(person1)
-			person1._rev = old_rev
+		for note in self.notes:
+			self.database.get(note._id)
+		
+		self.database.getMultiple([note._id for note in self.notes])
+		self.database.update(self.notes[0])
+		
+		# Reads spread evenly, writes to the primary
+		self.assertEqual([server.getRequestCounts().get(("GET","doc"),0) for server in self.servers],[2,2,2])
+		self.assertEqual([server.getRequestCounts().get(("PUT","doc"),0) for server in self.servers],[1,0,0])
+		self.assertEqual(sum([server.getRequestCounts().get(("POST","_all_docs"),0) for server in self.servers]),1)
+	
+	def test_hedging(self):
+		
+		metrics = self.session.getMetrics()
+		
+		database = self.session.getDatabase("test_node_pool",hedging=ormchair.Hedging(max_delay=0.1,budget=1))
+		database_unhedged = self.session.getDatabase("test_node_pool",hedging=ormchair.Hedging(max_delay=0.1,budget=0))
+		
+		# One slow node
+		self.servers[1].setLatency(0.5)
+		
+		for note in self.notes:
 			
-			(ok_docs,failed_docs) = self.test_ormchair_db.updateMultiple([person1,person2])
+			start = time.time()
+			self.assertEqual(database.get(note._id)._id,note._id)
+			self.assertTrue(time.time() - start < 0.4)
+		
+		stats = database.getHedging().getStats()
+		self.assertEqual(stats["reads"],6)
+		self.assertTrue(stats["wins"] >= 1)
+		self.assertTrue(stats["hedges"] >= stats["wins"])
+		self.assertEqual(metrics.getCounter("ormchair_hedge_wins_total",{"database" : "test_node_pool"}),stats["wins"])
+		self.assertEqual(metrics.getCounter("ormchair_hedged_reads_total",{"database" : "test_node_pool"}),6)
+		
+		# Over budget so waits for the slow node (once the discarded requests have finished)
+		time.sleep(0.5)
+		slow_reads = 0
+		
+		for note in self.notes[:3]:
 			
-			self.assertEqual(ok_docs[0], person2)
-			self.assertEqual(failed_docs[0], person1)
+			start = time.time()
+			database_unhedged.getMultiple([note._id])
+			slow_reads += 1 if time.time() - start >= 0.4 else 0
 		
-		except Exception as e:
-			self.fail()
+		self.assertTrue(slow_reads >= 1)
+		self.assertEqual(database_unhedged.getHedging().getStats()["hedges"],0)
+		self.assertTrue(database_unhedged.getHedging().getStats()["skipped"] >= slow_reads)
 	
-	def test_add_embedded_link(self):
+	def test_failover(self):
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		metrics = self.session.getMetrics()
 		
-		pet1 = self.pet_class()
-		pet1.name = "Pooch"
+		# Reads fail over and the node is ejected
+		self.servers[1].setFailureRate(1)
 		
-		person1.best_pet = pet1
+		for note in self.notes:
+			self.assertEqual(self.database.get(note._id)._id,note._id)
 		
-		self.test_ormchair_db.update(person1)
+		self.assertEqual(self.servers[1].getRequestCounts().get(("GET","doc")),1)
+		self.assertFalse(self.node_pool.getStats()[1]["healthy"])
+		self.assertEqual(metrics.getCounter("ormchair_node_ejections_total",{"node" : self.servers[1].getUrl()}),1)
+		self.assertEqual(metrics.getCounter("ormchair_node_failovers_total",{"node" : self.servers[1].getUrl()}),1)
 		
-		fetched_person1 = self.test_ormchair_db.get(person1._id)
+		# Restored once health checked after the backoff
+		self.servers[1].setFailureRate(0)
+		time.sleep(0.1)
 		
-		self.assertEqual(fetched_person1.best_pet,pet1._id)
-	
-	def test_add_link(self):
+		for note in self.notes:
+			self.database.get(note._id)
 		
-		person1 = self.person_class()
-		person1.name = "Will"
+		self.assertTrue(self.node_pool.getStats()[1]["healthy"])
+		self.assertEqual(self.servers[1].getRequestCounts().get(("GET","doc")),3)
 		
-		pet1 = self.pet_class()
-		pet1.name = "Pooch"
+		# Writes move to the next node when the primary is down
+		self.primary.stop()
 		
-		self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		self.assertRaises(requests.ConnectionError,self.database.update,self.notes[0])
+		self.database.update(self.notes[0])
 		
-		person1_related_pets = self.test_ormchair_db.getLinks(person1.related_pets)
+		self.assertEqual(self.servers[1].getRequestCounts().get(("PUT","doc")),1)
+		self.assertFalse(self.node_pool.getStats()[0]["healthy"])
 		
-		self.assertEqual(pet1, person1_related_pets[0])
+		# Nothing healthy so the node due a check is tried
+		self.servers[1].stop()
+		self.servers[2].stop()
+		self.assertRaises(requests.ConnectionError,self.database.get,self.notes[0]._id)
 
-	def test_add_links(self):
+
+class ShardedDatabaseTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		class ShardedPerson(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			age = ormchair.IntegerProperty()
+			
+			get_by_age = ormchair.Index("age")
+		
+		class ShardedPet(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+		
+		self.person_class = ShardedPerson
+		self.pet_class = ShardedPet
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+		
+		self.databases = []
+		for i in range(3):
+			
+			if self.session.databaseExists("test_ormchair_shard_%d" % (i)):
+				self.session.deleteDatabase("test_ormchair_shard_%d" % (i))
+			
+			self.databases.append(self.session.createDatabase("test_ormchair_shard_%d" % (i)))
+		
+		# Small pages so merging has to page
+		self.sharded_database = ormchair.ShardedDatabase(self.databases,page_size=2)
+		self.sharded_database.sync()
+		
+		self.people = []
+		for i in range(20):
+			person = self.person_class()
+			person.name = "person_%d" % (i)
+			person.age = i % 5
+			self.people.append(person)
+		
+		self.sharded_database.addMultiple(self.people)
+	
+	def tearDown(self):
+		
+		for i in range(3):
+			self.session.deleteDatabase("test_ormchair_shard_%d" % (i))
+	
+	def test_routing(self):
+		
+		# Spread over the shards, each document only on its own
+		shard_ids = [database.existsMultiple([person._id for person in self.people]) for database in self.databases]
+		self.assertEqual(sum([len(_ids) for _ids in shard_ids]),20)
+		self.assertTrue(all([len(_ids) > 0 for _ids in shard_ids]))
+		
+		for person in self.people:
+			self.assertTrue(person._id in self.sharded_database.getShard(person).existsMultiple([person._id]))
+			self.assertEqual(self.sharded_database.get(person._id).name,person.name)
+		
+		_ids = [person._id for person in reversed(self.people)] + ["missing"]
+		documents = self.sharded_database.getMultiple(_ids)
+		self.assertEqual([document._id for document in documents[:-1]],_ids[:-1])
+		self.assertEqual(documents[-1]["error"],"not_found")
+		
+		self.assertEqual(self.sharded_database.existsMultiple(_ids),_ids[:-1])
+		
+		self.people[0].name = "renamed"
+		self.sharded_database.update(self.people[0])
+		self.assertEqual(self.sharded_database.get(self.people[0]._id).name,"renamed")
+		
+		(ok_documents,failed_documents) = self.sharded_database.deleteMultiple(self.people[:5])
+		self.assertEqual(len(ok_documents),5)
+		self.assertFalse(self.sharded_database.exists(self.people[0]._id))
+	
+	def test_scatter_gather(self):
+		
+		expected = sorted(self.people,key=lambda person: (person.age,person._id))
+		
+		people = self.sharded_database.getByIndex(self.person_class.get_by_age,startkey=1,endkey=3)
+		self.assertEqual([person._id for person in people],[person._id for person in expected if 1 <= person.age <= 3])
+		
+		people = self.sharded_database.getByIndex(self.person_class.get_by_age,startkey=0,endkey=4,skip=3,limit=7)
+		self.assertEqual([person._id for person in people],[person._id for person in expected][3:10])
+		
+		# Keys with more rows than a page
+		people = self.sharded_database.getByIndex(self.person_class.get_by_age,key=2)
+		self.assertEqual([person._id for person in people],[person._id for person in expected if person.age == 2])
+		
+		people = self.sharded_database.getByIndex(self.person_class.get_by_age,startkey=4,endkey=0,descending=True,limit=5)
+		self.assertEqual([person._id for person in people],[person._id for person in reversed(expected)][:5])
+		
+		people = self.sharded_database.getByIndex(self.person_class.get_by_age,keys=[4,1])
+		self.assertEqual(sorted([person._id for person in people]),sorted([person._id for person in self.people if person.age in [1,4]]))
+	
+	def test_mixed_case_keys(self):
+		
+		class ShardedTag(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			
+			get_by_name = ormchair.Index("name")
+		
+		self.sharded_database.sync()
+		
+		tags = []
+		for name in ["b","B","ba","a","A","aa","Ab","ab","1","~"]:
+			tag = ShardedTag()
+			tag.name = name
+			tags.append(tag)
+		
+		self.sharded_database.addMultiple(tags)
+		
+		# Merged in couchdb's collation order (lowercase first, case only breaking ties) as each shard returns its rows
+		self.assertEqual([tag.name for tag in self.sharded_database.getByIndex(ShardedTag.get_by_name,startkey=[""],endkey=[{}])],["~","1","a","A","aa","ab","Ab","b","B","ba"])
+		self.assertEqual([tag.name for tag in self.sharded_database.getByIndex(ShardedTag.get_by_name,startkey=[""],endkey=[{}],skip=3,limit=4)],["A","aa","ab","Ab"])
+		self.assertEqual([tag.name for tag in self.sharded_database.getByIndex(ShardedTag.get_by_name,startkey=[{}],endkey=[""],descending=True,limit=3)],["ba","B","b"])
+	
+	def test_collation_order(self):
+		
+		# Fixed orderings from the couchdb collation specification
+		self.assertEqual(sorted(["B","b","aa","A","a"],key=ormchair._collationKey),["a","A","aa","b","B"])
+		self.assertEqual(sorted([u"f",u"\xc9",u"e",u"\xe9",u"E"],key=ormchair._collationKey),[u"e",u"E",u"\xe9",u"\xc9",u"f"])
+		self.assertEqual(sorted(["a","~","10","1"],key=ormchair._collationKey),["~","1","10","a"])
+		self.assertEqual(sorted([{"a" : 1},["b"],["a",1],["a"],"a",2.5,1,True,False,None],key=ormchair._collationKey),[None,False,True,1,2.5,"a",["a"],["a",1],["b"],{"a" : 1}])
+		self.assertEqual(ormchair._collationKey(("a",1)),ormchair._collationKey(["a",1]))
+		
+		# As are the stand-in server's views
+		class CollatedTag(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			
+			get_by_name = ormchair.Index("name")
+		
+		self.databases[0].sync()
+		
+		for name in [u"b",u"\xe9",u"B",u"A",u"e",u"a",u"1"]:
+			tag = CollatedTag()
+			tag.name = name
+			self.databases[0].add(tag)
+		
+		self.assertEqual([tag.name for tag in self.databases[0].getByIndex(CollatedTag.get_by_name,startkey=[""],endkey=[{}])],[u"1",u"a",u"A",u"b",u"B",u"e",u"\xe9"])
+	
+	def test_sync(self):
+		
+		for database in self.databases:
+			self.assertTrue(database.exists(self.person_class.getSchemaDesignDocumentId()))
+	
+	def test_shard_by_type(self):
+		
+		sharded_database = ormchair.ShardedDatabase(self.databases,shard_by="type")
+		
+		pet = self.pet_class()
+		pet.name = "dog"
+		sharded_database.add(pet)
+		
+		self.assertTrue(sharded_database.getShard(self.pet_class()).exists(pet._id))
+		self.assertEqual(sharded_database.get(pet._id).name,"dog")
+		self.assertEqual(sharded_database.getMultiple([pet._id,"missing"])[0]._id,pet._id)
+		self.assertRaises(Exception,sharded_database.get,"missing")
+		self.assertRaises(Exception,sharded_database.getShard,pet._id)
+
+
+class PartitionedDatabaseTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		@ormchair.partitionKey("account")
+		class PartitionedOrder(ormchair.Document):
+			
+			account = ormchair.StringProperty()
+			total = ormchair.IntegerProperty()
+			
+			get_by_total = ormchair.Index("total")
+		
+		class PartitionedNote(ormchair.Document):
+			
+			text = ormchair.StringProperty()
+		
+		self.order_class = PartitionedOrder
+		self.note_class = PartitionedNote
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+		
+		for database_name in ["test_ormchair_partitioned","test_ormchair_partitioned_mango"]:
+			if self.session.databaseExists(database_name):
+				self.session.deleteDatabase(database_name)
+		
+		self.database = self.session.createDatabase("test_ormchair_partitioned",partitioned=True)
+		self.database.sync()
+		
+		self.orders = []
+		for i in range(12):
+			order = self.order_class()
+			order.account = "account_%d" % (i % 3)
+			order.total = i
+			self.orders.append(order)
+		
+		self.database.addMultiple(self.orders[:6])
+		for order in self.orders[6:]:
+			self.database.add(order)
+	
+	def tearDown(self):
+		
+		for database_name in ["test_ormchair_partitioned","test_ormchair_partitioned_mango"]:
+			if self.session.databaseExists(database_name):
+				self.session.deleteDatabase(database_name)
+	
+	def test_partitioned_ids(self):
+		
+		self.assertTrue(self.session.getDatabase("test_ormchair_partitioned").isPartitioned())
+		
+		for order in self.orders:
+			self.assertTrue(order._id.startswith(order.account + ":"))
+			self.assertEqual(order.getPartition(),order.account)
+		
+		# The partition is fixed once added
+		self.orders[0].account = "account_9"
+		self.database.update(self.orders[0])
+		self.assertEqual(self.database.get(self.orders[0]._id).getPartition(),"account_0")
+		
+		order = self.order_class()
+		self.assertRaises(ormchair.ValidationError,self.database.add,order)
+		order.account = "_account"
+		self.assertRaises(ormchair.ValidationError,self.database.add,order)
+		
+		# Design documents are partitioned only for partitioned document classes
+		self.assertTrue(self.database.get(self.order_class.getSchemaDesignDocumentId(),as_json=True)["options"]["partitioned"])
+		self.assertFalse(self.database.get(self.note_class.getSchemaDesignDocumentId(),as_json=True)["options"]["partitioned"])
+		
+		# Syncing again doesn't change them
+		rev = self.database.get(self.order_class.getSchemaDesignDocumentId(),as_json=True)["_rev"]
+		self.database.sync()
+		self.assertEqual(self.database.get(self.order_class.getSchemaDesignDocumentId(),as_json=True)["_rev"],rev)
+	
+	def test_partition_queries(self):
+		
+		orders = self.database.getByIndex(self.order_class.get_by_total,startkey=[0],endkey=[100],partition="account_1")
+		self.assertEqual([order.total for order in orders],[1,4,7,10])
+		
+		orders = self.database.getByIndex(self.order_class.get_by_total,key=[4],partition="account_1")
+		self.assertEqual([order._id for order in orders],[self.orders[4]._id])
+		self.assertEqual(self.database.getByIndex(self.order_class.get_by_total,key=[4],partition="account_2"),[])
+		
+		# Partitioned views can't be queried globally
+		self.assertRaises(Exception,self.database.getByIndex,self.order_class.get_by_total,key=[4])
+		
+		orders = self.database.getByPartition("account_2")
+		self.assertEqual(sorted([order.total for order in orders]),[2,5,8,11])
+		self.assertEqual(len(self.database.getByPartition("account_2",limit=2)),2)
+		self.assertEqual(self.database.getPartitionInfo("account_2")["doc_count"],4)
+		
+		self.assertEqual(sorted([order.total for order in self.database.find({"type_" : "partitionedorder"},partition="account_0")]),[0,3,6,9])
+		
+		# Mango indexes are partitioned too
+		mango_database = self.session.createDatabase("test_ormchair_partitioned_mango",partitioned=True,index_backend="mango")
+		mango_database.sync()
+		mango_database.addMultiple([self._copyOrder(order) for order in self.orders])
+		
+		orders = mango_database.getByIndex(self.order_class.get_by_total,startkey=[0],endkey=[100],partition="account_0")
+		self.assertEqual([order.total for order in orders],[0,3,6,9])
+	
+	# A new unsaved copy of an order
+	def _copyOrder(self,order):
+		
+		order_copy = self.order_class()
+		order_copy.account = order.account
+		order_copy.total = order.total
+		
+		return order_copy
+	
+	def test_partitioned_links(self):
+		
+		@ormchair.partitionKey("account")
+		class PartitionedCustomer(ormchair.Document):
+			
+			account = ormchair.StringProperty()
+			
+			orders = ormchair.LinkProperty(self.order_class,reverse="customer")
+		
+		self.database.sync()
+		
+		customer = PartitionedCustomer()
+		customer.account = "account_0"
+		
+		# Links across partitions are stored in the partition of one of the documents
+		link_documents = self.database.addLinks(customer.orders,[self.orders[0],self.orders[3],self.orders[1]])
+		
+		self.assertEqual(len(link_documents),3)
+		for link_document in link_documents:
+			self.assertIn(link_document._id.split(":",1)[0],["account_0","account_1"])
+		
+		self.assertEqual(sorted([order._id for order in self.database.getLinks(customer.orders)]),sorted([self.orders[0]._id,self.orders[3]._id,self.orders[1]._id]))
+		self.assertEqual([linked_customer._id for linked_customer in self.database.getLinks(self.orders[1].customer)],[customer._id])
+		
+		# The same link document from either side
+		self.assertEqual(self.database.addLink(self.orders[1].customer,customer)[0]._id,link_documents[2]._id)
+		self.assertEqual(len(self.database.getLinks(customer.orders)),3)
+		
+		# Documents added before their class was partitioned aren't in a partition
+		order = self.order_class()
+		order.account = "account_0"
+		order._id = "unpartitioned"
+		order._rev = "1-abc"
+		self.assertEqual(order.getPartition(),None)
+	
+	def test_non_partitioned_database(self):
+		
+		database = self.session.createDatabase("test_ormchair_partitioned_mango")
+		database.sync()
+		
+		# Partitioned classes can still be stored (with their partitioned ids) but not queried by partition
+		order = self._copyOrder(self.orders[0])
+		database.add(order)
+		self.assertTrue(order._id.startswith("account_0:"))
+		self.assertEqual(database.getByIndex(self.order_class.get_by_total,key=[0])[0]._id,order._id)
+		self.assertFalse("options" in database.get(self.order_class.getSchemaDesignDocumentId(),as_json=True))
+		self.assertRaises(Exception,database.getByPartition,"account_0")
+
+
+class SchemaMigrationTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		class MigratingPerson(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+		
+		if self.session.databaseExists("test_ormchair_migration"):
+			self.session.deleteDatabase("test_ormchair_migration")
+		
+		self.database = self.session.createDatabase("test_ormchair_migration")
+		self.database.sync()
+		
+		people = []
+		for i in range(11):
+			person = MigratingPerson()
+			person.name = "first_%d last_%d" % (i,i)
+			people.append(person)
+		
+		# Can't be split so fails to migrate
+		people[5].name = "unsplittable"
+		
+		self.database.addMultiple(people)
+		self.people = people
+		
+		# Redefine the class with a new schema (replacing the old one) and sync to bump the version
+		class MigratingPerson(ormchair.Document):
+			
+			first_name = ormchair.StringProperty()
+			last_name = ormchair.StringProperty()
+		
+		@ormchair.migration(MigratingPerson,0)
+		def splitName(document_data):
+			(document_data["first_name"],document_data["last_name"]) = document_data.pop("name").split(" ")
+			return document_data
+		
+		self.person_class = MigratingPerson
+		self.database.sync()
+	
+	def tearDown(self):
+		
+		self.session.deleteDatabase("test_ormchair_migration")
+	
+	def test_migrate(self):
+		
+		self.assertEqual(self.person_class.getCurrentSchemaVersion(),1)
+		self.assertTrue(isinstance(self.database.get(self.people[0]._id),ormchair.UnboundDocument))
+		
+		# The migration view isn't synced, the first run creates it
+		self.assertFalse("_design/_migration" in self.database.getDesignDocumentIds())
+		self.assertRaises(Exception,self.database.get,"_design/_migration",as_json=True)
+		
+		migration = ormchair.SchemaMigration(self.database,[self.person_class],batch_size=2,workers=2)
+		
+		# Dry runs don't write
+		report = migration.run(dry_run=True)["migratingperson"]
+		self.assertEqual((report["scanned"],report["migrated"],report["failed"],report["failed_ids"]),(11,10,1,[self.people[5]._id]))
+		self.assertTrue(isinstance(self.database.get(self.people[0]._id),ormchair.UnboundDocument))
+		self.assertEqual(migration.getCheckpoint(self.person_class),None)
+		
+		self.assertEqual(self.database.get("_design/_migration",as_json=True)["_id"],"_design/_migration")
+		
+		report = migration.run()["migratingperson"]
+		self.assertEqual((report["scanned"],report["migrated"],report["failed"]),(11,10,1))
+		
+		person = self.database.get(self.people[0]._id)
+		self.assertEqual((person.first_name,person.last_name,person.schema_version_),("first_0","last_0",1))
+		self.assertEqual(self.session.getMetrics().getCounter("ormchair_migrated_documents_total",{"type" : "migratingperson", "status" : "ok"}),10)
+		
+		# Resuming carries on from the checkpoint so the failure isn't retried, starting again is
+		self.assertEqual(migration.getCheckpoint(self.person_class)["to_version"],1)
+		self.assertEqual(migration.run()["migratingperson"]["scanned"],0)
+		
+		migration.resetCheckpoint(self.person_class)
+		self.assertEqual(migration.start(resume=False).wait(),True)
+		self.assertEqual(migration.getProgress()["migratingperson"]["failed_ids"],[self.people[5]._id])
+	
+	def test_migrate_on_read(self):
+		
+		database = self.session.getDatabase("test_ormchair_migration",migrate_on_read=True,write_back=ormchair.MigrationWriteBack(flush_interval=10))
+		
+		# Chains are composed once
+		self.assertTrue(self.person_class.getMigrationChain(0) is self.person_class.getMigrationChain(0))
+		self.assertEqual(self.person_class.getMigrationChain(1,2),None)
+		
+		person = database.get(self.people[0]._id)
+		self.assertEqual((person.first_name,person.last_name,person.schema_version_),("first_0","last_0",1))
+		
+		# Documents that can't be migrated are still unbound, and only warned about once
+		warnings = []
+		warning_handler = logging.Handler(logging.WARNING)
+		warning_handler.emit = warnings.append
+		logging.getLogger("ormchair").addHandler(warning_handler)
+		
+		try:
+			people = database.getMultiple([person._id for person in self.people])
+			database.get(self.people[5]._id)
+		finally:
+			logging.getLogger("ormchair").removeHandler(warning_handler)
+		
+		self.assertEqual([isinstance(person,ormchair.UnboundDocument) for person in people],[i == 5 for i in range(11)])
+		self.assertEqual(len(warnings),1)
+		
+		# Nothing written until flushed, then each document only once
+		self.assertTrue(isinstance(self.database.get(self.people[0]._id),ormchair.UnboundDocument))
+		self.assertEqual(database.getWriteBack().getPendingCount(),10)
+		
+		# Documents saved since they were read conflict and are skipped
+		person = database.get(self.people[1]._id)
+		person.first_name = "changed"
+		database.update(person)
+		
+		database.getWriteBack().flush()
+		
+		self.assertEqual(self.database.get(self.people[0]._id).first_name,"first_0")
+		self.assertEqual(self.database.get(self.people[1]._id).first_name,"changed")
+		self.assertEqual(database.getWriteBack().getStats()["written"],9)
+		self.assertEqual(database.getWriteBack().getStats()["conflicts"],1)
+		self.assertEqual(database.getWriteBack().getPendingCount(),0)
+		
+		# Closing writes what's pending and stops the thread
+		person_data = self.database.get(self.people[2]._id,as_json=True)
+		person_data["first_name"] = "closed"
+		database.getWriteBack().add(self.person_class,person_data)
+		
+		database.close()
+		
+		self.assertEqual(self.database.get(self.people[2]._id).first_name,"closed")
+		self.assertFalse(database.getWriteBack()._thread.is_alive())
+		
+		database.getWriteBack().add(self.person_class,self.database.get(self.people[3]._id,as_json=True))
+		self.assertEqual(database.getWriteBack().getStats()["dropped"],1)
+	
+	def test_migrate_document_data(self):
+		
+		document_data = {"name" : "first last", "schema_version_" : 0}
+		
+		self.assertEqual(self.person_class.migrateDocumentData(document_data),{"first_name" : "first", "last_name" : "last", "schema_version_" : 1})
+		self.assertEqual(document_data["name"],"first last")
+		self.assertRaises(ormchair.MigrationError,self.person_class.migrateDocumentData,{"schema_version_" : 1},to_version=2)
+		self.assertRaises(ormchair.MigrationError,self.person_class.migrateDocumentData,{"schema_version_" : None})
+
+
+class BenchTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+	
+	def tearDown(self):
+		
+		self.session = None
+	
+	def test_run_scenario(self):
+		
+		options = ormchair_bench.parseArguments(["mixed","--threads","2","--operations","5","--documents","20","--database","test_ormchair_bench"])
+		
+		result = ormchair_bench.runScenario(self.session,ormchair_bench.MixedScenario,options)
+		
+		self.assertEqual(result["errors"],0)
+		self.assertEqual(sum([operation["count"] for operation in result["operations"].values()]),10)
+		self.assertEqual(result["operations"]["get"]["requests_per_call"],1)
+		self.assertFalse(self.session.databaseExists("test_ormchair_bench"))
+
+
+class JSONCodecTestCase(unittest.TestCase):
+	
+	def test_get_json_codec(self):
+		
+		self.assertIsInstance(ormchair.getJSONCodec("json"),ormchair.JSONCodec)
+		self.assertIsInstance(ormchair.getJSONCodec(),ormchair.JSONCodec)
+		self.assertRaises(Exception,ormchair.getJSONCodec,"missing")
+		
+		# Floats round trip with the automatically picked codec
+		json_codec = ormchair.getJSONCodec()
+		self.assertNotIsInstance(json_codec,ormchair.UJSONCodec)
+		self.assertEqual(json_codec.loads(json_codec.dumps([0.1 + 0.2])),[0.1 + 0.2])
+	
+	def test_round_trip(self):
+		
+		for json_codec_class in [ormchair.JSONCodec,ormchair.SimpleJSONCodec,ormchair.UJSONCodec]:
+			
+			if json_codec_class.isAvailable():
+				
+				json_codec = json_codec_class()
+				self.assertEqual(json_codec.loads(json_codec.dumps({"name" : u"caf\xe9", "values" : [1,2.5,None,True]})),{"name" : u"caf\xe9", "values" : [1,2.5,None,True]})
+
+
+class CompressionTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		class Note(ormchair.Document):
+			text = ormchair.StringProperty()
+		
+		self.note_class = Note
+		
+		self.server = ormchair_testing.FakeCouchDBServer(compress_responses=True).start()
+		self.session = ormchair.Session(self.server.getUrl(),compression=ormchair.Compression(threshold=100))
+		self.database = self.session.createDatabase("test_compression")
+	
+	def tearDown(self):
+		
+		self.server.stop()
+		self.server = None
+		self.session = None
+		self.database = None
+		self.note_class = None
+	
+	def test_should_compress(self):
+		
+		compression = ormchair.Compression(threshold=10)
+		
+		self.assertTrue(compression.shouldCompress("POST","_bulk_docs","x" * 10))
+		self.assertTrue(compression.shouldCompress("POST","view:_design/_schema_person/indexes_","x" * 10))
+		self.assertFalse(compression.shouldCompress("POST","_bulk_docs","x" * 9))
+		self.assertFalse(compression.shouldCompress("PUT","doc","x" * 10))
+		self.assertFalse(compression.shouldCompress("GET","_all_docs",None))
+	
+	def test_compression(self):
+		
+		notes = []
+		for i in range(50):
+			note = self.note_class()
+			note.text = "A repetitive note %d" % (i)
+			notes.append(note)
+		
+		self.database.addMultiple(notes)
+		fetched_notes = self.database.getMultiple([note._id for note in notes])
+		
+		self.assertEqual(sorted([note.text for note in fetched_notes]),sorted([note.text for note in notes]))
+		
+		metrics = self.session.getMetrics()
+		
+		uncompressed_bytes = metrics.getCounter("ormchair_http_uncompressed_bytes_total",{"endpoint" : "_bulk_docs", "direction" : "request"})
+		compressed_bytes = metrics.getCounter("ormchair_http_compressed_bytes_total",{"endpoint" : "_bulk_docs", "direction" : "request"})
+		self.assertGreater(uncompressed_bytes,0)
+		self.assertLess(compressed_bytes,uncompressed_bytes)
+		self.assertEqual(metrics.getHistogram("ormchair_http_compression_cpu_seconds",{"endpoint" : "_bulk_docs"})["count"],1)
+		
+		self.assertLess(
+			metrics.getCounter("ormchair_http_compressed_bytes_total",{"endpoint" : "_all_docs", "direction" : "response"}),
+			metrics.getCounter("ormchair_http_uncompressed_bytes_total",{"endpoint" : "_all_docs", "direction" : "response"})
+		)
+
+
+class SessionTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+		if self.session.databaseExists("test_ormchair"):
+			self.session.deleteDatabase("test_ormchair")
+
+	def tearDown(self):
+		
+		self.session = None
+		
+	def test_create_database(self):
+		
+		test_ormchair_db = self.session.createDatabase("test_ormchair")
+		self.assertIsInstance(test_ormchair_db,ormchair.Database)
+		
+	
+	def test_get_database(self):
+		
+		self.session.createDatabase("test_ormchair")
+		test_ormchair_db = self.session.getDatabase("test_ormchair")
+		self.assertIsInstance(test_ormchair_db,ormchair.Database)
+
+			
+	def test_delete_database(self):
+		
+		self.session.createDatabase("test_ormchair")
+		self.assertTrue(self.session.databaseExists("test_ormchair"))
+		self.session.deleteDatabase("test_ormchair")
+		self.assertFalse(self.session.databaseExists("test_ormchair"))
+		
+class DatabaseTestCase(unittest.TestCase):
+	
+	def setUp(self):
+		
+		self.session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin")
+		
+		if self.session.databaseExists("test_ormchair"):
+			self.session.deleteDatabase("test_ormchair")
+		
+		self.test_ormchair_db = self.session.createDatabase("test_ormchair")
+		
+		# Test data
+		@ormchair._id("_design/all_pets")
+		class AllPetsDesignDocument(ormchair.DesignDocument):
+			
+			all_pets = ormchair.View({
+				"map" :(
+					'function(doc) {'
+						'if(doc.type_=="pet") {'
+							'emit(doc._id,null);'
+						'}'
+					'}'
+				)
+			})
+		
+		
+		class Pet(ormchair.Document):
+	
+			name = ormchair.StringProperty(default="dog")
+			
+			all = ormchair.View({
+				"map" :(
+					'function(doc) {'
+						'if(doc.type_=="pet") {'
+							'emit(doc._id,null);'
+						'}'
+					'}'
+				)
+			})
+				
+		
+		class Person(ormchair.Document):
+			
+			name = ormchair.StringProperty(default="joe bloggs")
+			address = ormchair.DictProperty(
+				address_1 = ormchair.StringProperty(),
+				address_2 = ormchair.StringProperty(default="wessex"),
+				postcode = ormchair.DictProperty(
+					postcode_1 = ormchair.StringProperty(),
+					postcode_2 = ormchair.StringProperty(),
+					extra_postcodes = ormchair.ListProperty(
+						ormchair.StringProperty()
+					)
+				)
+			)
+			
+			other_addresses = ormchair.ListProperty(
+				ormchair.DictProperty(
+					address_1 = ormchair.StringProperty(),
+					address_2 = ormchair.StringProperty(default="wessex")
+				)
+			)
+			
+			related_pets = ormchair.LinkProperty(Pet,reverse="owner",index_property_paths=["name"],reverse_index_property_paths=["address.postcode.postcode_1"])
+			
+			best_pet = ormchair.EmbeddedLinkProperty(Pet)
+			
+			owned_pets = ormchair.ListProperty(
+				ormchair.EmbeddedLinkProperty(Pet)
+			)
+			
+			
+			get_by_name = ormchair.Index("name")
+			get_by_name_and_address = ormchair.Index("name","address.address_1")
+		
+		self.pet_class = Pet
+		self.person_class = Person
+		self.all_pets_design_document_class = AllPetsDesignDocument
+		
+		self.test_ormchair_db.sync()
+		
+	def tearDown(self):
+		
+		self.session = None
+		self.pet_class = None
+		self.person_class = None
+		self.all_pets_design_document_class = None
+		self.test_ormchair_db = None
+	
+	def test_sync(self):
+		
+		all_pets_design_document = self.test_ormchair_db.get("_design/all_pets")
+		pet_schema_design_document = self.test_ormchair_db.get(self.pet_class.getSchemaDesignDocumentId())
+		person_schema_design_document = self.test_ormchair_db.get(self.person_class.getSchemaDesignDocumentId())
+		
+		self.assertTrue(issubclass(all_pets_design_document.__class__,ormchair.DesignDocument))
+		self.assertTrue(issubclass(pet_schema_design_document.__class__,ormchair.DesignDocument))
+		self.assertTrue(issubclass(person_schema_design_document.__class__,ormchair.DesignDocument))
+		
+		self.assertTrue(len(all_pets_design_document._rev)>0)
+		self.assertTrue(len(pet_schema_design_document._rev)>0)
+		self.assertTrue(len(person_schema_design_document._rev)>0)
+	
+	def test_sync_staged(self):
+		
+		# Change the saved design document so that sync has to deploy the class version
+		all_pets_design_document = self.test_ormchair_db.get("_design/all_pets")
+		all_pets_design_document.all_pets = {"map" : "function(doc) {}"}
+		self.test_ormchair_db.update(all_pets_design_document)
+		
+		deployments = self.test_ormchair_db.sync(staged=True,wait=True)
+		
+		self.assertEqual(len(deployments),1)
+		self.assertTrue(deployments[0].isComplete())
+		
+		all_pets_design_document = self.test_ormchair_db.get("_design/all_pets")
+		self.assertEqual(all_pets_design_document.all_pets,self.all_pets_design_document_class().all_pets)
+		self.assertEqual(all_pets_design_document._rev,deployments[0].getDesignDocument()._rev)
+		
+		# Staging document is removed once swapped in
+		self.assertRaises(Exception,self.test_ormchair_db.get,self.test_ormchair_db.getStagingDesignDocumentId("_design/all_pets"))
+	
+	def test_sync_staged_schema_version(self):
+		
+		class StagedPerson(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+		
+		self.test_ormchair_db.sync()
+		self.assertEqual(StagedPerson.getCurrentSchemaVersion(),0)
+		
+		# Redefine the class with a new schema (replacing the old one)
+		class StagedPerson(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			age = ormchair.IntegerProperty()
+		
+		design_document_id = StagedPerson.getSchemaDesignDocumentId()
+		
+		# A failed deployment keeps the live schema version and removes its staging document
+		database_session = self.test_ormchair_db._database_session
+		request = database_session.request
+		
+		def failCopy(method,url,**kwargs):
+			if method == "COPY":
+				raise Exception("COPY failed")
+			return request(method,url,**kwargs)
+		
+		database_session.request = failCopy
+		
+		try:
+			deployments = [deployment for deployment in self.test_ormchair_db.sync(staged=True) if deployment.getDesignDocument()._id == design_document_id]
+			self.assertEqual(StagedPerson.getCurrentSchemaVersion(),0)
+			self.assertRaises(Exception,deployments[0].wait)
+		finally:
+			del database_session.request
+		
+		self.assertEqual(StagedPerson.getCurrentSchemaVersion(),0)
+		self.assertEqual(self.test_ormchair_db.get(design_document_id,as_json=True)["version"],0)
+		self.assertRaises(Exception,self.test_ormchair_db.get,self.test_ormchair_db.getStagingDesignDocumentId(design_document_id))
+		
+		# The new version is used once the new design document is live
+		self.test_ormchair_db.sync(staged=True,wait=True)
+		self.assertEqual(StagedPerson.getCurrentSchemaVersion(),1)
+		self.assertEqual(self.test_ormchair_db.get(design_document_id,as_json=True)["version"],1)
+	
+	def test_warm_up(self):
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		self.test_ormchair_db.add(pet1)
+		
+		self.assertIn(self.pet_class.getSchemaDesignDocumentId(),self.test_ormchair_db.getDesignDocumentIds())
+		self.assertIn("_design/all_pets",self.test_ormchair_db.getDesignDocumentIds())
+		
+		# Not in the background the indexes are built on the calling thread
+		request_threads = set()
+		request_hook = lambda event: request_threads.add(threading.current_thread())
+		self.session.addRequestHook(request_hook)
+		
+		try:
+			self.assertEqual(self.test_ormchair_db.warmUp(background=False),True)
+		finally:
+			self.session.removeRequestHook(request_hook)
+		
+		self.assertEqual(request_threads,set([threading.current_thread()]))
+		
+		self.assertTrue(self.test_ormchair_db.warmUp().wait())
+		
+		index_status = self.test_ormchair_db.getIndexStatus()
+		self.assertEqual(index_status["_design/all_pets"]["lag"],0)
+		self.assertEqual(index_status[self.pet_class.getSchemaDesignDocumentId()]["lag"],0)
+		
+		self.assertTrue(self.test_ormchair_db.waitUntilIndexed(timeout=10))
+		
+		# Opaque sequences have only caught up when equal
+		self.assertEqual(ormchair._sequenceLag(12,10),2)
+		self.assertEqual(ormchair._sequenceLag("12-g1AAAA","12-g1AAAA"),0)
+		self.assertEqual(ormchair._sequenceLag("12-g1AAAA","12-g1BBBB"),1)
+		self.assertEqual(ormchair._sequenceLag("15-g1AAAA","12-g1BBBB"),3)
+	
+	def test_request_hooks(self):
+		
+		self.session.getMetrics().reset()
+		
+		events = []
+		self.session.addRequestHook(events.append)
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		self.test_ormchair_db.add(person1)
+		self.test_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will")
+		
+		self.session.removeRequestHook(events.append)
+		
+		end_events = [event for event in events if event["stage"] == "end"]
+		self.assertEqual([(event["method"],event["endpoint"],event["operation"]) for event in end_events],[
+			("PUT","doc","add"),
+			("POST","view:_design/_schema_person/indexes_","getByView")
+		])
+		self.assertEqual(end_events[1]["root_operation"],"getByIndex")
+		self.assertEqual(end_events[0]["status"],201)
+		self.assertGreater(end_events[0]["bytes_sent"],0)
+		self.assertGreater(end_events[1]["bytes_received"],0)
+		
+		metrics = self.session.getMetrics()
+		self.assertEqual(metrics.getCounter("ormchair_database_calls_total",{"method" : "getByIndex", "status" : "ok"}),1)
+		self.assertEqual(metrics.getHistogram("ormchair_database_call_seconds",{"method" : "add"})["count"],1)
+		self.assertEqual(metrics.getCounter("ormchair_http_requests_total",{"method" : "PUT", "endpoint" : "doc", "status" : 201}),1)
+		self.assertEqual(metrics.getCounter("ormchair_operation_http_requests_total",{"operation" : "getByIndex"}),1)
+	
+	def test_tracing(self):
+		
+		exporter = ormchair.InMemorySpanExporter()
+		self.session.setTracer(ormchair.Tracer(exporter))
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		try:
+			self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		finally:
+			self.session.setTracer(None)
+		
+		root_spans = exporter.getRootSpans()
+		self.assertEqual([span.name for span in root_spans],["Database.addLink"])
+		
+		add_links_span = root_spans[0].children[0]
+		self.assertEqual(add_links_span.name,"Database.addLinks")
+		self.assertEqual([span.name for span in add_links_span.children][-1],"HTTP POST")
+		self.assertEqual(add_links_span.children[-1].attributes["endpoint"],"_bulk_docs")
+		self.assertEqual(add_links_span.children[-1].attributes["status"],201)
+		
+	def test_profile(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		with ormchair.profile() as profiler:
+			self.test_ormchair_db.add(person1)
+			self.test_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will")
+		
+		stats = profiler.getStats()
+		self.assertEqual(sorted(stats.keys()),["add","getByIndex"])
+		self.assertEqual(stats["getByIndex"]["calls"],1)
+		self.assertEqual(sorted(stats["getByIndex"]["phases"].keys()),["http","inflate","other","parse","process","serialize"])
+		self.assertEqual(sorted(stats["add"]["phases"].keys()),["http","other","parse","serialize"])
+		self.assertGreater(stats["getByIndex"]["phases"]["http"]["wall"],0)
+		self.assertGreater(stats["getByIndex"]["phases"]["inflate"]["allocations"],0)
+		self.assertIn("getByIndex",profiler.getReport())
+		
+		# The garbage collector stays paused until the last of overlapping profilers on different threads exits
+		self.assertTrue(gc.isenabled())
+		
+		first_entered = threading.Event()
+		first_exit = threading.Event()
+		
+		def profileThread():
+			with ormchair.profile():
+				first_entered.set()
+				first_exit.wait()
+		
+		profile_thread = threading.Thread(target=profileThread)
+		profile_thread.start()
+		first_entered.wait()
+		
+		with ormchair.profile():
+			
+			first_exit.set()
+			profile_thread.join()
+			self.assertFalse(gc.isenabled())
+		
+		self.assertTrue(gc.isenabled())
+		
+	def test_json_codec(self):
+		
+		class CountingJSONCodec(ormchair.JSONCodec):
+			
+			def __init__(self):
+				self.dumps_count = 0
+				self.loads_count = 0
+			
+			def dumps(self,data):
+				self.dumps_count += 1
+				return super(CountingJSONCodec,self).dumps(data)
+			
+			def loads(self,content):
+				self.loads_count += 1
+				return super(CountingJSONCodec,self).loads(content)
+		
+		json_codec = CountingJSONCodec()
+		session = ormchair.Session(getCouchDBUrl(),json_codec=json_codec)
+		test_ormchair_db = session.getDatabase("test_ormchair")
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		test_ormchair_db.add(person1)
+		test_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will")
+		
+		# getDatabase, add and getByIndex each decode a response, add encodes its body and getByIndex its key and body
+		self.assertEqual(json_codec.loads_count,3)
+		self.assertEqual(json_codec.dumps_count,3)
+		
+	def test_attachments(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		# Adds the document first
+		self.test_ormchair_db.putAttachment(person1,"notes.txt","Some notes",content_type="text/plain")
+		self.assertTrue(person1.hasBeenAdded())
+		
+		self.test_ormchair_db.putAttachment(person1,"photo.bin",memoryview(bytearray("\x00\x01\x02" * 1000)))
+		
+		with tempfile.TemporaryFile() as attachment_file:
+			
+			attachment_file.write("x" * 100000)
+			attachment_file.flush()
+			
+			attachment_file.seek(0)
+			self.test_ormchair_db.putAttachment(person1,"file.bin",attachment_file)
+			
+			attachment_map = mmap.mmap(attachment_file.fileno(),0,access=mmap.ACCESS_READ)
+			self.test_ormchair_db.putAttachment(person1,"mmap.bin",attachment_map)
+			attachment_map.close()
+		
+		# In memory files are read from their current position
+		for attachment_file in [StringIO.StringIO("skip notes"),io.BytesIO("skip notes")]:
+			attachment_file.seek(5)
+			self.test_ormchair_db.putAttachment(person1,"memory.txt",attachment_file,content_type="text/plain")
+			self.assertEqual(self.test_ormchair_db.getAttachment(person1,"memory.txt"),"notes")
+		
+		# Unless the length is passed sources that can't seek are rejected
+		unseekable_file = StringIO.StringIO("notes")
+		unseekable_source = type("UnseekableFile",(object,),{"read" : lambda self,size=-1: unseekable_file.read(size)})()
+		self.assertRaises(Exception,self.test_ormchair_db.putAttachment,person1,"memory.txt",unseekable_source)
+		self.test_ormchair_db.putAttachment(person1,"memory.txt",unseekable_source,length=5)
+		self.assertEqual(self.test_ormchair_db.getAttachment(person1,"memory.txt"),"notes")
+		self.test_ormchair_db.deleteAttachment(person1,"memory.txt")
+		
+		self.assertEqual(self.test_ormchair_db.getAttachment(person1,"notes.txt"),"Some notes")
+		self.assertEqual(self.test_ormchair_db.getAttachment(person1,"photo.bin"),"\x00\x01\x02" * 1000)
+		
+		sink = StringIO.StringIO()
+		self.assertEqual(self.test_ormchair_db.getAttachment(person1,"file.bin",sink=sink),100000)
+		self.assertEqual(sink.getvalue(),"x" * 100000)
+		
+		self.assertEqual([len(chunk) for chunk in self.test_ormchair_db.iterAttachment(person1._id,"mmap.bin",chunk_size=40000)],[40000,40000,20000])
+		
+		# Stubs survive a get and update
+		person1_fetched = self.test_ormchair_db.get(person1._id)
+		self.assertEqual(person1_fetched.getAttachmentNames(),["file.bin","mmap.bin","notes.txt","photo.bin"])
+		self.assertEqual(person1_fetched.getAttachmentStub("notes.txt")["content_type"],"text/plain")
+		
+		person1_fetched.name = "Bill"
+		self.test_ormchair_db.update(person1_fetched)
+		self.assertEqual(self.test_ormchair_db.getAttachment(person1_fetched,"notes.txt"),"Some notes")
+		
+		self.test_ormchair_db.deleteAttachment(person1_fetched,"notes.txt")
+		self.assertFalse(person1_fetched.hasAttachment("notes.txt"))
+		self.assertRaises(Exception,self.test_ormchair_db.getAttachment,person1_fetched,"notes.txt")
+		self.assertTrue(self.test_ormchair_db.get(person1._id).hasAttachment("photo.bin"))
+		
+	def test_attachment_property(self):
+		
+		class Report(ormchair.Document):
+			
+			title = ormchair.StringProperty()
+			body = ormchair.AttachmentProperty(content_type="text/plain",required=True)
+			thumbnail = ormchair.AttachmentProperty(cache=False)
+		
+		schema = Report.schemaToDict()
+		self.assertEqual(schema["properties"]["body"],{"type" : "string", "media" : {"type" : "text/plain"}, "required" : True})
+		self.assertEqual(schema["properties"]["thumbnail"],{"type" : "string", "media" : {"type" : "application/octet-stream"}})
+		
+		report = Report()
+		report.title = "Big"
+		report.body = "x" * 100000
+		
+		# Sent inline with the add
+		self.assertEqual(report.instanceToDict()["_attachments"]["body"]["content_type"],"text/plain")
+		self.assertFalse("body" in report.instanceToDict())
+		self.test_ormchair_db.add(report)
+		
+		# Only the stub is sent once saved
+		self.assertEqual(report.instanceToDict()["_attachments"]["body"],{"content_type" : "text/plain", "length" : 100000, "stub" : True})
+		self.assertEqual(report.body,"x" * 100000)
+		
+		# Read only the stub then fetch on first access
+		metrics = self.session.getMetrics()
+		report_fetched = self.test_ormchair_db.get(report._id)
+		self.assertEqual(report_fetched.thumbnail,None)
+		
+		requests_before = metrics.getCounter("ormchair_database_calls_total",{"method" : "getAttachment", "status" : "ok"})
+		self.assertEqual(report_fetched.body,"x" * 100000)
+		self.assertEqual(report_fetched.body,"x" * 100000)
+		self.assertEqual(metrics.getCounter("ormchair_database_calls_total",{"method" : "getAttachment", "status" : "ok"}) - requests_before,1)
+		
+		# Updating other properties keeps the attachment
+		report_fetched.title = "Bigger"
+		report_fetched.thumbnail = "\x89PNG"
+		self.test_ormchair_db.update(report_fetched)
+		
+		report_fetched = self.test_ormchair_db.get(report._id)
+		self.assertEqual(report_fetched.title,"Bigger")
+		self.assertEqual(report_fetched.body,"x" * 100000)
+		
+		# Not cached so fetched on each access
+		requests_before = metrics.getCounter("ormchair_database_calls_total",{"method" : "getAttachment", "status" : "ok"})
+		self.assertEqual(report_fetched.thumbnail,"\x89PNG")
+		self.assertEqual(report_fetched.thumbnail,"\x89PNG")
+		self.assertEqual(metrics.getCounter("ormchair_database_calls_total",{"method" : "getAttachment", "status" : "ok"}) - requests_before,2)
+		
+		# Setting None removes the attachment
+		report_fetched.thumbnail = None
+		self.test_ormchair_db.update(report_fetched)
+		self.assertEqual(self.test_ormchair_db.get(report._id).getAttachmentNames(),["body"])
+		
+		# Unbound documents can't fetch
+		self.assertRaises(Exception,getattr,Report(document_data=report_fetched.instanceToDict()),"body")
+		
+	def test_add_document(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+
+		try:
+			person1 = self.test_ormchair_db.add(person1)
+			person1_fetched = self.test_ormchair_db.get(person1._id)
+			self.assertEqual(person1, person1_fetched)
+		except Exception as e:
+			self.fail()
+		
+	def test_add_documents(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		person2 = self.person_class()
+		person2.name = "Tom"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		pet2 = self.pet_class()
+		pet2.name = "Snoop"
+		
+		self.assertNotEqual(person1.name, person2.name)
+		self.assertNotEqual(pet1.name, pet2.name)
+		
+		try:
+			self.test_ormchair_db.addMultiple([person1,person2,pet1,pet2])
+			fetched = self.test_ormchair_db.getMultiple([person1._id,person2._id,pet1._id,pet2._id])
+			self.assertEqual(person1, fetched[0])
+			self.assertEqual(person2, fetched[1])
+			self.assertEqual(pet1, fetched[2])
+			self.assertEqual(pet2, fetched[3])
+			
+		except Exception as e:
+			self.fail()
+			
+	def test_delete_document(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		self.test_ormchair_db.add(person1)
+		
+		person1_fetched = self.test_ormchair_db.get(person1._id)
+		self.assertEquals(person1, person1_fetched)
+		
+		self.test_ormchair_db.delete(person1)
+		self.assertRaises(Exception, self.test_ormchair_db.get,person1._id)
+		
+	def test_delete_documents(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		person2 = self.person_class()
+		person2.name = "Tom"
+		
+		self.test_ormchair_db.addMultiple([person1,person2])
+		
+		persons_fetched = self.test_ormchair_db.getMultiple([person1._id,person2._id])
+		self.assertIn(person1, persons_fetched)
+		self.assertIn(person2, persons_fetched)
+		
+		self.test_ormchair_db.deleteMultiple([person1,person2])
+		self.assertRaises(Exception, self.test_ormchair_db.getMultiple,[person1._id,person2._id])
+			
+	def test_update_documents(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		person2 = self.person_class()
+		person2.name = "Tom"
+				
+		try:
+			self.test_ormchair_db.addMultiple([person1,person2])
+			
+			# Make rev old version so update should fail for person1
+			old_rev = person1._rev
+			person1.name = "Will2"
+			self.test_ormchair_db.update(person1)
+			person1._rev = old_rev
+			
+			(ok_docs,failed_docs) = self.test_ormchair_db.updateMultiple([person1,person2])
+			
+			self.assertEqual(ok_docs[0], person2)
+			self.assertEqual(failed_docs[0], person1)
+		
+		except Exception as e:
+			self.fail()
+	
+	def test_add_embedded_link(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		person1.best_pet = pet1
+		
+		self.test_ormchair_db.update(person1)
+		
+		fetched_person1 = self.test_ormchair_db.get(person1._id)
+		
+		self.assertEqual(fetched_person1.best_pet,pet1._id)
+	
+	def test_include_embedded_links(self):
+		
+		class IncludedCompany(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+		
+		class IncludedAuthor(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			company = ormchair.EmbeddedLinkProperty(IncludedCompany)
+		
+		class IncludedPost(ormchair.Document):
+			
+			title = ormchair.StringProperty()
+			author = ormchair.EmbeddedLinkProperty(IncludedAuthor)
+			reviewers = ormchair.ListProperty(
+				ormchair.EmbeddedLinkProperty(IncludedAuthor)
+			)
+			meta = ormchair.DictProperty(
+				editor = ormchair.EmbeddedLinkProperty(IncludedAuthor)
+			)
+			
+			get_by_title = ormchair.Index("title")
+		
+		self.test_ormchair_db.sync()
+		
+		company = IncludedCompany()
+		company.name = "acme"
+		
+		authors = []
+		for i in range(3):
+			author = IncludedAuthor()
+			author.name = "author_%d" % (i)
+			author.company = company._id
+			authors.append(author)
+		
+		posts = []
+		for i in range(10):
+			post = IncludedPost()
+			post.title = "post_%d" % (i)
+			post.author = authors[i % 3]._id
+			post.reviewers = [authors[0]._id,authors[1]._id]
+			post.meta.editor = authors[2]._id
+			posts.append(post)
+		
+		posts[9].author = "missing"
+		
+		self.test_ormchair_db.addMultiple([company] + authors + posts)
+		
+		events = []
+		self.session.addRequestHook(events.append)
+		
+		loaded_posts = self.test_ormchair_db.getMultiple([post._id for post in posts],include=["author.company","reviewers","meta.editor"])
+		
+		self.session.removeRequestHook(events.append)
+		
+		# One request for the posts and one per level of the paths
+		self.assertEqual(len([event for event in events if event["stage"] == "end"]),3)
+		
+		self.assertEqual(loaded_posts[0].author.name,"author_0")
+		self.assertEqual(loaded_posts[0].author.company.name,"acme")
+		self.assertEqual([reviewer.name for reviewer in loaded_posts[1].reviewers],["author_0","author_1"])
+		self.assertEqual(loaded_posts[2].meta.editor.name,"author_2")
+		
+		# Each linked document is inflated once and missing ones are left as ids
+		self.assertTrue(loaded_posts[0].author is loaded_posts[3].author)
+		self.assertTrue(loaded_posts[0].author is loaded_posts[5].reviewers[0])
+		self.assertEqual(loaded_posts[9].author,"missing")
+		
+		# Inflated links are still saved as ids
+		self.test_ormchair_db.update(loaded_posts[0])
+		post_data = self.test_ormchair_db.get(posts[0]._id,as_json=True)
+		self.assertEqual((post_data["author"],post_data["reviewers"],post_data["meta"]["editor"]),(authors[0]._id,[authors[0]._id,authors[1]._id],authors[2]._id))
+		
+		self.assertEqual(self.test_ormchair_db.get(posts[1]._id,include="author").author.name,"author_1")
+		self.assertEqual(self.test_ormchair_db.getByIndex(IncludedPost.get_by_title,key=["post_2"],include=["author"])[0].author.name,"author_2")
+		
+		events = []
+		self.session.addRequestHook(events.append)
+		self.test_ormchair_db.loadEmbeddedLinks(self.test_ormchair_db.getMultiple([post._id for post in posts]),["reviewers"],chunk_size=1)
+		self.session.removeRequestHook(events.append)
+		self.assertEqual(len([event for event in events if event["stage"] == "end"]),3)
+		
+		self.assertRaises(ormchair.PropertyPathNotFoundError,self.test_ormchair_db.get,posts[0]._id,include=["title"])
+	
+	def test_embedded_link_loader(self):
+		
+		class LoadedCompany(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+		
+		class LoadedAuthor(ormchair.Document):
+			
+			name = ormchair.StringProperty()
+			company = ormchair.EmbeddedLinkProperty(LoadedCompany)
+		
+		class LoadedPost(ormchair.Document):
+			
+			title = ormchair.StringProperty()
+			author = ormchair.EmbeddedLinkProperty(LoadedAuthor)
+			reviewers = ormchair.ListProperty(
+				ormchair.EmbeddedLinkProperty(LoadedAuthor)
+			)
+			meta = ormchair.DictProperty(
+				editor = ormchair.EmbeddedLinkProperty(LoadedAuthor)
+			)
+		
+		self.test_ormchair_db.sync()
+		
+		companies = []
+		for i in range(2):
+			company = LoadedCompany()
+			company.name = "company_%d" % (i)
+			companies.append(company)
+		
+		authors = []
+		for i in range(4):
+			author = LoadedAuthor()
+			author.name = "author_%d" % (i)
+			author.company = companies[i % 2]._id
+			authors.append(author)
+		
+		posts = []
+		for i in range(6):
+			post = LoadedPost()
+			post.title = "post_%d" % (i)
+			post.author = authors[i % 3]._id
+			post.reviewers = [authors[3]._id]
+			post.meta.editor = authors[(i + 1) % 4]._id
+			posts.append(post)
+		
+		posts[5].author = "missing"
+		
+		self.test_ormchair_db.addMultiple(companies + authors + posts)
+		
+		post_ids = [post._id for post in posts]
+		
+		events = []
+		
+		with self.test_ormchair_db.loader() as loader:
+			
+			loaded_posts = self.test_ormchair_db.getMultiple(post_ids)
+			
+			self.session.addRequestHook(events.append)
+			
+			# Reading the first post's author loads the authors of all the posts returned with it
+			self.assertEqual([post.author.name for post in loaded_posts[:5]],["author_0","author_1","author_2","author_0","author_1"])
+			self.assertEqual(len([event for event in events if event["stage"] == "end"]),1)
+			
+			# As does the next level, with the authors loaded together
+			self.assertEqual([post.author.company.name for post in loaded_posts[:5]],["company_0","company_1","company_0","company_0","company_1"])
+			self.assertEqual(len([event for event in events if event["stage"] == "end"]),2)
+			
+			# Links through list and dict properties, and documents already loaded are memoized
+			self.assertEqual([post.reviewers[0].name for post in loaded_posts],["author_3"] * 6)
+			self.assertEqual([post.meta.editor.name for post in loaded_posts],["author_1","author_2","author_3","author_0","author_1","author_2"])
+			self.assertEqual(len([event for event in events if event["stage"] == "end"]),3)
+			
+			self.session.removeRequestHook(events.append)
+			
+			self.assertTrue(loaded_posts[0].author is loaded_posts[3].author)
+			self.assertTrue(loaded_posts[0].reviewers[0] is loaded_posts[1].reviewers[0])
+			
+			# Missing documents are proxies that compare as their id
+			missing_author = loaded_posts[5].author
+			self.assertTrue(isinstance(missing_author,ormchair.EmbeddedLinkProxy))
+			self.assertEqual(missing_author,"missing")
+			self.assertEqual(missing_author._id,"missing")
+			self.assertEqual(missing_author.getDocument(),None)
+			self.assertRaises(ormchair.LinkedDocumentNotFoundError,getattr,missing_author,"name")
+			
+			self.assertEqual(loader.getStats(),{"requests" : 3, "loaded" : 6, "missing" : 1})
+			self.assertEqual(loader.getPendingCount(),0)
+		
+		with self.test_ormchair_db.loader():
+			
+			post = self.test_ormchair_db.get(post_ids[0])
+			other_post = self.test_ormchair_db.get(post_ids[1])
+			
+			# Proxies that haven't been loaded are saved as ids
+			self.assertTrue(isinstance(post.author,ormchair.EmbeddedLinkProxy))
+			post.meta.editor = other_post.author
+			self.assertEqual(post.instanceToDict()["reviewers"],[authors[3]._id])
+			self.assertEqual(post.instanceToDict()["meta"]["editor"],authors[1]._id)
+			
+			# Including in lists of embedded links
+			post.reviewers = [other_post.author,authors[3]._id]
+			self.assertEqual(post.instanceToDict()["reviewers"],[authors[1]._id,authors[3]._id])
+			self.assertTrue(all([isinstance(reviewer,basestring) for reviewer in post.instanceToDict()["reviewers"]]))
+		
+		# Outside a loader scope links are ids
+		self.assertEqual(self.test_ormchair_db.get(post_ids[0]).author,authors[0]._id)
+	
+	def test_add_link(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		
+		person1_related_pets = self.test_ormchair_db.getLinks(person1.related_pets)
+		
+		self.assertEqual(pet1, person1_related_pets[0])
+
+	def test_add_links(self):
 		
 		person1 = self.person_class()
 		person1.name = "Will"
@@ -847,6 +2328,174 @@ class DatabaseTestCase(unittest.TestCase):
 		# Checks duplicate isn't added (pet1)
 		self.assertEqual(len(person1_related_pets), 2)
 
+	def test_add_reverse_link(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		link_documents = self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		self.assertEqual(len(link_documents),1)
+		
+		# Linking from the other side finds the existing link document
+		reverse_link_documents = self.test_ormchair_db.addLink(pet1.owner, person1)
+		self.assertEqual(reverse_link_documents[0]._id,link_documents[0]._id)
+		
+		self.assertEqual(len(self.test_ormchair_db.getLinks(person1.related_pets)),1)
+		self.assertEqual(len(self.test_ormchair_db.getLinks(pet1.owner)),1)
+	
+	def test_add_links_failure(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		pet2 = self.pet_class()
+		pet2.name = "Snoop"
+		
+		pet3 = self.pet_class()
+		pet3.name = "Rex"
+		self.test_ormchair_db.add(pet3)
+		
+		self.test_ormchair_db.addLink(person1.related_pets, pet2)
+		
+		# New documents with the ids of existing ones conflict
+		conflicting_pet2 = self.pet_class()
+		conflicting_pet2._id = pet2._id
+		
+		conflicting_pet3 = self.pet_class()
+		conflicting_pet3._id = pet3._id
+		
+		self.assertRaises(Exception,self.test_ormchair_db.addLinks,person1.related_pets,[pet1,conflicting_pet2,conflicting_pet3])
+		
+		# The link to the document that couldn't be added is removed, links that already existed are kept
+		self.assertEqual(sorted([pet._id for pet in self.test_ormchair_db.getLinks(person1.related_pets)]),sorted([pet1._id,pet2._id]))
+	
+	def test_migrate_link_document_ids(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		self.test_ormchair_db.add(person1)
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		self.test_ormchair_db.add(pet1)
+		
+		# Link documents saved with random ids (as before link document ids were deterministic)
+		for i in range(2):
+			link_document = self.test_ormchair_db._createLinkDocument(person1,person1.related_pets[1],pet1)
+			link_document._id = uuid.uuid4().hex
+			self.test_ormchair_db.add(link_document)
+		
+		self.assertEqual(len(self.test_ormchair_db.getLinks(person1.related_pets)),2)
+		
+		self.assertEqual(self.test_ormchair_db.migrateLinkDocumentIds(batch_size=1),2)
+		self.assertEqual(self.test_ormchair_db.migrateLinkDocumentIds(),0)
+		
+		# Adding the link again finds the migrated link document
+		self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		self.assertEqual(len(self.test_ormchair_db.getLinks(person1.related_pets)),1)
+	
+	def test_lease_lock(self):
+		
+		lease_session = ormchair.Session(getCouchDBUrl(),username="testadmin", password="testadmin",Lock=ormchair.LeaseLock)
+		lease_ormchair_db = lease_session.getDatabase("test_ormchair")
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		lease_ormchair_db.addLink(person1.related_pets, pet1)
+		
+		person1.name = "Will2"
+		lease_ormchair_db.update(person1)
+		lease_ormchair_db.deleteLink(person1.related_pets, pet1)
+		
+		# Leases are removed once released
+		self.assertRaises(Exception,lease_ormchair_db.get,ormchair.LeaseLock.getLeaseDocumentId(person1._id))
+		
+		ormchair.LeaseLock.resetMetrics()
+		
+		# Another thread can't acquire a held lease
+		errors = []
+		def acquire(document_id):
+			try:
+				with ormchair.LeaseLock.configure(timeout=0.2)([document_id],database=lease_ormchair_db):
+					pass
+			except ormchair.LockTimeoutError as e:
+				errors.append(e)
+		
+		with ormchair.LeaseLock([person1._id,pet1._id],database=lease_ormchair_db):
+			
+			# Re-entrant in the same thread
+			with ormchair.LeaseLock([person1._id],database=lease_ormchair_db):
+				pass
+			
+			thread = threading.Thread(target=acquire,args=(person1._id,))
+			thread.start()
+			thread.join()
+		
+		self.assertEqual(len(errors),1)
+		
+		# Expired leases are taken over
+		expired_lock = ormchair.LeaseLock.configure(ttl=-1)([pet1._id],database=lease_ormchair_db)
+		expired_lock.__enter__()
+		
+		thread = threading.Thread(target=acquire,args=(pet1._id,))
+		thread.start()
+		thread.join()
+		
+		self.assertEqual(len(errors),1)
+		
+		metrics = ormchair.LeaseLock.getMetrics()
+		self.assertEqual(metrics["timeouts"],1)
+		self.assertGreaterEqual(metrics["contended"],1)
+		self.assertGreaterEqual(metrics["acquisitions"],3)
+		self.assertEqual(metrics["takeovers"],1)
+		
+		# Leaving a lock after its leases expired raises
+		self.assertRaises(ormchair.LeaseExpiredError,expired_lock.__exit__,None,None,None)
+		
+		# Leases won whilst another is held are given back each round (so overlapping locks can't deadlock)
+		release = threading.Event()
+		acquired = threading.Event()
+		def hold(document_id):
+			with ormchair.LeaseLock([document_id],database=lease_ormchair_db):
+				acquired.set()
+				release.wait()
+		
+		thread = threading.Thread(target=hold,args=(pet1._id,))
+		thread.start()
+		acquired.wait()
+		
+		events = []
+		lease_session.addRequestHook(events.append)
+		
+		try:
+			self.assertRaises(ormchair.LockTimeoutError,ormchair.LeaseLock.configure(timeout=0.1)([person1._id,pet1._id],database=lease_ormchair_db).__enter__)
+		finally:
+			lease_session.removeRequestHook(events.append)
+			release.set()
+			thread.join()
+		
+		bulk_requests = len([event for event in events if event["stage"] == "end" and event["endpoint"] == "_bulk_docs"])
+		lookup_requests = len([event for event in events if event["stage"] == "end" and event["endpoint"] == "_all_docs"])
+		self.assertEqual(bulk_requests,2 * lookup_requests)
+		self.assertRaises(Exception,lease_ormchair_db.get,ormchair.LeaseLock.getLeaseDocumentId(person1._id))
+		
+		# Leases can be renewed
+		with ormchair.LeaseLock([person1._id],database=lease_ormchair_db) as lease_lock:
+			
+			expires = lease_ormchair_db.get(ormchair.LeaseLock.getLeaseDocumentId(person1._id),as_json=True)["expires"]
+			lease_lock.renew()
+			self.assertGreater(lease_ormchair_db.get(ormchair.LeaseLock.getLeaseDocumentId(person1._id),as_json=True)["expires"],expires)
+	
 	def test_get_links_by_index(self):
 
 		person1 = self.person_class()
@@ -976,6 +2625,87 @@ class DatabaseTestCase(unittest.TestCase):
 		self.assertIn(person2,queried_persons)
 		self.assertIn(person1,queried_persons)
 		
+	def test_get_stale(self):
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		
+		self.test_ormchair_db.add(person1)
+		
+		pet1 = self.pet_class()
+		pet1.name = "Pooch"
+		
+		self.test_ormchair_db.addLink(person1.related_pets, pet1)
+		
+		# Bring the indexes up to date so stale reads have something to answer from
+		self.test_ormchair_db.waitUntilIndexed(timeout=10)
+		
+		stale_ormchair_db = self.session.getDatabase("test_ormchair",stale="update_after")
+		self.assertEqual(stale_ormchair_db.getStale(),"update_after")
+		
+		queried_persons = stale_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will")
+		self.assertIn(person1,queried_persons)
+		
+		self.assertIn(pet1,stale_ormchair_db.getLinks(person1.related_pets))
+		self.assertIn(pet1,self.test_ormchair_db.getLinks(person1.related_pets,stale="ok"))
+		self.assertIn(pet1,self.test_ormchair_db.getLinksByIndex(person1.related_pets,"name","Pooch",stale="ok"))
+		
+		update_param_ormchair_db = self.session.getDatabase("test_ormchair",stale="ok",use_update_param=True)
+		self.assertIn(person1,update_param_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will",stale=False))
+		self.assertIn(person1,update_param_ormchair_db.getByIndex(self.person_class.get_by_name,key="Will"))
+		
+		self.assertRaises(Exception,self.test_ormchair_db.setStale,"sometimes")
+	
+	def test_get_by_mango_index(self):
+		
+		mango_ormchair_db = self.session.getDatabase("test_ormchair",index_backend="mango")
+		mango_ormchair_db.sync()
+		
+		person1 = self.person_class()
+		person1.name = "Will"
+		person1.address.address_1 = "1 The Street"
+		
+		person2 = self.person_class()
+		person2.name = "Tom"
+		person2.address.address_1 = "2 The Street"
+		
+		mango_ormchair_db.addMultiple([person1,person2])
+		
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name,key="Tom")
+		
+		self.assertEqual(len(queried_persons), 1)
+		self.assertIn(person2,queried_persons)
+		
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name,keys=["Tom","Will"])
+		
+		self.assertEqual(len(queried_persons), 2)
+		self.assertIn(person2,queried_persons)
+		self.assertIn(person1,queried_persons)
+		
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["Will","1"],endkey=["Will",{}])
+		self.assertEqual(queried_persons,[person1])
+		
+		# Compound ranges are compared in key order like the view, not field by field
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["Tom","3"],endkey=["Will","2"])
+		self.assertEqual(queried_persons,[person1])
+		
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["Tom","1"],endkey=["Will","0"])
+		self.assertEqual(queried_persons,[person2])
+		
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["Will","2"],endkey=["Tom","1"],descending=True)
+		self.assertEqual(queried_persons,[person1,person2])
+		
+		self.assertEqual(mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["A"],limit=0),[])
+		
+		# Page through with the bookmark
+		first_page = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["A"],limit=1)
+		second_page = mango_ormchair_db.getByIndex(self.person_class.get_by_name_and_address,startkey=["A"],limit=1,bookmark=first_page.bookmark)
+		self.assertEqual(first_page + second_page,[person2,person1])
+		
+		# Projection returns partial json
+		queried_persons = mango_ormchair_db.getByIndex(self.person_class.get_by_name,key="Tom",fields=["_id","name"])
+		self.assertEqual(queried_persons,[{"_id" : person2._id, "name" : "Tom"}])
+	
 	def test_get_by_view(self):
 		
 		pet1 = self.pet_class()
@@ -1052,24 +2782,83 @@ def suite():
 	suite.addTest(LinkPropertyTestCase('test_return_type'))
 	suite.addTest(LinkPropertyTestCase('test_reverse_property'))
 	suite.addTest(LinkPropertyTestCase('test_has_links'))
+	suite.addTest(LinkPropertyTestCase('test_link_document_id'))
+	
+	suite.addTest(BasicLockTestCase('test_stripe_index'))
+	suite.addTest(BasicLockTestCase('test_reentrant'))
+	suite.addTest(BasicLockTestCase('test_contention'))
+	
+	suite.addTest(MetricsRegistryTestCase('test_to_dict'))
+	suite.addTest(MetricsRegistryTestCase('test_to_prometheus'))
+	
+	suite.addTest(TracerTestCase('test_nested_spans'))
+	suite.addTest(TracerTestCase('test_span_error'))
+	suite.addTest(TracerTestCase('test_slow_operation_log'))
+	
+	suite.addTest(FakeCouchDBServerTestCase('test_map_function_translator'))
+	suite.addTest(FakeCouchDBServerTestCase('test_request_counts'))
+	suite.addTest(FakeCouchDBServerTestCase('test_latency'))
+	suite.addTest(FakeCouchDBServerTestCase('test_failure_rate'))
+	suite.addTest(FakeCouchDBServerTestCase('test_changes'))
+	
+	suite.addTest(NodePoolTestCase('test_read_balancing'))
+	suite.addTest(NodePoolTestCase('test_failover'))
+	suite.addTest(NodePoolTestCase('test_hedging'))
+	suite.addTest(ShardedDatabaseTestCase('test_routing'))
+	suite.addTest(ShardedDatabaseTestCase('test_scatter_gather'))
+	suite.addTest(ShardedDatabaseTestCase('test_mixed_case_keys'))
+	suite.addTest(ShardedDatabaseTestCase('test_collation_order'))
+	suite.addTest(ShardedDatabaseTestCase('test_sync'))
+	suite.addTest(ShardedDatabaseTestCase('test_shard_by_type'))
+	suite.addTest(PartitionedDatabaseTestCase('test_partitioned_ids'))
+	suite.addTest(PartitionedDatabaseTestCase('test_partition_queries'))
+	suite.addTest(PartitionedDatabaseTestCase('test_partitioned_links'))
+	suite.addTest(PartitionedDatabaseTestCase('test_non_partitioned_database'))
+	suite.addTest(SchemaMigrationTestCase('test_migrate'))
+	suite.addTest(SchemaMigrationTestCase('test_migrate_document_data'))
+	suite.addTest(SchemaMigrationTestCase('test_migrate_on_read'))
+	suite.addTest(BenchTestCase('test_run_scenario'))
+	
+	suite.addTest(JSONCodecTestCase('test_get_json_codec'))
+	suite.addTest(JSONCodecTestCase('test_round_trip'))
+	
+	suite.addTest(CompressionTestCase('test_should_compress'))
+	suite.addTest(CompressionTestCase('test_compression'))
 	
 	suite.addTest(SessionTestCase('test_create_database'))
 	suite.addTest(SessionTestCase('test_get_database'))
 	suite.addTest(SessionTestCase('test_delete_database'))
 	
 	suite.addTest(DatabaseTestCase('test_sync'))
+	suite.addTest(DatabaseTestCase('test_sync_staged'))
+	suite.addTest(DatabaseTestCase('test_sync_staged_schema_version'))
+	suite.addTest(DatabaseTestCase('test_warm_up'))
+	suite.addTest(DatabaseTestCase('test_request_hooks'))
+	suite.addTest(DatabaseTestCase('test_tracing'))
+	suite.addTest(DatabaseTestCase('test_profile'))
+	suite.addTest(DatabaseTestCase('test_json_codec'))
+	suite.addTest(DatabaseTestCase('test_attachments'))
+	suite.addTest(DatabaseTestCase('test_attachment_property'))
 	suite.addTest(DatabaseTestCase('test_add_document'))
 	suite.addTest(DatabaseTestCase('test_add_documents'))
 	suite.addTest(DatabaseTestCase('test_delete_document'))
 	suite.addTest(DatabaseTestCase('test_delete_documents'))
 	suite.addTest(DatabaseTestCase('test_update_documents'))
 	suite.addTest(DatabaseTestCase('test_add_embedded_link'))
+	suite.addTest(DatabaseTestCase('test_include_embedded_links'))
+	suite.addTest(DatabaseTestCase('test_embedded_link_loader'))
 	suite.addTest(DatabaseTestCase('test_add_link'))
 	suite.addTest(DatabaseTestCase('test_add_links'))
+	suite.addTest(DatabaseTestCase('test_add_reverse_link'))
+	suite.addTest(DatabaseTestCase('test_add_links_failure'))
+	suite.addTest(DatabaseTestCase('test_migrate_link_document_ids'))
+	suite.addTest(DatabaseTestCase('test_lease_lock'))
 	suite.addTest(DatabaseTestCase('test_get_links_by_index'))
 	suite.addTest(DatabaseTestCase('test_delete_links'))
 	suite.addTest(DatabaseTestCase('test_get_by_index'))
+	suite.addTest(DatabaseTestCase('test_get_by_mango_index'))
 	suite.addTest(DatabaseTestCase('test_get_by_view'))
+	suite.addTest(DatabaseTestCase('test_get_stale'))
 	suite.addTest(DatabaseTestCase('test_get_by_view_in_document'))
 	suite.addTest(DatabaseTestCase('test_delete_document_with_links'))
 	suite.addTest(DatabaseTestCase('test_update_document_with_link_indexes'))